@@ -1,29 +1,61 @@
 import time
-import requests
-import bs4
 import re
 import os
 import random
 import json
-import urllib3
 import threading
+import queue
+import atexit
+import sqlite3
+import zlib
+import argparse
 import signal
 import sys
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from tqdm import tqdm
-from collections import OrderedDict
-from fake_useragent import UserAgent
+import bisect
+import importlib
+import importlib.util
+import codecs
+import html
+import heapq
+import zipfile
+import shutil
+import socket
+import struct
+import mmap
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import OrderedDict, deque
 from typing import Optional, Dict
-from Crypto.Cipher import AES
-from Crypto.Util.Padding import pad, unpad
-from Crypto.Random import get_random_bytes
 import base64
 import gzip
-from urllib.parse import urlencode
+from urllib.parse import urlencode, urlparse
 
-# 禁用SSL证书验证警告
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-requests.packages.urllib3.disable_warnings()
+class LazyModule:
+    """首次访问属性时才导入的模块，较重的第三方库只在用到时加载，缩短启动时间"""
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+# PyInstaller 无法识别这里的延迟导入，打包时需要用 --hidden-import 指定（见 build-executable.yml）
+requests = LazyModule("requests")
+asyncio = LazyModule("asyncio")
+aiohttp = LazyModule("aiohttp")
+tqdm = LazyModule("tqdm")
+AES = LazyModule("Crypto.Cipher.AES")
+Padding = LazyModule("Crypto.Util.Padding")
+CryptoRandom = LazyModule("Crypto.Random")
+zstandard = LazyModule("zstandard")
+
+def has_aiohttp():
+    return importlib.util.find_spec("aiohttp") is not None
+
+def has_zstandard():
+    return importlib.util.find_spec("zstandard") is not None
 
 okp = [
     "ac25", "c67d", "dd8f", "38c1", 
@@ -42,25 +74,417 @@ class FqCrypto:
 
     def encrypt(self, data, iv):
         cipher = AES.new(self.key, self.cipher_mode, iv)
-        ct_bytes = cipher.encrypt(pad(data, AES.block_size))
+        ct_bytes = cipher.encrypt(Padding.pad(data, AES.block_size))
         return ct_bytes
 
     def decrypt(self, data):
         iv = data[:16]
         ct = data[16:]
         cipher = AES.new(self.key, self.cipher_mode, iv)
-        pt = unpad(cipher.decrypt(ct), AES.block_size)
+        pt = Padding.unpad(cipher.decrypt(ct), AES.block_size)
         return pt
 
     def new_register_key_content(self, server_device_id, str_val):
         if not str_val.isdigit() or not server_device_id.isdigit():
             raise ValueError(f"Parse failed\nserver_device_id: {server_device_id}\nstr_val:{str_val}")
         combined_bytes = int(server_device_id).to_bytes(8, byteorder='little') + int(str_val).to_bytes(8, byteorder='little')
-        iv = get_random_bytes(16)
+        iv = CryptoRandom.get_random_bytes(16)
         enc_data = self.encrypt(combined_bytes, iv)
         combined_bytes = iv + enc_data
         return base64.b64encode(combined_bytes).decode('utf-8')
 
+class FqKeyCache:
+    """registerkey 密钥缓存，按 install_id/server_device_id 区分，所有线程共享"""
+    def __init__(self, ttl, cache_file=None):
+        self.ttl = ttl
+        self.cache_file = cache_file
+        self.lock = threading.Lock()
+        self.fetch_locks = {}
+        self.entries = {}
+        self.cryptos = {}
+        self.load()
+
+    @staticmethod
+    def cache_key(var):
+        return f"{var.install_id}:{var.server_device_id}"
+
+    def load(self):
+        """从磁盘加载未过期的密钥"""
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            now = time.time()
+            self.entries = {k: v for k, v in data.items() if v.get("expire", 0) > now}
+        except Exception as e:
+            print(f"读取密钥缓存失败: {str(e)}")
+
+    def save(self):
+        """将密钥写入磁盘，先写临时文件再替换"""
+        if not self.cache_file:
+            return
+        try:
+            tmp_file = self.cache_file + ".tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_file, self.cache_file)
+        except Exception as e:
+            print(f"保存密钥缓存失败: {str(e)}")
+
+    def lookup(self, var):
+        """返回缓存中未过期的解密器，没有则返回 None"""
+        name = self.cache_key(var)
+        with self.lock:
+            entry = self.entries.get(name)
+            if not entry or entry["expire"] <= time.time():
+                return None
+            crypto = self.cryptos.get(name)
+            if crypto is None:
+                crypto = self.cryptos[name] = FqCrypto(entry["key"])
+            return crypto
+
+    def store(self, var, key):
+        """保存新注册的密钥并返回对应的解密器"""
+        name = self.cache_key(var)
+        crypto = FqCrypto(key)
+        with self.lock:
+            self.entries[name] = {"key": key, "expire": time.time() + self.ttl}
+            self.cryptos[name] = crypto
+            self.save()
+        return crypto
+
+    def get_crypto(self, client):
+        """获取可用的解密器，缓存失效时才重新注册密钥"""
+        crypto = self.lookup(client.var)
+        if crypto is not None:
+            return crypto
+        with self.lock:
+            fetch_lock = self.fetch_locks.setdefault(self.cache_key(client.var), threading.Lock())
+
+        # 同一身份只允许一个线程去注册密钥，其他线程等待结果
+        with fetch_lock:
+            crypto = self.lookup(client.var)
+            if crypto is not None:
+                return crypto
+            return self.store(client.var, client.get_register_key())
+
+    def invalidate(self, var, crypto=None):
+        """作废密钥；传入 crypto 时仅当缓存仍是该密钥才作废，避免重复刷新"""
+        name = self.cache_key(var)
+        with self.lock:
+            if crypto is not None and self.cryptos.get(name) is not crypto:
+                return
+            self.entries.pop(name, None)
+            self.cryptos.pop(name, None)
+            self.save()
+
+def get_key_cache():
+    """获取全局密钥缓存"""
+    global KEY_CACHE
+    if KEY_CACHE is None:
+        with KEY_CACHE_LOCK:
+            if KEY_CACHE is None:
+                KEY_CACHE = FqKeyCache(CONFIG["key_ttl"], CONFIG["key_cache_file"])
+    return KEY_CACHE
+
+KEY_CACHE = None
+KEY_CACHE_LOCK = threading.Lock()
+
+class TokenBucket:
+    """令牌桶限速器，线程安全，允许突发请求，遇到 429/5xx 时自动降速"""
+    def __init__(self, rate, burst):
+        self.base_rate = rate
+        self.rate = rate
+        self.min_rate = rate / 8
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.acquired = 0
+        self.waited = 0
+        self.wait_time = 0.0
+        self.throttled = 0
+
+    def reserve(self):
+        """取走一个令牌，返回需要等待的秒数（不足时预支令牌）"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+            self.acquired += 1
+            if delay:
+                self.waited += 1
+                self.wait_time += delay
+            return delay
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+    async def acquire_async(self):
+        delay = self.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+    def feedback(self, status_code):
+        """根据响应状态调整速率：被限流或服务端错误时减半，成功后逐步恢复"""
+        with self.lock:
+            if status_code == 429 or status_code >= 500:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.throttled += 1
+            elif self.rate < self.base_rate:
+                self.rate = min(self.base_rate, self.rate * 1.1)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "rate": round(self.rate, 3),
+                "acquired": self.acquired,
+                "waited": self.waited,
+                "wait_time": round(self.wait_time, 3),
+                "throttled": self.throttled
+            }
+
+def get_rate_limiter(name):
+    """按名称获取限速器：official:<install_id>、fanqienovel.com 或备用API的主机名；
+    没有单独配置的官方API身份使用 official 的限速"""
+    with RATE_LIMITERS_LOCK:
+        limiter = RATE_LIMITERS.get(name)
+        if limiter is None:
+            limits = CONFIG["rate_limits"]
+            limit = limits.get(name) or limits.get(name.split(":", 1)[0]) or limits["default"]
+            limiter = RATE_LIMITERS[name] = TokenBucket(limit["rate"], limit["burst"])
+        return limiter
+
+def get_endpoint_limiter_name(api_endpoint):
+    return urlparse(api_endpoint).netloc
+
+def rate_limiter_stats():
+    with RATE_LIMITERS_LOCK:
+        limiters = dict(RATE_LIMITERS)
+    return {name: limiter.stats() for name, limiter in limiters.items()}
+
+RATE_LIMITERS = {}
+RATE_LIMITERS_LOCK = threading.Lock()
+
+class Metrics:
+    """进程内的性能指标：直方图记录耗时分布，计数器记录请求数、字节数和重试次数，
+    可以导出为 JSON 报告或 Prometheus 文本格式"""
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    @staticmethod
+    def format_key(key, extra=()):
+        name, labels = key
+        labels = labels + tuple(extra)
+        if not labels:
+            return name
+        return name + "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = {"buckets": [0] * (len(self.BUCKETS) + 1), "count": 0, "sum": 0.0, "max": 0.0}
+            hist["buckets"][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            hist["count"] += 1
+            hist["sum"] += seconds
+            hist["max"] = max(hist["max"], seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def percentile(self, hist, q):
+        """按直方图估算分位数（取所在区间的上界）"""
+        target = hist["count"] * q
+        seen = 0
+        for bound, count in zip(self.BUCKETS, hist["buckets"]):
+            seen += count
+            if seen >= target:
+                return min(bound, hist["max"])
+        return hist["max"]
+
+    def report(self):
+        """JSON 报告：计数器和每个直方图的次数、总耗时、平均值与分位数"""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: dict(hist, buckets=list(hist["buckets"])) for key, hist in self.histograms.items()}
+        return {
+            "uptime": round(time.time() - self.started, 3),
+            "counters": {self.format_key(key): value for key, value in sorted(counters.items())},
+            "histograms": {self.format_key(key): {
+                "count": hist["count"],
+                "sum": round(hist["sum"], 6),
+                "avg": round(hist["sum"] / hist["count"], 6),
+                "p50": round(self.percentile(hist, 0.5), 6),
+                "p90": round(self.percentile(hist, 0.9), 6),
+                "p99": round(self.percentile(hist, 0.99), 6),
+                "max": round(hist["max"], 6)
+            } for key, hist in sorted(histograms.items())}
+        }
+
+    def prometheus(self, prefix="tomato_"):
+        """Prometheus 文本格式"""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, dict(hist, buckets=list(hist["buckets"]))) for key, hist in self.histograms.items())
+        lines = []
+        declared = set()
+        for (name, labels), value in counters:
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {prefix}{name} counter")
+            lines.append(f"{self.format_key((prefix + name, labels))} {value}")
+        for (name, labels), hist in histograms:
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# TYPE {prefix}{name} histogram")
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + ("+Inf",), hist["buckets"]):
+                cumulative += count
+                lines.append(f"{self.format_key((prefix + name + '_bucket', labels), [('le', bound)])} {cumulative}")
+            lines.append(f"{self.format_key((prefix + name + '_sum', labels))} {hist['sum']}")
+            lines.append(f"{self.format_key((prefix + name + '_count', labels))} {hist['count']}")
+        return "\n".join(lines) + "\n"
+
+def get_metrics():
+    """获取全局性能指标"""
+    global METRICS
+    if METRICS is None:
+        with METRICS_LOCK:
+            if METRICS is None:
+                METRICS = Metrics()
+    return METRICS
+
+METRICS = None
+METRICS_LOCK = threading.Lock()
+
+def export_metrics(json_path=None, prometheus_path=None):
+    """把性能指标写入 JSON 报告和 Prometheus 文本文件，先写临时文件再替换"""
+    metrics = get_metrics()
+    for path, render in ((json_path, lambda: json.dumps(metrics.report(), ensure_ascii=False, indent=2)),
+                         (prometheus_path, metrics.prometheus)):
+        if not path:
+            continue
+        try:
+            tmp_path = path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(render())
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"写入性能指标失败: {str(e)}")
+
+class HttpClient:
+    """共享的HTTP客户端，所有下载线程复用同一个连接池"""
+    def __init__(self, pool_maxsize, pool_connections=10):
+        # 禁用SSL证书验证警告
+        requests.packages.urllib3.disable_warnings()
+        self.session = requests.Session()
+        self.adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=True
+        )
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+
+    def request(self, method, url, limiter=None, **kwargs):
+        """发送请求；指定 limiter 时先从对应令牌桶取令牌，并根据响应状态调整速率"""
+        kwargs.setdefault("timeout", CONFIG["request_timeout"])
+        metrics = get_metrics()
+        host = urlparse(url).netloc
+        bucket = get_rate_limiter(limiter) if limiter else None
+        if bucket:
+            with metrics.timer("rate_limit_wait_seconds", limiter=limiter):
+                bucket.acquire()
+        start_time = time.perf_counter()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except Exception:
+            metrics.inc("http_errors_total", host=host)
+            raise
+        finally:
+            metrics.observe("http_request_seconds", time.perf_counter() - start_time, host=host)
+        if bucket:
+            bucket.feedback(response.status_code)
+        metrics.inc("http_responses_total", host=host, status=response.status_code)
+        if not kwargs.get("stream"):
+            # 流式读取的响应由调用方按实际读取的字节数计数
+            metrics.inc("http_bytes_in_total", len(response.content), host=host)
+        data = kwargs.get("data")
+        if data:
+            metrics.inc("http_bytes_out_total", len(data), host=host)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def stats(self):
+        """连接复用统计：每个主机的请求数、新建连接数和复用次数"""
+        managers = [self.adapter.poolmanager] + list(self.adapter.proxy_manager.values())
+        hosts = {}
+        for manager in managers:
+            for pool_key in list(manager.pools.keys()):
+                pool = manager.pools.get(pool_key)
+                if pool is None:
+                    continue
+                host = hosts.setdefault(pool.host, {"requests": 0, "connections": 0})
+                host["requests"] += pool.num_requests
+                host["connections"] += pool.num_connections
+        for host in hosts.values():
+            host["reused"] = max(0, host["requests"] - host["connections"])
+        total = {
+            "requests": sum(h["requests"] for h in hosts.values()),
+            "connections": sum(h["connections"] for h in hosts.values()),
+            "reused": sum(h["reused"] for h in hosts.values())
+        }
+        return {"total": total, "hosts": hosts}
+
+    def close(self):
+        self.session.close()
+
+def get_http_client():
+    """获取全局HTTP客户端，连接池大小与 max_workers 一致"""
+    global HTTP_CLIENT
+    if HTTP_CLIENT is None:
+        with HTTP_CLIENT_LOCK:
+            if HTTP_CLIENT is None:
+                HTTP_CLIENT = HttpClient(
+                    CONFIG["pool_maxsize"] or CONFIG["max_workers"],
+                    CONFIG["pool_connections"]
+                )
+    return HTTP_CLIENT
+
+HTTP_CLIENT = None
+HTTP_CLIENT_LOCK = threading.Lock()
+
 class FqVariable:
     def __init__(self, install_id, server_device_id, aid, update_version_code):
         self.install_id = install_id
@@ -68,33 +492,64 @@ class FqVariable:
         self.aid = aid
         self.update_version_code = update_version_code
 
+    @classmethod
+    def from_config(cls, identity):
+        """由配置中的一个设备身份创建，aid 和 update_version_code 缺省时取 official_api 中的值"""
+        defaults = CONFIG["official_api"]
+        return cls(
+            str(identity["install_id"]),
+            str(identity["server_device_id"]),
+            str(identity.get("aid", defaults["aid"])),
+            str(identity.get("update_version_code", defaults["update_version_code"]))
+        )
+
+    @property
+    def limiter(self):
+        """每个身份单独的限速器名称"""
+        return f"official:{self.install_id}"
+
 class FqReq:
-    def __init__(self, var):
+    def __init__(self, var, http=None):
         self.var = var
-        self.session = requests.Session()
+        self.http = http or get_http_client()
 
-    def batch_get(self, item_ids, download=False):
+    def batch_get_request(self, item_ids, download=False):
         headers = {
             "Cookie": f"install_id={self.var.install_id}"
         }
-        url = "https://api5-normal-sinfonlineb.fqnovel.com/reading/reader/batch_full/v"
+        url = f"{CONFIG['official_api']['base_url']}/reading/reader/batch_full/v"
         params = {
             "item_ids": item_ids,
             "req_type": "0" if download else "1",
             "aid": self.var.aid,
             "update_version_code": self.var.update_version_code
         }
-        response = self.session.get(url, headers=headers, params=params, verify=False)
-        response.raise_for_status()
-        ret_arr = response.json()
+        return url, headers, params
+
+    def batch_get(self, item_ids, download=False):
+        url, headers, params = self.batch_get_request(item_ids, download)
+        with get_metrics().timer("batch_get_seconds"):
+            response = self.http.get(url, headers=headers, params=params, verify=False, limiter=self.var.limiter)
+            response.raise_for_status()
+            ret_arr = self.check_batch_response(response.json())
+        get_metrics().inc("batch_get_chapters_total", item_ids.count(",") + 1)
         return ret_arr
 
-    def get_register_key(self):
+    @staticmethod
+    def check_batch_response(ret_arr):
+        """身份被拒绝时接口仍返回 HTTP 200，只能从返回码判断；抛出异常才会计入身份池的失败次数。
+        code 为 0 但没有数据时不是身份的问题，按章节缺失处理"""
+        if ret_arr.get("code") != 0:
+            raise ValueError(f"batch_full 请求被拒绝: code={ret_arr.get('code')} {ret_arr.get('message', '')}".rstrip())
+        ret_arr["data"] = ret_arr.get("data") or {}
+        return ret_arr
+
+    def register_key_request(self):
         headers = {
             "Cookie": f"install_id={self.var.install_id}",
             "Content-Type": "application/json"
         }
-        url = "https://api5-normal-sinfonlineb.fqnovel.com/reading/crypt/registerkey"
+        url = f"{CONFIG['official_api']['base_url']}/reading/crypt/registerkey"
         params = {
             "aid": self.var.aid
         }
@@ -103,37 +558,99 @@ class FqReq:
             "content": crypto.new_register_key_content(self.var.server_device_id, "0"),
             "keyver": 1
         }).encode('utf-8')
-        response = self.session.post(url, headers=headers, params=params, data=payload, verify=False)
-        response.raise_for_status()
-        ret_arr = response.json()
+        return url, headers, params, payload, crypto
+
+    @staticmethod
+    def parse_register_key(ret_arr, crypto):
         key_str = ret_arr['data']['key']
         byte_key = crypto.decrypt(base64.b64decode(key_str))
         return byte_key.hex()
 
+    def get_register_key(self):
+        url, headers, params, payload, crypto = self.register_key_request()
+        with get_metrics().timer("register_key_seconds"):
+            response = self.http.post(url, headers=headers, params=params, data=payload, verify=False, limiter=self.var.limiter)
+            response.raise_for_status()
+            return self.parse_register_key(response.json(), crypto)
+
     def get_decrypt_contents(self, res_arr):
-        key = self.get_register_key()
-        crypto = FqCrypto(key)
+        key_cache = get_key_cache()
+        crypto = key_cache.get_crypto(self)
+        with get_metrics().timer("decrypt_seconds"):
+            try:
+                self.decrypt_items(crypto, res_arr)
+            except Exception:
+                # 密钥可能已失效，刷新后重试一次
+                get_metrics().inc("retries_total", kind="key_refresh")
+                key_cache.invalidate(self.var, crypto)
+                self.decrypt_items(key_cache.get_crypto(self), res_arr)
+        return res_arr
+
+    @staticmethod
+    def decrypt_items(crypto, res_arr):
         for item_id, content in res_arr['data'].items():
             byte_content = crypto.decrypt(base64.b64decode(content['content']))
             s = gzip.decompress(byte_content).decode('utf-8')
             res_arr['data'][item_id]['originContent'] = s
-        return res_arr
-
-    def __del__(self):
-        self.session.close()
 
 # 全局配置
 CONFIG = {
     "max_workers": 3,
+    "book_workers": 2,
+    "batch_size": 20,
+    "engine": "thread",
+    "async_concurrency": 100,
+    "decode_workers": 0,
+    "decode_queue_size": 16,
     "max_retries": 3,
+    "retry_max_attempts": 8,
+    "retry_base_delay": 1.0,
+    "retry_max_delay": 30.0,
     "request_timeout": 15,
+    "reorder_buffer": 200,
+    "cache_file": os.path.join(os.path.expanduser("~"), ".tomato_novel_downloader", "chapters.db"),
+    "cache_max_bytes": 512 * 1024 * 1024,
+    "pool_connections": 10,
+    "pool_maxsize": None,
     "status_file": "chapter.json",
-    "request_rate_limit": 0.4,
+    "status_fsync_batch": 20,
+    "status_fsync_interval": 2.0,
+    "status_compact_records": 1000,
+    "rate_limits": {
+        "official": {"rate": 2.5, "burst": 5},
+        "fanqienovel.com": {"rate": 2, "burst": 4},
+        "default": {"rate": 1.5, "burst": 3}
+    },
+    "endpoint_ewma_alpha": 0.3,
+    "circuit_failure_threshold": 3,
+    "circuit_open_seconds": 30,
+    "circuit_max_open_seconds": 300,
+    "hedge_percentile": 0.9,
+    "hedge_min_samples": 10,
+    "fake_useragent": False,
+    "book_info_ttl": 7 * 24 * 3600,
+    "export_formats": [],
+    "export_volume_size": 100,
+    "queue_lease_seconds": 120,
+    "queue_poll_interval": 1.0,
+    "book_format": "txt",
+    "book_compression": "auto",
+    "book_compression_level": None,
+    "metrics_file": None,
+    "metrics_prometheus_file": None,
+    "key_ttl": 3600,
+    "key_cache_file": None,
+    "web_base_url": "https://fanqienovel.com",
     "api_endpoints": [
         "https://api.cenguigui.cn/api/tomato/content.php?item_id={chapter_id}",
         "https://lsjk.zyii.xyz:3666/content?item_id={chapter_id}"
     ],
+    "identities": [],
+    "identity_selection": "least_loaded",
+    "identity_failure_threshold": 3,
+    "identity_bench_seconds": 60,
     "official_api": {
+        "base_url": "https://api5-normal-sinfonlineb.fqnovel.com",
         "install_id": "4427064614339001",
         "server_device_id": "4427064614334905",
         "aid": "1967",
@@ -141,187 +658,997 @@ CONFIG = {
     }
 }
 
+CONFIG_FILE = os.path.join(os.path.expanduser("~"), ".tomato_novel_downloader", "config.json")
+
+def load_config(path=None):
+    """读取 JSON 配置文件并合并到 CONFIG，嵌套的配置（如 rate_limits）按键合并。
+    每个文件只解析一次；path 为空时读取默认位置，默认文件不存在时不做任何事。
+    需要在首次下载之前调用，已经创建的连接池、缓存等不会随之改变"""
+    config_path = os.path.abspath(os.path.expanduser(path or CONFIG_FILE))
+    with LOADED_CONFIGS_LOCK:
+        if config_path in LOADED_CONFIGS:
+            return LOADED_CONFIGS[config_path]
+        overrides = {}
+        if os.path.exists(config_path):
+            with open(config_path, 'r', encoding='utf-8') as f:
+                overrides = json.load(f)
+            for key, value in overrides.items():
+                if key not in CONFIG:
+                    print(f"配置文件中有未知的配置项: {key}")
+                if isinstance(value, dict) and isinstance(CONFIG.get(key), dict):
+                    CONFIG[key].update(value)
+                else:
+                    CONFIG[key] = value
+        elif path:
+            raise FileNotFoundError(f"配置文件不存在: {path}")
+        LOADED_CONFIGS[config_path] = overrides
+        return overrides
+
+LOADED_CONFIGS = {}
+LOADED_CONFIGS_LOCK = threading.Lock()
+
+# 内置的离线 User-Agent 列表，不依赖 fake_useragent 的浏览器数据库
+USER_AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36 Edg/124.0.0.0",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36 Edg/125.0.0.0",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36 Edg/126.0.0.0",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36 Edg/126.0.0.0"
+]
+
+def get_user_agents():
+    """获取 User-Agent 池：内置列表，启用 fake_useragent 时再补充一批，只加载一次"""
+    global USER_AGENT_POOL
+    if USER_AGENT_POOL is None:
+        with USER_AGENT_POOL_LOCK:
+            if USER_AGENT_POOL is None:
+                agents = list(USER_AGENTS)
+                if CONFIG["fake_useragent"]:
+                    try:
+                        from fake_useragent import UserAgent
+                        ua = UserAgent()
+                        agents.extend({random.choice([ua.chrome, ua.edge]) for _ in range(20)} - set(agents))
+                    except Exception as e:
+                        print(f"加载 fake_useragent 失败，使用内置 User-Agent 列表: {str(e)}")
+                USER_AGENT_POOL = agents
+    return USER_AGENT_POOL
+
+USER_AGENT_POOL = None
+USER_AGENT_POOL_LOCK = threading.Lock()
+
 def get_headers() -> Dict[str, str]:
-    """生成随机请求头"""
-    browsers = ['chrome', 'edge']
-    browser = random.choice(browsers)
-    
-    if browser == 'chrome':
-        user_agent = UserAgent().chrome
-    else:
-        user_agent = UserAgent().edge
-    
+    """生成随机请求头，User-Agent 从预先加载的池中轮换"""
     return {
-        "User-Agent": user_agent,
+        "User-Agent": random.choice(get_user_agents()),
         "Accept": "application/json, text/javascript, */*; q=0.01",
         "Accept-Language": "zh-CN,zh;q=0.9,en-US;q=0.8,en;q=0.7",
         "Referer": "https://fanqienovel.com/",
         "X-Requested-With": "XMLHttpRequest",
     }
 
-def down_text(chapter_id, headers, book_id=None):
-    """下载章节内容"""
-    try:
-        if hasattr(down_text, "last_request_time"):
-            elapsed = time.time() - down_text.last_request_time
-            if elapsed < CONFIG["request_rate_limit"]:
-                time.sleep(CONFIG["request_rate_limit"] - elapsed)
-        down_text.last_request_time = time.time()
-
-        var = FqVariable(
-            CONFIG["official_api"]["install_id"],
-            CONFIG["official_api"]["server_device_id"],
-            CONFIG["official_api"]["aid"],
-            CONFIG["official_api"]["update_version_code"]
-        )
-        client = FqReq(var)
-        batch_res_arr = client.batch_get(chapter_id, False)
-        res = client.get_decrypt_contents(batch_res_arr)
+class FqIdentityPool:
+    """官方API设备身份池：每个身份有自己的密钥、连接池和令牌桶，请求按最少占用或轮询分配，
+    连续失败的身份暂停使用一段时间"""
+    def __init__(self, identities, selection="least_loaded", failure_threshold=3, bench_seconds=60):
+        self.clients = []
+        for identity in identities:
+            http = HttpClient(CONFIG["pool_maxsize"] or CONFIG["max_workers"], CONFIG["pool_connections"])
+            self.clients.append(FqReq(FqVariable.from_config(identity), http))
+        if not self.clients:
+            raise ValueError("没有可用的官方API设备身份")
+        self.selection = selection
+        self.failure_threshold = failure_threshold
+        self.bench_seconds = bench_seconds
+        self.health = {
+            client.var.install_id: {"inflight": 0, "requests": 0, "errors": 0, "failures": 0, "benched_until": 0.0, "benched": 0}
+            for client in self.clients
+        }
+        self.next = 0
+        self.lock = threading.Lock()
 
-        for k, v in res['data'].items():
-            content = v['originContent']
-            chapter_title = v['title']
-            
-            # 处理标题
-            if chapter_title and re.match(r'^第[0-9]+章', chapter_title):
-                chapter_title = re.sub(r'^第[0-9]+章\s*', '', chapter_title)
-            
-            # 处理内容
-            content = re.sub(r'<header>.*?</header>', '', content, flags=re.DOTALL)
-            content = re.sub(r'<footer>.*?</footer>', '', content, flags=re.DOTALL)
-            content = re.sub(r'</?article>', '', content)
-            content = re.sub(r'<p[^>]*>', '\n    ', content)
-            content = re.sub(r'</p>', '', content)
-            content = re.sub(r'<[^>]+>', '', content)
-            content = re.sub(r'\\u003c|\\u003e', '', content)
-            
-            # 处理重复章节标题
-            if chapter_title and content.startswith(chapter_title):
-                content = content[len(chapter_title):].lstrip()
+    def acquire(self):
+        """选出一个身份；全部暂停中时选最早恢复的"""
+        with self.lock:
+            now = time.monotonic()
+            available = [c for c in self.clients if self.health[c.var.install_id]["benched_until"] <= now]
+            if not available:
+                available = [min(self.clients, key=lambda c: self.health[c.var.install_id]["benched_until"])]
+            if self.selection == "round_robin":
+                while True:
+                    client = self.clients[self.next % len(self.clients)]
+                    self.next += 1
+                    if client in available:
+                        break
+            else:
+                client = min(available, key=lambda c: (self.health[c.var.install_id]["inflight"], self.health[c.var.install_id]["requests"]))
+            health = self.health[client.var.install_id]
+            health["inflight"] += 1
+            health["requests"] += 1
+            return client
 
-            content = re.sub(r'\n{3,}', '\n\n', content).strip()
+    def release(self, client, ok):
+        """归还身份并记录结果；ok 为 None 表示请求被取消，不计入结果"""
+        with self.lock:
+            health = self.health[client.var.install_id]
+            health["inflight"] -= 1
+            if ok is None:
+                return
+            if ok:
+                health["failures"] = 0
+                return
+            health["errors"] += 1
+            health["failures"] += 1
+            if health["failures"] < self.failure_threshold:
+                return
+            health["failures"] = 0
+            health["benched"] += 1
+            health["benched_until"] = time.monotonic() + self.bench_seconds
+        print(f"设备身份 {client.var.install_id} 连续失败 {self.failure_threshold} 次，暂停使用 {self.bench_seconds} 秒")
 
-            lines = [line.strip() for line in content.split('\n') if line.strip()]
-            formatted_content = '\n'.join(['    ' + line for line in lines])
-            
-            return chapter_title, formatted_content
-            
-    except Exception as e:
-        print(f"官方API请求失败，尝试备用API: {str(e)}")
-    
-    # 备用API
-    content = ""
-    chapter_title = ""
-    
-    # 初始化API端点状态
-    if not hasattr(down_text, "api_status"):
-        down_text.api_status = {endpoint: {
-            "last_response_time": float('inf'),
-            "error_count": 0,
-            "last_try_time": 0
-        } for endpoint in CONFIG["api_endpoints"]}
-    
-    # 顺序尝试API
-    for api_endpoint in CONFIG["api_endpoints"]:
-        current_endpoint = api_endpoint.format(chapter_id=chapter_id)
-        down_text.api_status[api_endpoint]["last_try_time"] = time.time()
-        
+    @contextmanager
+    def lease(self):
+        """借用一个身份，块内抛出异常时计为失败"""
+        client = self.acquire()
         try:
-            # 随机延迟
-            time.sleep(random.uniform(0.5, 1))
-            
-            start_time = time.time()
-            response = requests.get(
-                current_endpoint, 
-                headers=headers, 
-                timeout=CONFIG["request_timeout"],
-                verify=False
-            )
-            response_time = time.time() - start_time
-            
-            # 更新API状态
-            down_text.api_status[api_endpoint].update({
-                "last_response_time": response_time,
-                "error_count": max(0, down_text.api_status[api_endpoint]["error_count"] - 1)
-            })
-            
-            data = response.json()
-            content = data.get("data", {}).get("content", "")
-            chapter_title = data.get("data", {}).get("title", "")
-            
-            if "api.cenguigui.cn" in api_endpoint:
-                if data.get("code") == 200 and content:
-                    # 内容处理
-                    content = re.sub(r'<header>.*?</header>', '', content, flags=re.DOTALL)
-                    content = re.sub(r'<footer>.*?</footer>', '', content, flags=re.DOTALL)
-                    content = re.sub(r'</?article>', '', content)
-                    content = re.sub(r'<p idx="\d+">', '\n', content)
-                    content = re.sub(r'</p>', '\n', content)
-                    content = re.sub(r'<[^>]+>', '', content)
-                    content = re.sub(r'\\u003c|\\u003e', '', content)
-                    
-                    # 去掉重复标题
-                    if chapter_title and content.startswith(chapter_title):
-                        content = content[len(chapter_title):].lstrip()
-                    
-                    content = re.sub(r'\n{2,}', '\n', content).strip()
-                    formatted_content = '\n'.join(['    ' + line if line.strip() else line for line in content.split('\n')])
-                    return chapter_title, formatted_content
-
-            elif "lsjk.zyii.xyz" in api_endpoint and content:
-                # 提取内容
-                paragraphs = re.findall(r'<p idx="\d+">(.*?)</p>', content)
-                cleaned_content = "\n".join(p.strip() for p in paragraphs if p.strip())
-                formatted_content = '\n'.join('    ' + line if line.strip() else line 
-                                              for line in cleaned_content.split('\n'))
-                return chapter_title, formatted_content
-
-            print(f"API端点 {api_endpoint} 返回空内容，继续尝试下一个API...")
-            down_text.api_status[api_endpoint]["error_count"] += 1
+            yield client
+        except Exception:
+            self.release(client, False)
+            raise
+        except BaseException:
+            # 对冲请求被取消或用户中断
+            self.release(client, None)
+            raise
+        self.release(client, True)
+
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            return {
+                install_id: {
+                    "requests": health["requests"],
+                    "errors": health["errors"],
+                    "inflight": health["inflight"],
+                    "benched": health["benched"],
+                    "active": health["benched_until"] <= now
+                }
+                for install_id, health in self.health.items()
+            }
+
+def get_identity_pool():
+    """获取全局设备身份池；没有配置 identities 时只有 official_api 中的一个身份"""
+    global IDENTITY_POOL
+    if IDENTITY_POOL is None:
+        with IDENTITY_POOL_LOCK:
+            if IDENTITY_POOL is None:
+                IDENTITY_POOL = FqIdentityPool(
+                    CONFIG["identities"] or [CONFIG["official_api"]],
+                    CONFIG["identity_selection"],
+                    CONFIG["identity_failure_threshold"],
+                    CONFIG["identity_bench_seconds"]
+                )
+    return IDENTITY_POOL
+
+IDENTITY_POOL = None
+IDENTITY_POOL_LOCK = threading.Lock()
+
+# 章节内容清洗
+CHAPTER_NUMBER_RE = re.compile(r'^第[0-9]+章\s*')
+# 去掉页眉、页脚、除 <p> 以外的所有标签以及转义残留
+CONTENT_STRIP_RE = re.compile(r'<header>.*?</header>|<footer>.*?</footer>|<(?!/?p\b)[^>]+>|\\u003c|\\u003e', re.DOTALL)
+# 按 <p> 标签切分段落，捕获组区分开始标签（''）和结束标签（'/'）
+PARAGRAPH_SPLIT_RE = re.compile(r'<(/?)p\b[^>]*>')
+
+def clean_chapter_title(chapter_title):
+    """去掉标题开头的“第N章”"""
+    if chapter_title:
+        return CHAPTER_NUMBER_RE.sub('', chapter_title, count=1)
+    return chapter_title
+
+def sanitize_content(content, chapter_title=None, paragraphs_only=False):
+    """把章节HTML转换为每段缩进四个空格的纯文本，官方API和各备用API共用
+
+    paragraphs_only 为 True 时只保留 <p> 标签内的文本。
+    """
+    parts = PARAGRAPH_SPLIT_RE.split(CONTENT_STRIP_RE.sub('', content))
+    if paragraphs_only:
+        segments = [seg for tag, seg in zip(parts[1::2], parts[2::2]) if not tag]
+    else:
+        segments = parts[0::2]
+        # 去掉段落之前重复出现的章节标题
+        if chapter_title and segments[0].startswith(chapter_title):
+            segments[0] = segments[0][len(chapter_title):]
+
+    lines = []
+    for seg in segments:
+        if '\n' in seg:
+            lines.extend(line for line in (part.strip() for part in seg.split('\n')) if line)
+        else:
+            seg = seg.strip()
+            if seg:
+                lines.append(seg)
+    return '\n'.join(['    ' + line for line in lines])
+
+def process_official_content(chapter_title, content):
+    """处理官方API返回的章节标题和内容"""
+    chapter_title = clean_chapter_title(chapter_title)
+    return chapter_title, sanitize_content(content, chapter_title)
+
+def decode_official_batch(key, data, chapter_ids):
+    """解密、解压并清洗 batch_full 返回的章节，返回 {章节ID: (标题, 内容)}
 
+    只依赖参数，可以放到子进程中执行。
+    """
+    crypto = FqCrypto(key)
+    results = {}
+    wanted = set(chapter_ids)
+    decrypt_time = sanitize_time = 0.0
+    bytes_in = bytes_out = 0
+    for item_id, v in data.items():
+        item_id = str(item_id)
+        if item_id not in wanted or not v.get('content'):
+            continue
+        start_time = time.perf_counter()
+        byte_content = crypto.decrypt(base64.b64decode(v['content']))
+        origin_content = gzip.decompress(byte_content).decode('utf-8')
+        decoded_time = time.perf_counter()
+        chapter_title, content = process_official_content(v.get('title'), origin_content)
+        decrypt_time += decoded_time - start_time
+        sanitize_time += time.perf_counter() - decoded_time
+        bytes_in += len(origin_content)
+        if content:
+            bytes_out += len(content)
+            results[item_id] = (chapter_title, content)
+
+    # 在解密进程池中运行时这些指标留在子进程里，主进程只记录流水线的整体耗时
+    metrics = get_metrics()
+    metrics.observe("decrypt_seconds", decrypt_time)
+    metrics.observe("sanitize_seconds", sanitize_time)
+    metrics.inc("sanitize_chars_in_total", bytes_in)
+    metrics.inc("sanitize_chars_out_total", bytes_out)
+    return results
+
+def fetch_official_batch(chapter_ids):
+    """只做网络部分：用身份池中的一个身份请求 batch_full 并取得解密密钥，返回 (客户端, 解密器, 原始数据)"""
+    with get_identity_pool().lease() as client:
+        res = client.batch_get(",".join(chapter_ids), False)
+        crypto = get_key_cache().get_crypto(client)
+    return client, crypto, res.get('data') or {}
+
+def get_decode_pool():
+    """获取解密/清洗进程池，decode_workers 为 0 时返回 None"""
+    global DECODE_POOL
+    if DECODE_POOL is None and CONFIG["decode_workers"] > 0:
+        with DECODE_POOL_LOCK:
+            if DECODE_POOL is None:
+                from concurrent.futures import ProcessPoolExecutor
+                DECODE_POOL = ProcessPoolExecutor(max_workers=CONFIG["decode_workers"])
+                atexit.register(DECODE_POOL.shutdown)
+    return DECODE_POOL
+
+def reset_decode_pool(pool):
+    """进程池损坏（子进程被结束）后丢弃它，下次 get_decode_pool 时重新创建"""
+    global DECODE_POOL
+    with DECODE_POOL_LOCK:
+        if DECODE_POOL is pool:
+            DECODE_POOL = None
+    pool.shutdown(wait=False)
+
+DECODE_POOL = None
+DECODE_POOL_LOCK = threading.Lock()
+
+class DecodePipeline:
+    """解密、解压、清洗流水线：下载线程只把原始 batch_full 数据放进有界队列，
+    由进程池完成CPU密集的工作，结果按提交顺序交给 on_result(任务, 结果, 异常)"""
+    def __init__(self, on_result, queue_size=None):
+        self.on_result = on_result
+        self.pool = get_decode_pool()
+        self.max_inflight = CONFIG["decode_workers"] * 2
+        self.queue = queue.Queue(maxsize=queue_size or CONFIG["decode_queue_size"])
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, job, key, data, chapter_ids):
+        """放入一批原始数据，队列已满时阻塞下载线程"""
+        self.queue.put((job, key, data, chapter_ids))
+
+    def run(self):
+        pending = deque()
+        while True:
+            # 队列暂时为空或进程池已满时，先按顺序交付最早提交的结果
+            if pending and (len(pending) >= self.max_inflight or self.queue.empty()):
+                self.deliver(*pending.popleft())
+                continue
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            job, key, data, chapter_ids = item
+            try:
+                future = self.pool.submit(decode_official_batch, key, data, chapter_ids)
+            except Exception as e:
+                # 提交失败时同样要交回结果，否则这批章节会一直处于下载中
+                while pending:
+                    self.deliver(*pending.popleft())
+                self.fail(job, e)
+                continue
+            pending.append((job, future, time.perf_counter()))
+        while pending:
+            self.deliver(*pending.popleft())
+
+    def deliver(self, job, future, submitted):
+        try:
+            results = future.result()
+            get_metrics().observe("decode_pipeline_seconds", time.perf_counter() - submitted)
+            self.on_result(job, results, None)
         except Exception as e:
-            print(f"API端点 {api_endpoint} 请求失败: {str(e)}")
-            down_text.api_status[api_endpoint]["error_count"] += 1
-            time.sleep(3)
+            self.fail(job, e)
+            return
+        self.queue.task_done()
+
+    def fail(self, job, error):
+        """交回失败的任务；进程池已损坏时换一个新的进程池"""
+        from concurrent.futures.process import BrokenProcessPool
+        try:
+            if isinstance(error, BrokenProcessPool) and self.pool is not None:
+                reset_decode_pool(self.pool)
+                self.pool = get_decode_pool()
+            self.on_result(job, {}, error)
+        finally:
+            self.queue.task_done()
+
+    def join(self):
+        """等待已放入的数据全部处理完"""
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+def down_text_batch(chapter_ids, headers, book_id=None, batch_size=None, attempted=None):
+    """批量下载章节内容，返回 {章节ID: (标题, 内容)}。
+    attempted 为集合时，加入确实向某个接口发出过请求的章节ID（所有接口都在熔断中时没有请求发出）"""
+    results = {}
+    if batch_size is None:
+        # 先从本地缓存读取
+        results.update(cached_results(chapter_ids))
+        chapter_ids = [cid for cid in chapter_ids if cid not in results]
+        batch_size = len(chapter_ids)
+    if not chapter_ids:
+        return results
+
+    # 单个章节直接走完整的下载流程（包含备用API）
+    if len(chapter_ids) == 1 or batch_size <= 1:
+        for chapter_id in chapter_ids:
+            chapter_title, content = down_text(chapter_id, headers, book_id, attempted)
+            if content:
+                results[chapter_id] = (chapter_title, content)
+        return results
+
+    scheduler = get_endpoint_scheduler()
+    for start in range(0, len(chapter_ids), batch_size):
+        batch = chapter_ids[start:start + batch_size]
+        # 官方API熔断中时不再拆分批次，直接逐章走调度器选出的接口
+        available = scheduler.acquire(OFFICIAL_ENDPOINT)
+        if available:
+            if attempted is not None:
+                attempted.update(batch)
+            try:
+                client, crypto, data = fetch_official_batch(batch)
+            except Exception as e:
+                scheduler.record(OFFICIAL_ENDPOINT, False)
+                print(f"批量请求失败（{len(batch)}个章节），将拆分重试: {str(e)}")
+            else:
+                batch_results = {}
+                try:
+                    try:
+                        batch_results = decode_official_batch(crypto.key.hex(), data, batch)
+                    except Exception:
+                        # 密钥可能已失效，刷新后重试一次
+                        get_key_cache().invalidate(client.var, crypto)
+                        crypto = get_key_cache().get_crypto(client)
+                        batch_results = decode_official_batch(crypto.key.hex(), data, batch)
+                    cache_results(batch_results)
+                    results.update(batch_results)
+                except Exception as e:
+                    print(f"批量解密失败（{len(batch)}个章节），将拆分重试: {str(e)}")
+                # 至少拿到一个请求的章节才算成功，否则一直返回空数据的接口会被当作正常而不会熔断
+                scheduler.record(OFFICIAL_ENDPOINT, bool(batch_results))
+
+        # 响应中缺失的章节拆分成更小的批次重试
+        missing = [cid for cid in batch if cid not in results]
+        if missing:
+            get_metrics().inc("retries_total", len(missing), kind="batch_split")
+            results.update(down_text_batch(missing, headers, book_id, len(missing) // 2 if available else 1, attempted))
+
+    return results
+
+OFFICIAL_ENDPOINT = "official"
+
+class EndpointScheduler:
+    """章节接口调度器：按 EWMA 延迟和成功率给官方API和备用API排序；
+    连续失败的接口熔断一段时间，冷却后只放行一个探测请求（半开），探测成功才恢复"""
+    def __init__(self, endpoints, alpha=0.3, failure_threshold=3, open_seconds=30, max_open_seconds=300,
+                 hedge_percentile=0.9, hedge_min_samples=10, window=50):
+        self.endpoints = list(endpoints)
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.lock = threading.Lock()
+        self.health = {endpoint: {
+            "latency": None,
+            "success": 1.0,
+            "samples": deque(maxlen=window),
+            "failures": 0,
+            "state": "closed",
+            "open_until": 0.0,
+            "open_seconds": open_seconds,
+            "probing": False,
+            "requests": 0,
+            "errors": 0,
+            "hedged": 0
+        } for endpoint in self.endpoints}
+
+    @staticmethod
+    def score(health):
+        """预期耗时：平均延迟除以成功率；还没有延迟数据的接口优先尝试一次"""
+        if health["latency"] is None:
+            return 0.0
+        return health["latency"] / max(health["success"], 0.05)
+
+    def ranked(self):
+        """当前可以请求的接口，按预期耗时从小到大排序（得分相同时保持配置顺序）"""
+        now = time.monotonic()
+        with self.lock:
+            available = [
+                endpoint for endpoint in self.endpoints
+                if self.health[endpoint]["state"] == "closed"
+                or (self.health[endpoint]["open_until"] <= now and not self.health[endpoint]["probing"])
+            ]
+            return sorted(available, key=lambda endpoint: self.score(self.health[endpoint]))
+
+    def acquire(self, endpoint):
+        """请求前调用：熔断中返回 False；冷却结束后只放行一个探测请求"""
+        with self.lock:
+            health = self.health[endpoint]
+            if health["state"] == "closed":
+                return True
+            if health["state"] == "open" and health["open_until"] <= time.monotonic():
+                health["state"] = "half_open"
+            if health["state"] == "half_open" and not health["probing"]:
+                health["probing"] = True
+                return True
+            return False
+
+    def retry_after(self):
+        """所有接口都在熔断中时返回需要等待的秒数，有可用接口时返回 0"""
+        with self.lock:
+            now = time.monotonic()
+            wait_time = None
+            for health in self.health.values():
+                if health["state"] == "closed" or (not health["probing"] and health["open_until"] <= now):
+                    return 0.0
+                # 正在探测的接口很快会有结果
+                remaining = 0.1 if health["probing"] else health["open_until"] - now
+                wait_time = remaining if wait_time is None else min(wait_time, remaining)
+            return wait_time or 0.0
+
+    def release(self, endpoint):
+        """请求被取消、没有结果时释放探测名额"""
+        with self.lock:
+            self.health[endpoint]["probing"] = False
+
+    def record(self, endpoint, ok, latency=None):
+        """记录一次请求的结果；latency 只记录单章节请求的耗时"""
+        with self.lock:
+            health = self.health[endpoint]
+            health["requests"] += 1
+            health["success"] += self.alpha * ((1.0 if ok else 0.0) - health["success"])
+            if latency is not None:
+                if health["latency"] is None:
+                    health["latency"] = latency
+                else:
+                    health["latency"] += self.alpha * (latency - health["latency"])
+                health["samples"].append(latency)
+            health["probing"] = False
+            if ok:
+                health["failures"] = 0
+                health["state"] = "closed"
+                health["open_seconds"] = self.open_seconds
+                return
+            health["errors"] += 1
+            health["failures"] += 1
+            if health["state"] == "half_open":
+                # 探测失败，熔断时间加倍
+                health["open_seconds"] = min(self.max_open_seconds, health["open_seconds"] * 2)
+                self.trip(endpoint, health)
+            elif health["state"] == "closed" and health["failures"] >= self.failure_threshold:
+                self.trip(endpoint, health)
+
+    def trip(self, endpoint, health):
+        health["state"] = "open"
+        health["open_until"] = time.monotonic() + health["open_seconds"]
+        print(f"接口 {endpoint_label(endpoint)} 连续失败 {health['failures']} 次，暂停使用 {health['open_seconds']} 秒")
+
+    def hedge_delay(self, endpoint):
+        """接口耗时超过其延迟分位数仍未返回时，应同时请求下一个接口；样本不足或未启用时返回 None"""
+        if endpoint is None or self.hedge_percentile is None:
+            return None
+        with self.lock:
+            samples = sorted(self.health[endpoint]["samples"])
+        if len(samples) < self.hedge_min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * self.hedge_percentile))]
+
+    def hedged(self, endpoint):
+        with self.lock:
+            self.health[endpoint]["hedged"] += 1
+        get_metrics().inc("retries_total", kind="hedge")
+
+    def stats(self):
+        with self.lock:
+            return {endpoint_label(endpoint): {
+                "state": health["state"],
+                "latency": None if health["latency"] is None else round(health["latency"], 3),
+                "success": round(health["success"], 3),
+                "requests": health["requests"],
+                "errors": health["errors"],
+                "hedged": health["hedged"]
+            } for endpoint, health in self.health.items()}
+
+def endpoint_label(endpoint):
+    return endpoint if endpoint == OFFICIAL_ENDPOINT else urlparse(endpoint).netloc
+
+def get_endpoint_scheduler():
+    """获取全局接口调度器，官方API与备用API一起参与排序"""
+    global ENDPOINT_SCHEDULER
+    if ENDPOINT_SCHEDULER is None:
+        with ENDPOINT_SCHEDULER_LOCK:
+            if ENDPOINT_SCHEDULER is None:
+                ENDPOINT_SCHEDULER = EndpointScheduler(
+                    [OFFICIAL_ENDPOINT] + CONFIG["api_endpoints"],
+                    alpha=CONFIG["endpoint_ewma_alpha"],
+                    failure_threshold=CONFIG["circuit_failure_threshold"],
+                    open_seconds=CONFIG["circuit_open_seconds"],
+                    max_open_seconds=CONFIG["circuit_max_open_seconds"],
+                    hedge_percentile=CONFIG["hedge_percentile"],
+                    hedge_min_samples=CONFIG["hedge_min_samples"]
+                )
+    return ENDPOINT_SCHEDULER
+
+ENDPOINT_SCHEDULER = None
+ENDPOINT_SCHEDULER_LOCK = threading.Lock()
+
+def get_hedge_pool():
+    """单章节请求使用的线程池，慢请求可以和对冲请求同时进行"""
+    global HEDGE_POOL
+    if HEDGE_POOL is None:
+        with HEDGE_POOL_LOCK:
+            if HEDGE_POOL is None:
+                HEDGE_POOL = ThreadPoolExecutor(max_workers=max(4, CONFIG["max_workers"] * 2))
+    return HEDGE_POOL
+
+HEDGE_POOL = None
+HEDGE_POOL_LOCK = threading.Lock()
+
+def parse_fallback_response(api_endpoint, data):
+    """解析备用API返回的数据，内容为空时返回 (None, None)"""
+    content = data.get("data", {}).get("content", "")
+    chapter_title = data.get("data", {}).get("title", "")
+    
+    if "api.cenguigui.cn" in api_endpoint:
+        if data.get("code") == 200 and content:
+            return chapter_title, sanitize_content(content, chapter_title)
+
+    elif "lsjk.zyii.xyz" in api_endpoint and content:
+        # 只提取段落内容
+        return chapter_title, sanitize_content(content, paragraphs_only=True)
+
+    return None, None
+
+def down_text(chapter_id, headers, book_id=None, attempted=None):
+    """下载章节内容，优先读取本地章节缓存"""
+    cached = cached_results([chapter_id]).get(chapter_id)
+    if cached:
+        return cached
+    chapter_title, content = fetch_text(chapter_id, headers, book_id, attempted)
+    if content:
+        cache_results({chapter_id: (chapter_title, content)})
+    return chapter_title, content
+
+def fetch_from_endpoint(endpoint, chapter_id, headers):
+    """从一个接口下载单个章节，并把结果计入接口调度器"""
+    scheduler = get_endpoint_scheduler()
+    chapter_title, content = None, None
+    start_time = time.monotonic()
+    try:
+        if endpoint == OFFICIAL_ENDPOINT:
+            with get_identity_pool().lease() as client:
+                res = client.get_decrypt_contents(client.batch_get(chapter_id, False))
+            for k, v in res['data'].items():
+                with get_metrics().timer("sanitize_seconds"):
+                    chapter_title, content = process_official_content(v['title'], v['originContent'])
+                break
+        else:
+            response = get_http_client().get(
+                endpoint.format(chapter_id=chapter_id),
+                headers=headers,
+                verify=False,
+                limiter=get_endpoint_limiter_name(endpoint)
+            )
+            with get_metrics().timer("sanitize_seconds"):
+                chapter_title, content = parse_fallback_response(endpoint, response.json())
+        if not content:
+            print(f"接口 {endpoint_label(endpoint)} 返回空内容")
+    except Exception as e:
+        print(f"接口 {endpoint_label(endpoint)} 请求失败: {str(e)}")
+    latency = time.monotonic() - start_time
+    scheduler.record(endpoint, bool(content), latency)
+    get_metrics().observe("endpoint_seconds", latency, endpoint=endpoint_label(endpoint), result="ok" if content else "error")
+    return chapter_title, content
+
+def fetch_text(chapter_id, headers, book_id=None, attempted=None):
+    """按接口调度器的排序依次尝试官方API和备用API；
+    当前接口超过其延迟分位数仍未返回时，同时请求下一个接口，先成功的结果生效。
+    发出了请求时把章节ID加入 attempted（集合）"""
+    scheduler = get_endpoint_scheduler()
+    candidates = deque(scheduler.ranked())
+    pool = get_hedge_pool()
+    running = {}
+
+    def launch():
+        while candidates:
+            endpoint = candidates.popleft()
+            if scheduler.acquire(endpoint):
+                if attempted is not None:
+                    attempted.add(chapter_id)
+                running[pool.submit(fetch_from_endpoint, endpoint, chapter_id, headers)] = endpoint
+                return endpoint
+        return None
+
+    current = launch()
+    while running:
+        delay = scheduler.hedge_delay(current) if candidates else None
+        done, _ = wait(running, timeout=delay, return_when=FIRST_COMPLETED)
+        if not done:
+            hedge = launch()
+            if hedge is not None:
+                scheduler.hedged(current)
+                current = hedge
+            continue
+        for future in done:
+            running.pop(future)
+            chapter_title, content = future.result()
+            if content:
+                return chapter_title, content
+        if not running:
+            current = launch()
 
     print(f"所有API尝试失败，无法下载章节 {chapter_id}")
     return None, None
+
+def get_chapter_list_url(book_id):
+    return f"{CONFIG['web_base_url']}/api/reader/directory/detail?bookId={book_id}"
+
+def parse_chapter_list(data):
+    """解析章节列表接口返回的数据"""
+    if data.get("code") != 0:
+        print(f"API返回错误: {data.get('message', '未知错误')}")
+        return None
+
+    chapters = []
+    chapter_ids = data.get("data", {}).get("allItemIds", [])
+    volumes = parse_chapter_volumes(data.get("data", {}))
+    
+    # 创建章节列表
+    for idx, chapter_id in enumerate(chapter_ids):
+        if not chapter_id:
+            continue
+            
+        final_title = f"第{idx+1}章"
+        
+        chapter = {
+            "id": chapter_id,
+            "title": final_title,
+            "index": idx
+        }
+        if chapter_id in volumes:
+            chapter["volume"] = volumes[chapter_id]
+        chapters.append(chapter)
+    
+    return chapters
+
+def parse_chapter_volumes(data):
+    """从章节列表接口的分卷信息中取出 {章节ID: 卷名}，接口没有分卷信息时返回空字典"""
+    volumes = {}
+    names = data.get("volumeNameList") or []
+    for number, items in enumerate(data.get("chapterListWithVolume") or []):
+        for item in items or []:
+            if not isinstance(item, dict) or not item.get("itemId"):
+                continue
+            name = item.get("volume_name") or (names[number] if number < len(names) else None)
+            if name:
+                volumes[str(item["itemId"])] = name
+    return volumes
         
 def get_chapters_from_api(book_id, headers):
     """从API获取章节列表"""
-    url = f"https://fanqienovel.com/api/reader/directory/detail?bookId={book_id}"
+    url = get_chapter_list_url(book_id)
     try:
-        response = requests.get(url, headers=headers, timeout=CONFIG["request_timeout"])
+        response = get_http_client().get(url, headers=headers, timeout=CONFIG["request_timeout"], limiter="fanqienovel.com")
         if response.status_code != 200:
             print(f"获取章节列表失败，状态码: {response.status_code}")
             return None
 
-        data = response.json()
-        if data.get("code") != 0:
-            print(f"API返回错误: {data.get('message', '未知错误')}")
-            return None
-
-        chapters = []
-        chapter_ids = data.get("data", {}).get("allItemIds", [])
-        
-        # 创建章节列表
-        for idx, chapter_id in enumerate(chapter_ids):
-            if not chapter_id:
-                continue
-                
-            final_title = f"第{idx+1}章"
-            
-            chapters.append({
-                "id": chapter_id,
-                "title": final_title,
-                "index": idx
-            })
-        
-        return chapters
+        return parse_chapter_list(response.json())
     except Exception as e:
         print(f"从API获取章节列表失败: {str(e)}")
         return None
 
+class AsyncDownloader:
+    """asyncio 下载引擎，章节列表、密钥注册、批量下载和备用API都以协程运行（需要安装 aiohttp）"""
+    def __init__(self, headers, concurrency=None):
+        self.headers = headers
+        self.concurrency = concurrency or CONFIG["async_concurrency"]
+        self.session = None
+        self.semaphore = None
+        self.key_locks = {}
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency, ssl=False)
+        timeout = aiohttp.ClientTimeout(total=CONFIG["request_timeout"])
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def request_json(self, method, url, limiter=None, **kwargs):
+        """发送请求并解析JSON，与多线程模式共用令牌桶限速器"""
+        metrics = get_metrics()
+        host = urlparse(url).netloc
+        bucket = get_rate_limiter(limiter) if limiter else None
+        if bucket:
+            wait_start = time.perf_counter()
+            await bucket.acquire_async()
+            metrics.observe("rate_limit_wait_seconds", time.perf_counter() - wait_start, limiter=limiter)
+        async with self.semaphore:
+            start_time = time.perf_counter()
+            try:
+                async with self.session.request(method, url, **kwargs) as response:
+                    if bucket:
+                        bucket.feedback(response.status)
+                    metrics.inc("http_responses_total", host=host, status=response.status)
+                    response.raise_for_status()
+                    body = await response.read()
+            except Exception:
+                metrics.inc("http_errors_total", host=host)
+                raise
+            finally:
+                metrics.observe("http_request_seconds", time.perf_counter() - start_time, host=host)
+        metrics.inc("http_bytes_in_total", len(body), host=host)
+        if kwargs.get("data"):
+            metrics.inc("http_bytes_out_total", len(kwargs["data"]), host=host)
+        return json.loads(body)
+
+    async def get_json(self, url, **kwargs):
+        return await self.request_json("GET", url, **kwargs)
+
+    async def get_chapters(self, book_id):
+        """获取章节列表"""
+        try:
+            data = await self.get_json(get_chapter_list_url(book_id), headers=self.headers, limiter="fanqienovel.com")
+            return parse_chapter_list(data)
+        except Exception as e:
+            print(f"从API获取章节列表失败: {str(e)}")
+            return None
+
+    async def get_crypto(self, client):
+        """获取解密器，与多线程模式共用同一个密钥缓存"""
+        key_cache = get_key_cache()
+        crypto = key_cache.lookup(client.var)
+        if crypto is not None:
+            return crypto
+        # 同一身份只注册一次密钥，不同身份可以同时注册
+        key_lock = self.key_locks.setdefault(key_cache.cache_key(client.var), asyncio.Lock())
+        async with key_lock:
+            crypto = key_cache.lookup(client.var)
+            if crypto is not None:
+                return crypto
+            url, headers, params, payload, reg_crypto = client.register_key_request()
+            ret_arr = await self.request_json("POST", url, headers=headers, params=params, data=payload, limiter=client.var.limiter)
+            return key_cache.store(client.var, client.parse_register_key(ret_arr, reg_crypto))
+
+    async def official_batch(self, chapter_ids):
+        """用身份池中的一个身份请求官方 batch_full 接口并解密清洗，返回 {章节ID: (标题, 内容)}"""
+        with get_identity_pool().lease() as client:
+            url, headers, params = client.batch_get_request(",".join(chapter_ids), False)
+            res = client.check_batch_response(
+                await self.get_json(url, headers=headers, params=params, limiter=client.var.limiter)
+            )
+            data = res['data']
+            crypto = await self.get_crypto(client)
+        try:
+            results = await self.decode(crypto.key.hex(), data, chapter_ids)
+        except Exception:
+            get_key_cache().invalidate(client.var, crypto)
+            crypto = await self.get_crypto(client)
+            results = await self.decode(crypto.key.hex(), data, chapter_ids)
+        cache_results(results)
+        return results
+
+    async def decode(self, key, data, chapter_ids):
+        """配置了 decode_workers 时在进程池中解密清洗，避免阻塞事件循环"""
+        pool = get_decode_pool()
+        if pool is None:
+            return decode_official_batch(key, data, chapter_ids)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(pool, decode_official_batch, key, data, chapter_ids)
+
+    async def down_text_batch(self, chapter_ids, batch_size=None, attempted=None):
+        """批量下载章节内容，逻辑与 down_text_batch 相同"""
+        results = {}
+        if batch_size is None:
+            results.update(cached_results(chapter_ids))
+            chapter_ids = [cid for cid in chapter_ids if cid not in results]
+            batch_size = len(chapter_ids)
+        if not chapter_ids:
+            return results
+
+        if len(chapter_ids) == 1 or batch_size <= 1:
+            contents = await asyncio.gather(*(self.down_text(cid, attempted) for cid in chapter_ids))
+            for chapter_id, (chapter_title, content) in zip(chapter_ids, contents):
+                if content:
+                    results[chapter_id] = (chapter_title, content)
+            return results
+
+        scheduler = get_endpoint_scheduler()
+        for start in range(0, len(chapter_ids), batch_size):
+            batch = chapter_ids[start:start + batch_size]
+            available = scheduler.acquire(OFFICIAL_ENDPOINT)
+            if available:
+                if attempted is not None:
+                    attempted.update(batch)
+                try:
+                    batch_results = await self.official_batch(batch)
+                    results.update(batch_results)
+                    scheduler.record(OFFICIAL_ENDPOINT, bool(batch_results))
+                except asyncio.CancelledError:
+                    scheduler.release(OFFICIAL_ENDPOINT)
+                    raise
+                except Exception as e:
+                    scheduler.record(OFFICIAL_ENDPOINT, False)
+                    print(f"批量请求失败（{len(batch)}个章节），将拆分重试: {str(e)}")
+
+            missing = [cid for cid in batch if cid not in results]
+            if missing:
+                get_metrics().inc("retries_total", len(missing), kind="batch_split")
+                results.update(await self.down_text_batch(missing, len(missing) // 2 if available else 1, attempted))
+
+        return results
+
+    async def fetch_from_endpoint(self, endpoint, chapter_id):
+        """从一个接口下载单个章节，并把结果计入接口调度器"""
+        scheduler = get_endpoint_scheduler()
+        chapter_title, content = None, None
+        start_time = time.monotonic()
+        try:
+            if endpoint == OFFICIAL_ENDPOINT:
+                results = await self.official_batch([chapter_id])
+                chapter_title, content = results.get(chapter_id, (None, None))
+            else:
+                data = await self.get_json(
+                    endpoint.format(chapter_id=chapter_id),
+                    headers=self.headers,
+                    limiter=get_endpoint_limiter_name(endpoint)
+                )
+                with get_metrics().timer("sanitize_seconds"):
+                    chapter_title, content = parse_fallback_response(endpoint, data)
+                if content:
+                    cache_results({chapter_id: (chapter_title, content)})
+            if not content:
+                print(f"接口 {endpoint_label(endpoint)} 返回空内容")
+        except asyncio.CancelledError:
+            scheduler.release(endpoint)
+            raise
+        except Exception as e:
+            print(f"接口 {endpoint_label(endpoint)} 请求失败: {str(e)}")
+        latency = time.monotonic() - start_time
+        scheduler.record(endpoint, bool(content), latency)
+        get_metrics().observe("endpoint_seconds", latency, endpoint=endpoint_label(endpoint), result="ok" if content else "error")
+        return chapter_title, content
+
+    async def down_text(self, chapter_id, attempted=None):
+        """下载单个章节，按接口调度器的排序尝试，慢请求会对冲到下一个接口；发出了请求时把章节ID加入 attempted"""
+        cached = cached_results([chapter_id]).get(chapter_id)
+        if cached:
+            return cached
+
+        scheduler = get_endpoint_scheduler()
+        candidates = deque(scheduler.ranked())
+        running = {}
+
+        def launch():
+            while candidates:
+                endpoint = candidates.popleft()
+                if scheduler.acquire(endpoint):
+                    if attempted is not None:
+                        attempted.add(chapter_id)
+                    running[asyncio.ensure_future(self.fetch_from_endpoint(endpoint, chapter_id))] = endpoint
+                    return endpoint
+            return None
+
+        current = launch()
+        try:
+            while running:
+                delay = scheduler.hedge_delay(current) if candidates else None
+                done, _ = await asyncio.wait(list(running), timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedge = launch()
+                    if hedge is not None:
+                        scheduler.hedged(current)
+                        current = hedge
+                    continue
+                for task in done:
+                    running.pop(task)
+                    chapter_title, content = task.result()
+                    if content:
+                        return chapter_title, content
+                if not running:
+                    current = launch()
+        finally:
+            # 已经拿到结果时取消其余的对冲请求
+            for task in running:
+                task.cancel()
+
+        print(f"所有API尝试失败，无法下载章节 {chapter_id}")
+        return None, None
+
+async def get_chapters_async(book_id, headers):
+    """异步获取章节列表"""
+    async with AsyncDownloader(headers) as engine:
+        return await engine.get_chapters(book_id)
+
+async def download_scheduled_async(retry, headers, on_result, stop_event=None, batch_size=None):
+    """异步下载重试调度器中的章节，每组完成后调用 on_result(分组, 结果, 发出过请求的章节ID)；
+    stop_event 被设置后不再开始新的分组"""
+    stop_event = stop_event or threading.Event()
+    batch_size = max(1, batch_size or CONFIG["batch_size"])
+    async with AsyncDownloader(headers) as engine:
+        async def worker():
+            while not retry.finished and not stop_event.is_set():
+                # 所有接口都在熔断中时先等待，避免章节在没有发出请求的情况下耗尽重试次数
+                pause = get_endpoint_scheduler().retry_after()
+                if pause > 0:
+                    await asyncio.sleep(min(pause, 0.5))
+                    continue
+                group, delay = retry.take(batch_size)
+                if not group:
+                    # 其余章节在其他协程中下载或正在退避
+                    await asyncio.sleep(0.05 if delay is None else min(delay, 0.05))
+                    continue
+                attempted = set()
+                try:
+                    results = await engine.down_text_batch([ch["id"] for ch in group], attempted=attempted)
+                except Exception as e:
+                    print(f"章节 {group[0]['title']} 等 {len(group)} 个章节下载异常: {str(e)}")
+                    results = {}
+                    attempted = None
+                on_result(group, results, attempted)
+
+        workers = min(engine.concurrency, -(-len(retry.pending) // batch_size)) or 1
+        await asyncio.gather(*(worker() for _ in range(workers)))
+
 def download_chapter(chapter, headers, save_path, book_name, downloaded, book_id):
     """下载单个章节"""
     if chapter["id"] in downloaded:
@@ -341,227 +1668,2043 @@ def download_chapter(chapter, headers, save_path, book_name, downloaded, book_id
             
             # 立即更新下载状态
             downloaded.add(chapter["id"])
-            save_status(save_path, downloaded)
+            save_status(save_path, downloaded, book_id)
             return chapter["index"], content
         except Exception as e:
             print(f"写入文件失败: {str(e)}")
     return None
 
-def get_book_info(book_id, headers):
-    """获取书名、作者、简介"""
-    url = f'https://fanqienovel.com/page/{book_id}'
+BOOK_INFO_PATTERNS = {
+    "name": re.compile(r'<h1\b[^>]*>(.*?)</h1>', re.S),
+    "author": re.compile(r'class="[^"]*\bauthor-name-text\b[^"]*"[^>]*>(.*?)</span>', re.S),
+    "description": re.compile(r'class="[^"]*\bpage-abstract-content\b[^"]*"[^>]*>.*?<p\b[^>]*>(.*?)</p>', re.S)
+}
+# 页面末尾内嵌的 __INITIAL_STATE__ 数据，页面结构变化时作为后备
+BOOK_STATE_PATTERNS = {
+    "name": re.compile(r'"bookName"\s*:\s*("(?:[^"\\]|\\.)*")'),
+    "author": re.compile(r'"author"\s*:\s*("(?:[^"\\]|\\.)*")'),
+    "description": re.compile(r'"abstract"\s*:\s*("(?:[^"\\]|\\.)*")')
+}
+HTML_TAG_RE = re.compile(r'<[^>]+>')
+
+def extract_book_info(page, info=None):
+    """从（可能还不完整的）详情页HTML中提取书名、作者、简介，返回已找到的字段"""
+    info = {} if info is None else info
+    for field, pattern in BOOK_INFO_PATTERNS.items():
+        if field not in info:
+            match = pattern.search(page)
+            if match:
+                info[field] = html.unescape(HTML_TAG_RE.sub('', match.group(1)))
+    return info
+
+def extract_book_state(page, info):
+    """用内嵌的页面数据补全缺少的字段"""
+    for field, pattern in BOOK_STATE_PATTERNS.items():
+        if field not in info:
+            match = pattern.search(page)
+            if match:
+                try:
+                    info[field] = json.loads(match.group(1))
+                except ValueError:
+                    pass
+    return info
+
+def fetch_book_info(book_id, headers):
+    """流式下载详情页，找到书名、作者、简介后立即停止读取"""
+    url = f"{CONFIG['web_base_url']}/page/{book_id}"
+    metrics = get_metrics()
     try:
-        response = requests.get(url, headers=headers, timeout=CONFIG["request_timeout"])
-        if response.status_code != 200:
-            print(f"网络请求失败，状态码: {response.status_code}")
-            return None, None, None
+        with metrics.timer("book_info_seconds"):
+            response = get_http_client().get(url, headers=headers, limiter="fanqienovel.com", stream=True)
+            try:
+                if response.status_code != 200:
+                    print(f"网络请求失败，状态码: {response.status_code}")
+                    return None, None, None
 
-        soup = bs4.BeautifulSoup(response.text, 'html.parser')
-        
-        # 获取书名
-        name_element = soup.find('h1')
-        name = name_element.text if name_element else "未知书名"
-        
-        # 获取作者
-        author_name = "未知作者"
-        author_name_element = soup.find('div', class_='author-name')
-        if author_name_element:
-            author_name_span = author_name_element.find('span', class_='author-name-text')
-            if author_name_span:
-                author_name = author_name_span.text
-        
-        # 获取简介
-        description = "无简介"
-        description_element = soup.find('div', class_='page-abstract-content')
-        if description_element:
-            description_p = description_element.find('p')
-            if description_p:
-                description = description_p.text
-        
-        return name, author_name, description
+                # 没有声明编码时按 UTF-8 解码，不使用 requests 默认的 ISO-8859-1
+                content_type = response.headers.get("Content-Type", "").lower()
+                encoding = response.encoding if "charset" in content_type else "utf-8"
+                decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+                page = ""
+                info = {}
+                received = 0
+                for chunk in response.iter_content(chunk_size=16384):
+                    received += len(chunk)
+                    page += decoder.decode(chunk)
+                    if len(extract_book_info(page, info)) == len(BOOK_INFO_PATTERNS):
+                        break
+                else:
+                    page += decoder.decode(b"", final=True)
+                    extract_book_state(page, extract_book_info(page, info))
+            finally:
+                response.close()
+        metrics.inc("http_bytes_in_total", received, host=urlparse(url).netloc)
+
+        return info.get("name", "未知书名"), info.get("author", "未知作者"), info.get("description", "无简介")
     except Exception as e:
         print(f"获取书籍信息失败: {str(e)}")
         return None, None, None
 
-def load_status(save_path):
-    """加载下载状态"""
-    status_file = os.path.join(save_path, CONFIG["status_file"])
-    if os.path.exists(status_file):
+def get_book_info(book_id, headers):
+    """获取书名、作者、简介；章节缓存中有未过期的信息时不再请求详情页"""
+    cache = get_chapter_cache()
+    if cache is not None:
         try:
-            with open(status_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            info = cache.load_book_info(book_id, CONFIG["book_info_ttl"])
+            if info:
+                return info
+        except Exception as e:
+            print(f"读取书籍信息缓存失败: {str(e)}")
+
+    name, author_name, description = fetch_book_info(book_id, headers)
+    if name and cache is not None:
+        try:
+            cache.save_book_info(book_id, name, author_name, description)
+        except Exception as e:
+            print(f"保存书籍信息缓存失败: {str(e)}")
+    return name, author_name, description
+
+class ChapterCache:
+    """本地章节缓存（SQLite）：按 item_id 保存清洗后的标题和压缩后的正文，
+    同时保存每本书的章节目录，超过容量上限时按最近使用时间淘汰"""
+    def __init__(self, path, max_bytes, journal_mode="WAL"):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        # 多台机器共用网络磁盘上的文件时不能用 WAL
+        self.conn.execute(f"PRAGMA journal_mode={journal_mode}")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS chapters ("
+            "item_id TEXT PRIMARY KEY, title TEXT, content BLOB, size INTEGER, atime REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS chapters_atime ON chapters(atime)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS books ("
+            "book_id TEXT PRIMARY KEY, name TEXT, author TEXT, description TEXT, chapters TEXT, updated REAL)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS book_info ("
+            "book_id TEXT PRIMARY KEY, name TEXT, author TEXT, description TEXT, fetched REAL)"
+        )
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM chapters").fetchone()[0]
+
+    def get(self, item_id):
+        return self.get_many([item_id]).get(item_id)
+
+    def get_many(self, item_ids):
+        """批量读取章节，返回 {章节ID: (标题, 内容)}"""
+        results = {}
+        if not item_ids:
+            return results
+        now = time.time()
+        with self.lock:
+            for start in range(0, len(item_ids), 500):
+                chunk = item_ids[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.conn.execute(
+                    f"SELECT item_id, title, content FROM chapters WHERE item_id IN ({placeholders})", chunk
+                ).fetchall()
+                for item_id, title, content in rows:
+                    results[item_id] = (title, zlib.decompress(content).decode('utf-8'))
+                self.conn.executemany(
+                    "UPDATE chapters SET atime = ? WHERE item_id = ?", [(now, row[0]) for row in rows]
+                )
+        return results
+
+    def put(self, item_id, title, content):
+        self.put_many({item_id: (title, content)})
+
+    def put_many(self, results):
+        """写入章节 {章节ID: (标题, 内容)}"""
+        if not results:
+            return
+        now = time.time()
+        rows = []
+        for item_id, (title, content) in results.items():
+            blob = zlib.compress(content.encode('utf-8'), 6)
+            rows.append((item_id, title, blob, len(blob), now))
+        with self.lock:
+            # 先读后写，必须一开始就拿写锁，否则多个进程同时写时会互相等待而直接报错
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                for row in rows:
+                    old = self.conn.execute("SELECT size FROM chapters WHERE item_id = ?", (row[0],)).fetchone()
+                    if old:
+                        self.total_bytes -= old[0]
+                    self.conn.execute("INSERT OR REPLACE INTO chapters VALUES (?, ?, ?, ?, ?)", row)
+                    self.total_bytes += row[3]
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """删除最久未使用的章节，直到占用降到上限的九成"""
+        target = self.max_bytes * 0.9
+        while self.total_bytes > target:
+            rows = self.conn.execute(
+                "SELECT item_id, size FROM chapters ORDER BY atime LIMIT 200"
+            ).fetchall()
+            if not rows:
+                self.total_bytes = 0
+                break
+            removed = []
+            for item_id, size in rows:
+                removed.append((item_id,))
+                self.total_bytes -= size
+                if self.total_bytes <= target:
+                    break
+            self.conn.executemany("DELETE FROM chapters WHERE item_id = ?", removed)
+
+    def save_book(self, book_id, name, author, description, chapters):
+        """保存书籍信息和完整的章节目录"""
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO books VALUES (?, ?, ?, ?, ?, ?)",
+                (str(book_id), name, author, description, json.dumps(chapters, ensure_ascii=False), time.time())
+            )
+
+    def save_book_info(self, book_id, name, author, description):
+        """保存详情页的书籍信息，记录获取时间"""
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO book_info VALUES (?, ?, ?, ?, ?)",
+                (str(book_id), name, author, description, time.time())
+            )
+
+    def load_book_info(self, book_id, ttl):
+        """读取 ttl 秒内获取的书籍信息 (书名, 作者, 简介)，没有或已过期时返回 None"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT name, author, description FROM book_info WHERE book_id = ? AND fetched > ?",
+                (str(book_id), time.time() - ttl)
+            ).fetchone()
+        return tuple(row) if row else None
+
+    def load_book(self, book_id):
+        """读取书籍信息和章节目录，没有记录时返回 None"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT name, author, description, chapters FROM books WHERE book_id = ?", (str(book_id),)
+            ).fetchone()
+        if not row:
+            return None
+        return {"name": row[0], "author": row[1], "description": row[2], "chapters": json.loads(row[3])}
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def get_chapter_cache():
+    """获取全局章节缓存，cache_file 为空时不启用"""
+    global CHAPTER_CACHE
+    if CHAPTER_CACHE is None and CONFIG["cache_file"]:
+        with CHAPTER_CACHE_LOCK:
+            if CHAPTER_CACHE is None:
+                try:
+                    CHAPTER_CACHE = ChapterCache(CONFIG["cache_file"], CONFIG["cache_max_bytes"])
+                except Exception as e:
+                    print(f"打开章节缓存失败，本次不使用缓存: {str(e)}")
+                    CONFIG["cache_file"] = None
+    return CHAPTER_CACHE
+
+CHAPTER_CACHE = None
+CHAPTER_CACHE_LOCK = threading.Lock()
+
+def cache_results(results):
+    """把下载结果写入章节缓存"""
+    cache = get_chapter_cache()
+    if cache is not None and results:
+        try:
+            with get_metrics().timer("cache_seconds", op="put"):
+                cache.put_many(results)
+        except Exception as e:
+            print(f"写入章节缓存失败: {str(e)}")
+
+def cached_results(chapter_ids):
+    """从章节缓存中读取已有的章节"""
+    cache = get_chapter_cache()
+    if cache is None or not chapter_ids:
+        return {}
+    try:
+        with get_metrics().timer("cache_seconds", op="get"):
+            results = cache.get_many(list(chapter_ids))
+        get_metrics().inc("cache_hits_total", len(results))
+        get_metrics().inc("cache_misses_total", len(chapter_ids) - len(results))
+        return results
+    except Exception as e:
+        print(f"读取章节缓存失败: {str(e)}")
+        return {}
+
+def chapter_heading(chapter, api_title):
+    """章节标题：目录中的序号加上接口返回的标题"""
+    if api_title:
+        return f'{chapter["title"]} {api_title}'
+    return chapter["title"]
+
+class BookWriter:
+    """按章节顺序流式追加写入TXT：连续的章节立即落盘并释放内存，
+    乱序到达的章节暂存在重排缓冲区，超过上限后溢写到临时文件"""
+    def __init__(self, output_file_path, chapters, downloaded, on_written=None, buffer_limit=None):
+        self.output_file_path = output_file_path
+        self.chapters = chapters
+        self.downloaded = downloaded
+        self.on_written = on_written
+        self.buffer_limit = CONFIG["reorder_buffer"] if buffer_limit is None else buffer_limit
+        self.positions = {ch["index"]: pos for pos, ch in enumerate(chapters)}
+        self.position = 0
+        self.pending = {}
+        self.spilled = {}
+        self.spill_path = output_file_path + ".spill"
+        self.spill_file = None
+        self.written = 0
+        self.lock = threading.Lock()
+        self.file = open(output_file_path, 'a', encoding='utf-8')
+
+    @staticmethod
+    def format_chapter(chapter, api_title, content):
+        return f"{chapter_heading(chapter, api_title)}\n{content}\n\n"
+
+    def add(self, chapter, api_title, content):
+        """加入一个已下载的章节，并写出当前能连续写出的所有章节"""
+        with self.lock:
+            pos = self.positions[chapter["index"]]
+            if pos < self.position or pos in self.pending or pos in self.spilled:
+                return
+            text = self.format_chapter(chapter, api_title, content)
+            if pos == self.position:
+                self.write(pos, text)
+                self.position += 1
+            elif len(self.pending) < self.buffer_limit:
+                self.pending[pos] = text
+            else:
+                self.spill(pos, text)
+            self.advance()
+            self.file.flush()
+
+    def spill(self, pos, text):
+        if self.spill_file is None:
+            self.spill_file = open(self.spill_path, 'w+b')
+        data = text.encode('utf-8')
+        self.spill_file.seek(0, os.SEEK_END)
+        self.spilled[pos] = (self.spill_file.tell(), len(data))
+        self.spill_file.write(data)
+
+    def take(self, pos):
+        """取出暂存的章节内容，没有则返回 None"""
+        if pos in self.pending:
+            return self.pending.pop(pos)
+        if pos in self.spilled:
+            offset, length = self.spilled.pop(pos)
+            self.spill_file.seek(offset)
+            return self.spill_file.read(length).decode('utf-8')
+        return None
+
+    def write(self, pos, text):
+        with get_metrics().timer("write_seconds"):
+            self.file.write(text)
+        get_metrics().inc("write_chars_total", len(text))
+        self.written += 1
+        if self.on_written:
+            self.on_written(self.chapters[pos])
+
+    def advance(self):
+        """跳过此前已写入的章节，写出缓冲区中连续的章节"""
+        while self.position < len(self.chapters):
+            if self.chapters[self.position]["id"] in self.downloaded:
+                self.position += 1
+                continue
+            text = self.take(self.position)
+            if text is None:
+                break
+            self.write(self.position, text)
+            self.position += 1
+
+    def buffered(self):
+        with self.lock:
+            return len(self.pending) + len(self.spilled)
+
+    def close(self, flush_all=False):
+        """关闭写入器；flush_all 为 True 时跳过缺失章节，把缓冲区剩余章节按顺序写出，
+        否则只保留连续部分，缓冲区中的章节不计入进度，下次重新下载"""
+        with self.lock:
+            if self.file.closed:
+                return 0
+            self.advance()
+            if flush_all:
+                for pos in sorted(set(self.pending) | set(self.spilled)):
+                    self.write(pos, self.take(pos))
+            dropped = len(self.pending) + len(self.spilled)
+            self.pending.clear()
+            self.spilled.clear()
+            self.file.close()
+            if self.spill_file is not None:
+                self.spill_file.close()
+                self.spill_file = None
+                os.remove(self.spill_path)
+            return dropped
+
+class IndexedBook:
+    """索引书籍文件（.tnb）：每章单独压缩（zstd，未安装 zstandard 时用 zlib）追加到文件末尾，
+    固定大小的索引按目录顺序记录每章的章节ID、偏移和长度。
+    乱序到达的章节直接写入，不需要重排缓冲区；读取任意章节只需查索引，可以用 mmap 读取。
+    每章只保存接口返回的标题和正文，“第N章”按章节在索引中的位置读取时生成，目录中间插入章节后序号仍然正确。
+
+    文件结构：64 字节文件头 | 索引（capacity 项，每项 24 字节）| 章节数据和书籍信息；
+    目录变长超过索引容量时在文件末尾写入新的索引，旧索引的空间不再使用"""
+    MAGIC = b"TNB1"
+    HEADER = struct.Struct("<4sBBHIIQQI")
+    HEADER_SIZE = 64
+    ENTRY = struct.Struct("<QQII")
+    CODECS = {"zlib": 1, "zstd": 2}
+
+    def __init__(self, path, chapters=None, meta=None, compression=None):
+        """打开已有的文件；文件不存在时按 chapters 和 meta（书名、作者、简介）创建。
+        chapters 与文件中的目录不同时（新增、删除或调整顺序）只重写索引，已写入的章节保持不变"""
+        self.path = path
+        self.lock = threading.Lock()
+        self.map = None
+        if not os.path.exists(path):
+            if chapters is None:
+                raise FileNotFoundError(f"书籍文件不存在: {path}")
+            self.create(chapters, meta or {}, compression or CONFIG["book_compression"])
+        self.file = open(path, 'r+b')
+        self.load_header()
+        if self.codec == "zstd" and not has_zstandard():
+            self.file.close()
+            raise RuntimeError("该书籍文件使用 zstd 压缩，需要先安装 zstandard（pip install zstandard）")
+        self.load_index()
+        if chapters is not None:
+            ids = [int(ch["id"]) for ch in chapters]
+            if ids != self.ids:
+                self.remap(ids)
+            if meta and meta != self.meta():
+                self.set_meta(meta)
+
+    def create(self, chapters, meta, compression):
+        if compression == "auto":
+            compression = "zstd" if has_zstandard() else "zlib"
+        if compression not in self.CODECS:
+            raise ValueError(f"不支持的压缩方式: {compression}")
+        self.codec = compression
+        capacity = self.grow_capacity(len(chapters))
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(bytes(self.HEADER_SIZE))
+            f.write(b"".join(self.ENTRY.pack(int(ch["id"]), 0, 0, 0) for ch in chapters))
+            f.write(bytes((capacity - len(chapters)) * self.ENTRY.size))
+            meta_blob = self.compress(json.dumps(meta, ensure_ascii=False))
+            meta_offset = f.tell()
+            f.write(meta_blob)
+            f.seek(0)
+            f.write(self.HEADER.pack(self.MAGIC, 1, self.CODECS[compression], 0, capacity, len(chapters),
+                                     self.HEADER_SIZE, meta_offset, len(meta_blob)))
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def grow_capacity(count):
+        """索引预留约四分之一的空位，连载更新时不必每次都重新分配"""
+        return max(64, count + count // 4)
+
+    def load_header(self):
+        self.file.seek(0)
+        data = self.file.read(self.HEADER.size)
+        if len(data) < self.HEADER.size:
+            raise ValueError(f"不是有效的书籍文件: {self.path}")
+        magic, version, codec, _, self.capacity, count, self.index_offset, self.meta_offset, self.meta_length = \
+            self.HEADER.unpack(data)
+        if magic != self.MAGIC or version != 1:
+            raise ValueError(f"不是有效的书籍文件: {self.path}")
+        self.codec = {value: name for name, value in self.CODECS.items()}.get(codec)
+        if self.codec is None:
+            raise ValueError(f"未知的压缩方式: {codec}")
+        self.count = count
+
+    def write_header(self):
+        self.file.seek(0)
+        self.file.write(self.HEADER.pack(self.MAGIC, 1, self.CODECS[self.codec], 0, self.capacity, self.count,
+                                         self.index_offset, self.meta_offset, self.meta_length))
+
+    def load_index(self):
+        """读取索引；偏移超出文件末尾的项（写入章节时进程被强制结束）视为未写入"""
+        self.file.seek(0, os.SEEK_END)
+        self.end = self.file.tell()
+        self.file.seek(self.index_offset)
+        data = self.file.read(self.count * self.ENTRY.size)
+        self.ids = []
+        self.entries = []
+        for item_id, offset, length, raw_length in self.ENTRY.iter_unpack(data):
+            self.ids.append(item_id)
+            valid = offset and offset + length <= self.end
+            self.entries.append((offset, length, raw_length) if valid else (0, 0, 0))
+        self.positions = {item_id: pos for pos, item_id in enumerate(self.ids)}
+
+    def remap(self, ids):
+        """按新目录重写索引，已写入的章节按章节ID保留"""
+        old = {item_id: entry for item_id, entry in zip(self.ids, self.entries)}
+        self.ids = ids
+        self.entries = [old.get(item_id, (0, 0, 0)) for item_id in ids]
+        self.positions = {item_id: pos for pos, item_id in enumerate(ids)}
+        data = b"".join(self.ENTRY.pack(item_id, *entry) for item_id, entry in zip(ids, self.entries))
+        if len(ids) > self.capacity:
+            self.capacity = self.grow_capacity(len(ids))
+            self.index_offset = self.end
+            data += bytes((self.capacity - len(ids)) * self.ENTRY.size)
+            self.end += len(data)
+        self.count = len(ids)
+        self.file.seek(self.index_offset)
+        self.file.write(data)
+        self.write_header()
+        self.file.flush()
+
+    def compress(self, text):
+        data = text.encode('utf-8')
+        if self.codec == "zstd":
+            return zstandard.ZstdCompressor(level=CONFIG["book_compression_level"] or 3).compress(data)
+        return zlib.compress(data, CONFIG["book_compression_level"] or 6)
+
+    def decompress(self, blob):
+        if self.codec == "zstd":
+            # 压缩时帧头中记录了原始长度
+            return zstandard.ZstdDecompressor().decompress(blob).decode('utf-8')
+        return zlib.decompress(blob).decode('utf-8')
+
+    def append(self, blob):
+        """在文件末尾追加数据，返回偏移；调用时需持有锁"""
+        offset = self.end
+        self.file.seek(offset)
+        self.file.write(blob)
+        self.end += len(blob)
+        return offset
+
+    def put(self, pos, api_title, content):
+        """写入第 pos 章的标题和正文，已有内容时覆盖"""
+        text = f"{api_title or ''}\n{content}"
+        raw_length = len(text.encode('utf-8'))
+        blob = self.compress(text)
+        with self.lock:
+            # 先写数据再写索引项，进程中途结束时最多丢失这一章
+            offset = self.append(blob)
+            self.entries[pos] = (offset, len(blob), raw_length)
+            self.file.seek(self.index_offset + pos * self.ENTRY.size)
+            self.file.write(self.ENTRY.pack(self.ids[pos], offset, len(blob), raw_length))
+        get_metrics().inc("write_chars_total", len(text))
+
+    def put_id(self, item_id, api_title, content):
+        self.put(self.positions[int(item_id)], api_title, content)
+
+    def view(self):
+        """返回覆盖整个文件的只读 mmap，文件变长后重新映射；调用时需持有锁"""
+        if self.map is None or len(self.map) < self.end:
+            self.file.flush()
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map
+
+    def get(self, pos):
+        """读取第 pos 章的内容（章节标题和正文），未写入时返回 None"""
+        with self.lock:
+            offset, length, _ = self.entries[pos]
+            if not offset:
+                return None
+            blob = self.view()[offset:offset + length]
+        api_title, _, content = self.decompress(blob).partition("\n")
+        return f"{chapter_heading({'title': f'第{pos + 1}章'}, api_title)}\n{content}"
+
+    def get_id(self, item_id):
+        pos = self.positions.get(int(item_id))
+        return None if pos is None else self.get(pos)
+
+    def present_ids(self):
+        """已写入内容的章节ID"""
+        with self.lock:
+            return {str(item_id) for item_id, entry in zip(self.ids, self.entries) if entry[0]}
+
+    def meta(self):
+        with self.lock:
+            blob = self.view()[self.meta_offset:self.meta_offset + self.meta_length]
+        return json.loads(self.decompress(blob))
+
+    def set_meta(self, meta):
+        blob = self.compress(json.dumps(meta, ensure_ascii=False))
+        with self.lock:
+            self.meta_offset = self.append(blob)
+            self.meta_length = len(blob)
+            self.write_header()
+
+    def iter_texts(self):
+        """按目录顺序逐章返回内容，跳过未写入的章节"""
+        for pos in range(self.count):
+            text = self.get(pos)
+            if text is not None:
+                yield text
+
+    def to_txt(self, output_path):
+        """按目录顺序流式转换为TXT（先写临时文件再替换），返回写入的章节数"""
+        meta = self.meta()
+        written = 0
+        tmp_path = output_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(f"小说名: {meta.get('name', '')}\n作者: {meta.get('author', '')}\n内容简介: {meta.get('description', '')}\n\n")
+            for text in self.iter_texts():
+                f.write(text)
+                f.write("\n\n")
+                written += 1
+        os.replace(tmp_path, output_path)
+        return written
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+            if not self.file.closed:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.file.close()
+
+class IndexedBookWriter:
+    """与 BookWriter 接口相同，把章节直接写入索引书籍文件，不需要按顺序等待"""
+    def __init__(self, book, chapters, on_written=None):
+        self.book = book
+        self.chapters = chapters
+        self.on_written = on_written
+        self.positions = {ch["index"]: pos for pos, ch in enumerate(chapters)}
+        self.written = 0
+
+    def add(self, chapter, api_title, content):
+        pos = self.positions[chapter["index"]]
+        with get_metrics().timer("write_seconds"):
+            self.book.put(pos, api_title, content)
+        self.written += 1
+        if self.on_written:
+            self.on_written(self.chapters[pos])
+
+    def buffered(self):
+        return 0
+
+    def close(self, flush_all=False):
+        self.book.close()
+        return 0
+
+def convert_book_to_txt(path, save_path=None):
+    """把索引书籍文件转换为同名TXT，返回TXT路径"""
+    book = IndexedBook(path)
+    try:
+        output_path = os.path.splitext(path)[0] + ".txt"
+        if save_path:
+            os.makedirs(save_path, exist_ok=True)
+            output_path = os.path.join(save_path, os.path.basename(output_path))
+        with get_metrics().timer("export_seconds"):
+            written = book.to_txt(output_path)
+    finally:
+        book.close()
+    print(f"已转换 {written} 个章节: {output_path}")
+    return output_path
+
+class ProgressJournal:
+    """按书籍保存下载进度：快照文件 + 只追加的日志，每完成一章追加一行，
+    日志过长时压缩进快照（先写临时文件再原子替换）；同时保存上次下载时的章节目录，用于增量更新时检测目录变化"""
+    def __init__(self, save_path, book_id=None):
+        if book_id is None:
+            self.snapshot_path = os.path.join(save_path, CONFIG["status_file"])
+        else:
+            self.snapshot_path = os.path.join(save_path, f"chapter_{book_id}.json")
+        self.journal_path = os.path.splitext(self.snapshot_path)[0] + ".journal"
+        self.catalog_path = os.path.splitext(self.snapshot_path)[0] + ".catalog.json"
+        self.legacy_path = os.path.join(save_path, CONFIG["status_file"])
+        self.done = set()
+        self.records = 0
+        self.unsynced = 0
+        self.last_sync = time.time()
+        self.file = None
+        self.lock = threading.Lock()
+
+    def load(self, chapter_ids=None):
+        """读取快照并重放日志；旧版共用的 chapter.json 只取属于本书的章节"""
+        done = set()
+        snapshot_path = self.snapshot_path
+        if not os.path.exists(snapshot_path) and not os.path.exists(self.journal_path) and chapter_ids is not None:
+            snapshot_path = self.legacy_path
+        if os.path.exists(snapshot_path):
+            try:
+                with open(snapshot_path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
                 if isinstance(data, list):
-                    return set(data)
-                return set()
-        except:
-            pass
-    return set()
+                    done.update(data)
+            except Exception:
+                pass
+        if snapshot_path == self.legacy_path and chapter_ids is not None:
+            done &= set(chapter_ids)
+
+        self.records = 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        done.add(json.loads(line))
+                        self.records += 1
+                    except ValueError:
+                        # 进程被强制结束时最后一行可能不完整
+                        continue
+        self.done = done
+        return done
+
+    def add(self, chapter_id):
+        """记录一个已完成的章节：每次都写入操作系统，按批次 fsync"""
+        with self.lock:
+            self.done.add(chapter_id)
+            if self.file is None:
+                self.file = open(self.journal_path, 'a', encoding='utf-8')
+            self.file.write(json.dumps(chapter_id) + "\n")
+            # TXT 每写一章都会 flush，日志不能落在它后面，否则进程被结束后已写入的章节会重复下载
+            self.file.flush()
+            self.records += 1
+            self.unsynced += 1
+            if (self.unsynced >= CONFIG["status_fsync_batch"]
+                    or time.time() - self.last_sync >= CONFIG["status_fsync_interval"]):
+                self.sync()
+            if self.records >= CONFIG["status_compact_records"]:
+                self.compact()
+
+    def sync(self):
+        if self.file is not None and self.unsynced:
+            with get_metrics().timer("journal_fsync_seconds"):
+                self.file.flush()
+                os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def compact(self):
+        """把当前进度写入快照并清空日志"""
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(list(self.done), f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self.records = 0
+        self.unsynced = 0
+
+    def load_catalog(self):
+        """读取上次保存的章节目录，没有或无法读取时返回 None"""
+        try:
+            with open(self.catalog_path, 'r', encoding='utf-8') as f:
+                chapters = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return chapters if isinstance(chapters, list) else None
+
+    def save_catalog(self, chapters):
+        """保存章节目录（只需要章节ID和序号）"""
+        tmp_path = self.catalog_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump([{"id": ch["id"], "index": ch["index"]} for ch in chapters], f)
+        os.replace(tmp_path, self.catalog_path)
 
-def save_status(save_path, downloaded):
+    def close(self):
+        with self.lock:
+            self.sync()
+            if self.records or not os.path.exists(self.snapshot_path):
+                self.compact()
+            elif self.file is not None:
+                self.file.close()
+                self.file = None
+
+def load_status(save_path, book_id=None, chapter_ids=None):
+    """加载下载状态"""
+    return ProgressJournal(save_path, book_id).load(chapter_ids)
+
+def save_status(save_path, downloaded, book_id=None):
     """保存下载状态"""
-    status_file = os.path.join(save_path, CONFIG["status_file"])
-    with open(status_file, 'w', encoding='utf-8') as f:
-        json.dump(list(downloaded), f, ensure_ascii=False, indent=2)
+    journal = ProgressJournal(save_path, book_id)
+    journal.done = set(downloaded)
+    journal.compact()
+
+def diff_chapter_lists(old_chapters, new_chapters):
+    """对比保存的章节目录和最新目录：新增、删除的章节，以及已有章节的顺序或编号是否变化"""
+    old_index = {ch["id"]: ch["index"] for ch in old_chapters}
+    new_index = {ch["id"]: ch["index"] for ch in new_chapters}
+    added = [ch["id"] for ch in new_chapters if ch["id"] not in old_index]
+    removed = [ch["id"] for ch in old_chapters if ch["id"] not in new_index]
+    common_old = [ch["id"] for ch in old_chapters if ch["id"] in new_index]
+    common_new = [ch["id"] for ch in new_chapters if ch["id"] in old_index]
+    reordered = common_old != common_new
+    renumbered = any(old_index[cid] != new_index[cid] for cid in common_new)
+    return {
+        "added": added,
+        "removed": removed,
+        "reordered": reordered,
+        "changed": bool(removed) or reordered or renumbered
+    }
+
+def retry_delay(attempts, jitter=None, base_delay=None, max_delay=None):
+    """第 attempts 次失败后的退避时间：指数增长，乘以 0.5~1 的随机抖动"""
+    base_delay = CONFIG["retry_base_delay"] if base_delay is None else base_delay
+    max_delay = CONFIG["retry_max_delay"] if max_delay is None else max_delay
+    if jitter is None:
+        jitter = random.uniform(0.5, 1.0)
+    return min(max_delay, base_delay * 2 ** max(0, attempts - 1)) * jitter
+
+class RetryScheduler:
+    """章节级重试调度：失败的章节立即按指数退避加随机抖动重新排队，不必等整轮结束；
+    就绪的章节按目录顺序优先取出，便于按顺序写入；超过最大尝试次数的章节记为永久失败"""
+    def __init__(self, chapters, max_attempts=None, base_delay=None, max_delay=None):
+        self.max_attempts = max(1, max_attempts or CONFIG["retry_max_attempts"])
+        self.base_delay = CONFIG["retry_base_delay"] if base_delay is None else base_delay
+        self.max_delay = CONFIG["retry_max_delay"] if max_delay is None else max_delay
+        self.ready = [(pos, ch) for pos, ch in enumerate(chapters)]
+        self.positions = {ch["id"]: pos for pos, ch in self.ready}
+        self.delayed = []
+        self.pending = {ch["id"] for ch in chapters}
+        self.inflight = set()
+        self.attempts = {}
+        self.failed = []
+        self.retried = 0
+        self.cond = threading.Condition()
+
+    @property
+    def finished(self):
+        return not self.pending
+
+    def promote(self, now):
+        """把退避时间已到的章节移入就绪队列"""
+        while self.delayed and self.delayed[0][0] <= now:
+            _, pos, chapter = heapq.heappop(self.delayed)
+            heapq.heappush(self.ready, (pos, chapter))
+
+    def take(self, limit):
+        """不阻塞地取出最多 limit 个就绪章节；没有就绪章节时返回距下一个章节就绪的秒数（没有排队的章节时为 None）"""
+        with self.cond:
+            now = time.monotonic()
+            self.promote(now)
+            batch = []
+            while self.ready and len(batch) < limit:
+                _, chapter = heapq.heappop(self.ready)
+                self.inflight.add(chapter["id"])
+                batch.append(chapter)
+            if batch:
+                return batch, 0.0
+            if self.delayed:
+                return batch, self.delayed[0][0] - now
+            return batch, None
+
+    def get(self, limit, stop_event):
+        """阻塞直到有就绪章节；全部章节都有结果或收到停止信号时返回空列表"""
+        with self.cond:
+            while not self.finished and not stop_event.is_set():
+                batch, delay = self.take(limit)
+                if batch:
+                    return batch
+                # 其他线程下载中的章节可能失败并重新排队，定时醒来检查停止信号
+                self.cond.wait(0.5 if delay is None else min(delay, 0.5))
+            return []
+
+    def done(self, chapter):
+        """章节下载成功；返回 False 表示该章节已经有结果（重复的结果应忽略）"""
+        with self.cond:
+            if chapter["id"] not in self.inflight:
+                return False
+            self.inflight.discard(chapter["id"])
+            self.pending.discard(chapter["id"])
+            self.cond.notify_all()
+            return True
+
+    def fail(self, chapters, charge=True):
+        """一批章节下载失败，按退避时间重新排队；同一批失败的章节共用抖动系数，就绪后仍能合并成一批请求。
+        charge 为 False 时不计入尝试次数（例如所有接口都在熔断中，请求根本没有发出）。
+        返回达到最大尝试次数、记为永久失败的章节"""
+        failed = []
+        with self.cond:
+            now = time.monotonic()
+            jitter = random.uniform(0.5, 1.0)
+            for chapter in chapters:
+                if chapter["id"] not in self.inflight:
+                    continue
+                self.inflight.discard(chapter["id"])
+                attempts = self.attempts.get(chapter["id"], 0) + charge
+                self.attempts[chapter["id"]] = attempts
+                if attempts >= self.max_attempts:
+                    self.pending.discard(chapter["id"])
+                    self.failed.append(chapter)
+                    failed.append(chapter)
+                    continue
+                delay = retry_delay(attempts, jitter, self.base_delay, self.max_delay)
+                heapq.heappush(self.delayed, (now + delay, self.positions[chapter["id"]], chapter))
+                self.retried += 1
+            self.cond.notify_all()
+        retried = len(chapters) - len(failed)
+        if retried:
+            get_metrics().inc("retries_total", retried, kind="chapter")
+        if failed:
+            get_metrics().inc("chapters_failed_total", len(failed))
+        return failed
+
+def get_download_slots():
+    """全局下载并发额度：同时下载多本书时，进行中的批量请求总数不超过 max_workers"""
+    global DOWNLOAD_SLOTS
+    if DOWNLOAD_SLOTS is None:
+        with DOWNLOAD_SLOTS_LOCK:
+            if DOWNLOAD_SLOTS is None:
+                DOWNLOAD_SLOTS = threading.BoundedSemaphore(max(1, CONFIG["max_workers"]))
+    return DOWNLOAD_SLOTS
+
+DOWNLOAD_SLOTS = None
+DOWNLOAD_SLOTS_LOCK = threading.Lock()
+
+def install_stop_handler(stop_event):
+    """在主线程安装 Ctrl+C 处理：第一次按下时通知下载任务保存进度后停止，再按一次立即中断。
+    返回原来的处理函数；不在主线程时不安装，返回 None"""
+    if threading.current_thread() is not threading.main_thread():
+        return None
 
-def Run(book_id, save_path):
-    """运行下载"""
     def signal_handler(sig, frame):
-        print("\n检测到程序中断，正在保存已下载内容...")
-        write_downloaded_chapters_in_order()
-        save_status(save_path, downloaded)
-        print(f"已保存 {len(downloaded)} 个章节的进度")
-        sys.exit(0)
-    
-    def write_downloaded_chapters_in_order():
-        """按章节顺序写入"""
-        if not chapter_results:
+        if stop_event.is_set():
+            raise KeyboardInterrupt
+        print("\n检测到程序中断，正在保存已下载内容...（再按一次 Ctrl+C 立即退出）")
+        stop_event.set()
+
+    return signal.signal(signal.SIGINT, signal_handler)
+
+def restore_stop_handler(previous):
+    if previous is not None:
+        signal.signal(signal.SIGINT, previous)
+
+def network_stats():
+    """连接池、限速器和接口调度器的统计信息"""
+    clients = [get_http_client()] + [client.http for client in get_identity_pool().clients]
+    totals = [client.stats()["total"] for client in clients]
+    return {
+        "http": {key: sum(total[key] for total in totals) for key in ("requests", "connections", "reused")},
+        "rate_limits": rate_limiter_stats(),
+        "endpoints": get_endpoint_scheduler().stats(),
+        "identities": get_identity_pool().stats()
+    }
+
+def print_network_stats():
+    stats = network_stats()
+    print(f"网络请求 {stats['http']['requests']} 次，新建连接 {stats['http']['connections']} 次，复用连接 {stats['http']['reused']} 次")
+    for limiter_name, limiter_stats in stats["rate_limits"].items():
+        print(f"限速 {limiter_name}: 请求 {limiter_stats['acquired']} 次，等待 {limiter_stats['wait_time']} 秒，被限流 {limiter_stats['throttled']} 次")
+    for endpoint, endpoint_stats in stats["endpoints"].items():
+        if endpoint_stats["requests"]:
+            print(f"接口 {endpoint}: 请求 {endpoint_stats['requests']} 次，失败 {endpoint_stats['errors']} 次，"
+                  f"平均延迟 {endpoint_stats['latency']} 秒，对冲 {endpoint_stats['hedged']} 次")
+    if len(stats["identities"]) > 1:
+        for install_id, identity_stats in stats["identities"].items():
+            print(f"设备身份 {install_id}: 请求 {identity_stats['requests']} 次，失败 {identity_stats['errors']} 次，"
+                  f"暂停 {identity_stats['benched']} 次")
+
+def download_book(book_id, save_path, update=False, interactive=False, progress=True, stop_event=None):
+    """下载一本书，不读取输入也不退出进程，可以在其他程序中调用。
+
+    update 为 True 时为增量更新模式，只下载新章节并追加到已有TXT；
+    interactive 为 True 时，曾经下载过的书会先询问是否继续；
+    stop_event 被设置后保存进度并尽快返回。
+    返回本次下载的结果摘要（dict）。"""
+    stop_event = stop_event or threading.Event()
+    started = time.time()
+    summary = {
+        "book_id": str(book_id),
+        "name": None,
+        "status": "error",
+        "total": 0,
+        "done": 0,
+        "downloaded": 0,
+        "failed": 0,
+        "output": None,
+        "elapsed": 0.0,
+        "error": None,
+        "failed_ids": []
+    }
+
+    def close_writer(flush_all=False):
+        """关闭写入器，报告未能按顺序写入的章节"""
+        if writer is None:
             return
-            
-        # 获取所有已下载的章节索引
-        downloaded_indices = sorted(chapter_results.keys())
+        dropped = writer.close(flush_all)
+        if dropped:
+            print(f"有 {dropped} 个章节因前面的章节未下载完成而未写入，下次运行时会重新下载")
+
+    writer = None
+    journal = None
+    pipeline = None
+    book = None
+    rebuild_order = False
+    chapters = []
 
-        with open(output_file_path, 'w', encoding='utf-8') as f:
-            f.write(f"小说名: {name}\n作者: {author_name}\n内容简介: {description}\n\n")
-            
-            # 按顺序写入所有章节
-            for idx in range(len(chapters)):
-                if idx in chapter_results:
-                    result = chapter_results[idx]
-                    if result["api_title"]:
-                        title = f'{result["base_title"]} {result["api_title"]}'
-                    else:
-                        title = result["base_title"]
-                    f.write(f"{title}\n")
-                    f.write(result["content"] + '\n\n')
-                elif chapters[idx]["id"] in downloaded:
-                    continue
-                else:
-                    pass
-    
-    # 信号处理
-    signal.signal(signal.SIGINT, signal_handler)
-    
     try:
         headers = get_headers()
-        
+
+        use_async = CONFIG["engine"] == "async"
+        if use_async and not has_aiohttp():
+            print("未安装 aiohttp，将使用多线程下载（pip install aiohttp 可启用异步引擎）")
+            use_async = False
+
         # 获取章节列表
-        chapters = get_chapters_from_api(book_id, headers)
+        if use_async:
+            chapters = asyncio.run(get_chapters_async(book_id, headers))
+        else:
+            chapters = get_chapters_from_api(book_id, headers)
         if not chapters:
             print("未找到任何章节，请检查小说ID是否正确。")
-            return
-            
-        # 获取书籍信息
-        name, author_name, description = get_book_info(book_id, headers)
+            summary["status"] = "not_found"
+            return summary
+        summary["total"] = len(chapters)
+
+        cache = get_chapter_cache()
+        stored_book = None
+        if update and cache is not None:
+            try:
+                stored_book = cache.load_book(book_id)
+            except Exception as e:
+                print(f"读取章节目录失败: {str(e)}")
+
+        # 获取书籍信息，增量更新时直接使用保存的信息
+        if stored_book:
+            name, author_name, description = stored_book["name"], stored_book["author"], stored_book["description"]
+        else:
+            name, author_name, description = get_book_info(book_id, headers)
         if not name:
             print("无法获取书籍信息，将使用默认名称")
             name = f"未知小说_{book_id}"
             author_name = "未知作者"
             description = "无简介"
+        summary["name"] = name
+
+        os.makedirs(save_path, exist_ok=True)
+        journal = ProgressJournal(save_path, book_id)
+        downloaded = journal.load([ch["id"] for ch in chapters])
+
+        # 与上次下载时的目录对比：优先使用缓存中的目录，未启用缓存时使用进度文件旁保存的目录
+        changes = None
+        if update:
+            stored_chapters = stored_book["chapters"] if stored_book else journal.load_catalog()
+            if stored_chapters is not None:
+                changes = diff_chapter_lists(stored_chapters, chapters)
+                print(f"《{name}》目录对比：新增 {len(changes['added'])} 章，删除 {len(changes['removed'])} 章" +
+                      ("，章节顺序有调整" if changes["reordered"] else ""))
+            elif downloaded:
+                print(f"《{name}》没有保存上次下载时的章节目录，无法检测目录中间插入、删除的章节，只补下载缺少的章节")
 
-        downloaded = load_status(save_path)
-        if downloaded:
+        # 保存章节目录，用于不联网重建TXT
+        if cache is not None:
+            try:
+                cache.save_book(book_id, name, author_name, description, chapters)
+            except Exception as e:
+                print(f"保存章节目录失败: {str(e)}")
+        indexed = CONFIG["book_format"] == "tnb"
+        output_file_path = os.path.join(save_path, f"{name}.{'tnb' if indexed else 'txt'}")
+        summary["output"] = output_file_path
+        if indexed:
+            # 目录变化时只重写索引，已下载的章节不需要重建；以文件中实际存在的章节为准
+            book = IndexedBook(output_file_path, chapters, {"name": name, "author": author_name, "description": description})
+            downloaded &= book.present_ids()
+        if update and not indexed:
+            # 目录结构变化或TXT丢失时，先从缓存按新目录重建，再补下载缺少的章节
+            txt_missing = bool(downloaded) and not os.path.exists(output_file_path)
+            if (txt_missing or (changes and changes["changed"])) and cache is not None:
+                print("章节目录有变化或TXT不存在，正在从本地缓存重建...")
+                rebuild_order = rebuild_txt(book_id, save_path)
+                downloaded = journal.load([ch["id"] for ch in chapters])
+            elif changes and changes["changed"] and downloaded:
+                # 没有缓存无法按新目录重建，直接追加会打乱章节顺序：保留旧文件，重新下载全书
+                if os.path.exists(output_file_path):
+                    os.replace(output_file_path, output_file_path + ".bak")
+                    print(f"章节目录有变化，但未启用章节缓存，无法重建TXT；旧文件已保存为 {output_file_path}.bak，将重新下载全书")
+                else:
+                    print("章节目录有变化，但未启用章节缓存，无法重建TXT，将重新下载全书")
+                save_status(save_path, [], book_id)
+                downloaded = journal.load([ch["id"] for ch in chapters])
+        elif downloaded and interactive and not update:
             print(f"检测到您曾经下载过小说《{name}》。")
             user_input = input("是否需要再次下载？如果需要请输入1并回车，如果不需要请直接回车即可返回主程序：")
             if user_input != "1":
                 print("已取消下载，返回主程序。")
-                return
+                summary["status"] = "cancelled"
+                return summary
+
+        try:
+            journal.save_catalog(chapters)
+        except OSError as e:
+            print(f"保存章节目录失败: {str(e)}")
 
         # 准备下载队列
         todo_chapters = [ch for ch in chapters if ch["id"] not in downloaded]
         if not todo_chapters:
-            print("所有章节已是最新，无需下载")
-            return
+            print(f"《{name}》所有章节已是最新，无需下载")
+            summary["status"] = "up_to_date"
+            return summary
 
         print(f"开始下载：《{name}》, 总章节数: {len(chapters)}, 待下载: {len(todo_chapters)}")
-        os.makedirs(save_path, exist_ok=True)
 
         # 写入书籍信息
-        output_file_path = os.path.join(save_path, f"{name}.txt")
-        if not os.path.exists(output_file_path):
+        if not indexed and not os.path.exists(output_file_path):
             with open(output_file_path, 'w', encoding='utf-8') as f:
                 f.write(f"小说名: {name}\n作者: {author_name}\n内容简介: {description}\n\n")
 
         # 多线程变量
         success_count = 0
-        failed_chapters = []
-        chapter_results = {}
         lock = threading.Lock()
-        
-        def download_task(chapter):
-            """多线程下载任务"""
-            nonlocal success_count
+        retry = RetryScheduler(todo_chapters)
+        batch_size = max(1, CONFIG["batch_size"])
+        if indexed:
+            writer = IndexedBookWriter(book, chapters, on_written=lambda ch: journal.add(ch["id"]))
+        else:
+            writer = BookWriter(output_file_path, chapters, downloaded, on_written=lambda ch: journal.add(ch["id"]))
+        pbar = tqdm.tqdm(total=len(todo_chapters), desc=f"《{name}》", disable=not progress)
+
+        def download_worker():
+            """下载线程：不断从重试调度器取出就绪的章节，同时下载多本书时共用全局并发额度"""
+            while True:
+                wait_for_endpoints()
+                batch = retry.get(batch_size, stop_event)
+                if not batch:
+                    return
+                with get_download_slots():
+                    try:
+                        download_batch(batch)
+                    except Exception as e:
+                        print(f"章节 {batch[0]['title']} 等 {len(batch)} 个章节下载异常: {str(e)}")
+                        record_results(batch, {})
+
+        def wait_for_endpoints():
+            """所有接口都在熔断中时先等待，避免章节在没有发出请求的情况下耗尽重试次数"""
+            delay = get_endpoint_scheduler().retry_after()
+            while delay > 0 and not stop_event.wait(min(delay, 0.5)):
+                delay = get_endpoint_scheduler().retry_after()
+
+        def download_batch(batch):
+            batch_size = None
+            attempted = set()
+            if pipeline is not None and len(batch) > 1:
+                cached = cached_results([ch["id"] for ch in batch])
+                if cached:
+                    record_results([ch for ch in batch if ch["id"] in cached], cached)
+                    batch = [ch for ch in batch if ch["id"] not in cached]
+                batch = fetch_to_pipeline(batch, attempted)
+                if not batch:
+                    return
+                batch_size = len(batch) // 2
             try:
-                chapter_title, content = down_text(chapter["id"], headers, book_id)
-                if content:
+                results = down_text_batch([ch["id"] for ch in batch], headers, book_id, batch_size, attempted)
+            except Exception as e:
+                print(f"章节 {batch[0]['title']} 等 {len(batch)} 个章节下载异常: {str(e)}")
+                results = {}
+                attempted = None
+            record_results(batch, results, attempted)
+
+        def fetch_to_pipeline(batch, attempted):
+            """只下载原始数据交给解密流水线，返回响应中缺失、需要拆分重试的章节"""
+            if not batch:
+                return batch
+            chapter_ids = [ch["id"] for ch in batch]
+            scheduler = get_endpoint_scheduler()
+            if not scheduler.acquire(OFFICIAL_ENDPOINT):
+                return batch
+            attempted.update(chapter_ids)
+            try:
+                client, crypto, data = fetch_official_batch(chapter_ids)
+            except Exception as e:
+                scheduler.record(OFFICIAL_ENDPOINT, False)
+                print(f"批量请求失败（{len(batch)}个章节），将拆分重试: {str(e)}")
+                return batch
+            present = [ch for ch in batch if (data.get(ch["id"]) or {}).get("content")]
+            scheduler.record(OFFICIAL_ENDPOINT, bool(present))
+            if present:
+                pipeline.put((client, crypto, present), crypto.key.hex(), data, chapter_ids)
+            present_ids = {ch["id"] for ch in present}
+            return [ch for ch in batch if ch["id"] not in present_ids]
+
+        def on_decoded(job, results, error):
+            """解密流水线按顺序交回的结果"""
+            client, crypto, present = job
+            if error is not None:
+                print(f"章节解密失败，将稍后重试: {str(error)}")
+                get_key_cache().invalidate(client.var, crypto)
+            cache_results(results)
+            record_results(present, results)
+
+        def record_results(batch, results, attempted=None):
+            """记录一批章节的下载结果，失败的章节交给重试调度器退避后重新排队。
+            attempted 为确实发出过请求的章节ID，其余失败的章节（所有接口都在熔断中）不计入尝试次数；
+            为 None 时全部计入"""
+            nonlocal success_count
+            missing = []
+            for chapter in batch:
+                chapter_title, content = results.get(chapter["id"], (None, None))
+                if not content:
+                    missing.append(chapter)
+                elif retry.done(chapter):
+                    # 章节写入文件后才计入已下载
+                    writer.add(chapter, chapter_title, content)
                     with lock:
-                        chapter_results[chapter["index"]] = {
-                            "base_title": chapter["title"],
-                            "api_title": chapter_title,
-                            "content": content
-                        }
-                        downloaded.add(chapter["id"])
                         success_count += 1
-                else:
-                    with lock:
-                        failed_chapters.append(chapter)
-            except Exception as e:
-                print(f"章节 {chapter['title']} 下载异常: {str(e)}")
-                with lock:
-                    failed_chapters.append(chapter)
-        
-        # 持续尝试直到下载完成
-        attempt = 1
-        while todo_chapters:
-            print(f"\n第 {attempt} 次尝试，剩余 {len(todo_chapters)} 个章节...")
-            attempt += 1
-            
-            # 当前批次
-            current_batch = todo_chapters.copy()
-            
-            with ThreadPoolExecutor(max_workers=CONFIG["max_workers"]) as executor:
-                futures = [executor.submit(download_task, ch) for ch in current_batch]
-                
-                with tqdm(total=len(current_batch), desc="下载进度") as pbar:
-                    for future in as_completed(futures):
                         pbar.update(1)
-            
-            # 按顺序写入已下载章节
-            write_downloaded_chapters_in_order()
-            save_status(save_path, downloaded)
-            
-            # 更新待下载列表
-            todo_chapters = failed_chapters.copy()
-            failed_chapters = []
-            
-            if todo_chapters:
-                time.sleep(1)
+            if attempted is None:
+                failed = retry.fail(missing) if missing else []
+            else:
+                charged = [ch for ch in missing if ch["id"] in attempted]
+                skipped = [ch for ch in missing if ch["id"] not in attempted]
+                failed = (retry.fail(charged) if charged else []) + (retry.fail(skipped, False) if skipped else [])
+            for chapter in failed:
+                print(f"章节 {chapter['title']} 已尝试 {retry.max_attempts} 次仍下载失败，跳过该章节")
+            if failed:
+                with lock:
+                    pbar.update(len(failed))
 
-        print(f"下载完成！成功下载 {success_count} 个章节")
+        # 配置了解密进程池时，下载线程只负责网络请求
+        if CONFIG["decode_workers"] > 0 and not use_async:
+            pipeline = DecodePipeline(on_decoded)
+
+        # 失败的章节单独退避重试，下载线程不需要等待整轮结束
+        with pbar:
+            if use_async:
+                asyncio.run(download_scheduled_async(retry, headers, record_results, stop_event, batch_size))
+            else:
+                workers = min(CONFIG["max_workers"], -(-len(todo_chapters) // batch_size)) or 1
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    for future in [executor.submit(download_worker) for _ in range(workers)]:
+                        future.result()
+
+            if pipeline is not None:
+                pipeline.close()
+                pipeline = None
+
+        summary["failed_ids"] = [ch["id"] for ch in retry.failed]
+        if stop_event.is_set():
+            close_writer()
+            summary["status"] = "stopped"
+        else:
+            # 跳过永久失败的章节，其余章节按顺序全部写出
+            close_writer(flush_all=True)
+            summary["status"] = "incomplete" if retry.failed else "completed"
+        if rebuild_order and success_count:
+            # 新下载的章节都追加在了TXT末尾，插在目录中间的章节需要从缓存按目录顺序再重建一次
+            journal.close()
+            print("正在按目录顺序重建TXT...")
+            rebuild_txt(book_id, save_path)
+            journal.load([ch["id"] for ch in chapters])
+        summary["downloaded"] = success_count
+        print(f"《{name}》下载{'已停止' if stop_event.is_set() else '完成'}！成功下载 {success_count} 个章节")
+        if retry.failed:
+            if indexed:
+                print(f"以下 {len(retry.failed)} 个章节多次重试后仍下载失败，再次运行时会重新下载并写入原来的位置：")
+            else:
+                print(f"以下 {len(retry.failed)} 个章节多次重试后仍下载失败，再次运行时会重新下载并追加到文件末尾"
+                      f"（之后可用 --rebuild-txt 按目录顺序重建）：")
+            for chapter in retry.failed:
+                print(f"  {chapter['title']}（{chapter['id']}）")
+        # TXT 已经边下载边写好，其他格式从章节缓存生成；索引书籍文件需要TXT时直接转换
+        formats = [fmt for fmt in CONFIG["export_formats"] if fmt != "txt"]
+        if indexed and "txt" in CONFIG["export_formats"] and not stop_event.is_set():
+            convert_book_to_txt(output_file_path)
+        if formats and not stop_event.is_set():
+            export_formats(book_id, save_path, formats)
 
     except Exception as e:
         print(f"运行过程中发生错误: {str(e)}")
-        # 在异常时也保存进度
-        if 'downloaded' in locals() and 'chapter_results' in locals():
-            write_downloaded_chapters_in_order()
-            save_status(save_path, downloaded)
+        summary["error"] = str(e)
+    finally:
+        # 正常结束、出错或被中断时都保存进度
+        if pipeline is not None:
+            pipeline.close()
+        close_writer()
+        if book is not None:
+            book.close()
+        if journal is not None:
+            journal.close()
+            done = sum(ch["id"] in journal.done for ch in chapters)
+            summary["done"] = done
+            summary["failed"] = len(chapters) - done
+        summary["elapsed"] = round(time.time() - started, 3)
+    return summary
+
+def print_metrics_summary():
+    """打印各环节的耗时统计"""
+    for name, hist in get_metrics().report()["histograms"].items():
+        print(f"耗时 {name}: {hist['count']} 次，合计 {hist['sum']:.3f} 秒，平均 {hist['avg'] * 1000:.1f} 毫秒，"
+              f"P90 {hist['p90'] * 1000:.1f} 毫秒，最大 {hist['max'] * 1000:.1f} 毫秒")
+
+def Run(book_id, save_path, update=False):
+    """交互式运行下载；update 为 True 时为非交互的增量更新模式"""
+    stop_event = threading.Event()
+    previous = install_stop_handler(stop_event)
+    try:
+        summary = download_book(book_id, save_path, update=update, interactive=not update, stop_event=stop_event)
+    finally:
+        restore_stop_handler(previous)
+    if summary["status"] in ("completed", "incomplete", "stopped"):
+        print_network_stats()
+        print_metrics_summary()
+    export_metrics(CONFIG["metrics_file"], CONFIG["metrics_prometheus_file"])
+    return summary
+
+def download_books(book_ids, save_path, update=False, jobs=None, progress=True, stop_event=None):
+    """同时下载多本书，共用连接池、密钥缓存、限速器和全局并发额度。
+    jobs 为同时进行的书籍数量，返回包含每本书结果的摘要（dict）"""
+    stop_event = stop_event or threading.Event()
+    jobs = max(1, jobs or CONFIG["book_workers"])
+    book_ids = list(OrderedDict.fromkeys(str(book_id) for book_id in book_ids))
+    started = time.time()
+    previous = install_stop_handler(stop_event)
+    try:
+        with ThreadPoolExecutor(max_workers=min(jobs, len(book_ids)) or 1) as executor:
+            futures = [
+                executor.submit(download_book, book_id, save_path, update=update, progress=progress, stop_event=stop_event)
+                for book_id in book_ids
+            ]
+            books = [future.result() for future in futures]
+    finally:
+        restore_stop_handler(previous)
+    export_metrics(CONFIG["metrics_file"], CONFIG["metrics_prometheus_file"])
+    return {
+        "books": books,
+        "ok": all(book["status"] in ("completed", "up_to_date") for book in books),
+        "elapsed": round(time.time() - started, 3),
+        "network": network_stats(),
+        "metrics": get_metrics().report()
+    }
+
+def rebuild_txt(book_id, save_path):
+    """不发送任何网络请求，从本地章节缓存重新生成TXT"""
+    result = export_book(book_id, save_path, ["txt"])
+    if result is None:
+        return False
+
+    # 进度与TXT保持一致，缺失的章节下次运行时会补下载
+    save_status(save_path, result["written"], book_id)
+    missing = result["missing"]
+    print(f"已从缓存重建《{result['name']}》：{len(result['written'])} 个章节" + (f"，缓存中缺少 {missing} 个章节" if missing else ""))
+    return True
+
+INVALID_FILENAME_RE = re.compile(r'[\\/:*?"<>|\x00-\x1f]+')
+
+def safe_filename(name, limit=80):
+    """替换文件名中不允许使用的字符"""
+    name = INVALID_FILENAME_RE.sub('_', name).strip(' .')
+    return name[:limit] or "未命名"
+
+def iter_cached_chapters(cache, chapters, chunk_size=500):
+    """按目录顺序逐块读取缓存中的章节，生成 (位置, 章节, 接口标题, 正文)；缓存中没有的章节跳过"""
+    for start in range(0, len(chapters), chunk_size):
+        chunk = chapters[start:start + chunk_size]
+        results = cache.get_many([ch["id"] for ch in chunk])
+        for pos, chapter in enumerate(chunk, start):
+            if chapter["id"] in results:
+                api_title, content = results[chapter["id"]]
+                yield pos, chapter, api_title, content
+
+class Exporter:
+    """导出格式的基类：先写入临时文件或目录，全部章节写完后再替换为正式输出"""
+    def __init__(self, book, output_path):
+        self.book = book
+        self.output_path = output_path
+        self.tmp_path = output_path + ".tmp"
+
+    def add(self, pos, chapter, api_title, content):
+        raise NotImplementedError
+
+    def finish(self):
+        pass
+
+    def close(self):
+        """完成导出，返回输出路径"""
+        self.finish()
+        if os.path.isdir(self.output_path):
+            shutil.rmtree(self.output_path)
+        os.replace(self.tmp_path, self.output_path)
+        return self.output_path
+
+    def abort(self):
+        """导出失败时删除临时输出"""
+        try:
+            self.finish()
+        except Exception:
+            pass
+        if os.path.isdir(self.tmp_path):
+            shutil.rmtree(self.tmp_path, ignore_errors=True)
+        elif os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def header(self):
+        return f"小说名: {self.book['name']}\n作者: {self.book['author']}\n内容简介: {self.book['description']}\n\n"
+
+class TxtExporter(Exporter):
+    """整本书一个TXT，格式与下载时生成的TXT相同"""
+    def __init__(self, book, save_path):
+        super().__init__(book, os.path.join(save_path, f"{book['name']}.txt"))
+        self.file = open(self.tmp_path, 'w', encoding='utf-8')
+        self.file.write(self.header())
+
+    def add(self, pos, chapter, api_title, content):
+        self.file.write(BookWriter.format_chapter(chapter, api_title, content))
+
+    def finish(self):
+        self.file.close()
+
+class ChapterSplitExporter(Exporter):
+    """每个章节一个TXT，文件名以目录序号开头，按文件名排序即为阅读顺序"""
+    def __init__(self, book, save_path):
+        super().__init__(book, os.path.join(save_path, f"{book['name']}_章节"))
+        os.makedirs(self.tmp_path, exist_ok=True)
+        self.width = max(4, len(str(len(book["chapters"]))))
+
+    def add(self, pos, chapter, api_title, content):
+        heading = chapter_heading(chapter, api_title)
+        file_name = f"{pos + 1:0{self.width}d} {safe_filename(heading)}.txt"
+        with open(os.path.join(self.tmp_path, file_name), 'w', encoding='utf-8') as f:
+            f.write(f"{heading}\n{content}\n")
+
+def chapter_volume(book, pos):
+    """章节所属的卷名；目录没有分卷信息时按 export_volume_size 个章节一卷"""
+    volume = book["chapters"][pos].get("volume")
+    if volume:
+        return volume
+    size = max(1, CONFIG["export_volume_size"])
+    start = pos // size * size
+    return f"第{start + 1}-{min(start + size, len(book['chapters']))}章"
+
+class VolumeSplitExporter(Exporter):
+    """每卷一个TXT，章节按顺序到达，卷名变化时换下一个文件"""
+    def __init__(self, book, save_path):
+        super().__init__(book, os.path.join(save_path, f"{book['name']}_分卷"))
+        os.makedirs(self.tmp_path, exist_ok=True)
+        self.volume = None
+        self.count = 0
+        self.file = None
+
+    def add(self, pos, chapter, api_title, content):
+        volume = chapter_volume(self.book, pos)
+        if volume != self.volume:
+            self.finish()
+            self.volume = volume
+            self.count += 1
+            file_name = f"{self.count:03d} {safe_filename(volume)}.txt"
+            self.file = open(os.path.join(self.tmp_path, file_name), 'w', encoding='utf-8')
+            self.file.write(f"小说名: {self.book['name']}\n{volume}\n\n")
+        self.file.write(BookWriter.format_chapter(chapter, api_title, content))
+
+    def finish(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+EPUB_CONTAINER = """<?xml version="1.0" encoding="utf-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>
+</container>
+"""
+
+EPUB_STYLE = """body { line-height: 1.6; }
+h1 { font-size: 1.4em; text-align: center; margin: 1em 0; }
+h2 { font-size: 1.2em; text-align: center; }
+p { text-indent: 2em; margin: 0.3em 0; }
+"""
+
+EPUB_PAGE = """<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="zh-CN" xml:lang="zh-CN">
+<head><meta charset="utf-8"/><title>{title}</title><link rel="stylesheet" type="text/css" href="../style.css"/></head>
+<body>
+{body}
+</body>
+</html>
+"""
+
+class EpubExporter(Exporter):
+    """EPUB 3（同时带 toc.ncx 兼容旧阅读器）：每个章节到达后立即压缩写入 zip，
+    内存中只保留目录所需的文件名和标题，最后写出目录和 content.opf"""
+    def __init__(self, book, save_path):
+        super().__init__(book, os.path.join(save_path, f"{book['name']}.epub"))
+        # 压缩级别 1 比默认级别快数倍，文件只大一成左右
+        self.zip = zipfile.ZipFile(self.tmp_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=1)
+        # mimetype 必须是第一个文件且不压缩
+        self.zip.writestr(zipfile.ZipInfo("mimetype"), "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        self.zip.writestr("META-INF/container.xml", EPUB_CONTAINER)
+        self.zip.writestr("OEBPS/style.css", EPUB_STYLE)
+        self.with_volumes = any(ch.get("volume") for ch in book["chapters"])
+        self.entries = []
+        paragraphs = "".join(f"<p>{html.escape(line.strip())}</p>" for line in book["description"].splitlines() if line.strip())
+        self.zip.writestr("OEBPS/Text/intro.xhtml", EPUB_PAGE.format(
+            title=html.escape(book["name"]),
+            body=f"<h1>{html.escape(book['name'])}</h1><p>作者: {html.escape(book['author'])}</p>{paragraphs}"
+        ))
+
+    def add(self, pos, chapter, api_title, content):
+        heading = chapter_heading(chapter, api_title)
+        file_name = f"Text/chapter_{len(self.entries) + 1:05d}.xhtml"
+        paragraphs = "\n".join(f"<p>{line.strip()}</p>" for line in html.escape(content, quote=False).split("\n") if line.strip())
+        self.zip.writestr("OEBPS/" + file_name, EPUB_PAGE.format(
+            title=html.escape(heading), body=f"<h1>{html.escape(heading)}</h1>\n{paragraphs}"
+        ))
+        self.entries.append((file_name, heading, chapter.get("volume") if self.with_volumes else None))
+
+    def toc_groups(self):
+        """按卷分组的目录 [(卷名或 None, [(文件名, 标题), ...]), ...]"""
+        groups = []
+        for file_name, heading, volume in self.entries:
+            if not groups or groups[-1][0] != volume:
+                groups.append((volume, []))
+            groups[-1][1].append((file_name, heading))
+        return groups
+
+    def nav(self):
+        items = []
+        for volume, entries in self.toc_groups():
+            links = "".join(f'<li><a href="{file_name}">{html.escape(heading)}</a></li>' for file_name, heading in entries)
+            if volume is None:
+                items.append(links)
+            else:
+                items.append(f'<li><a href="{entries[0][0]}">{html.escape(volume)}</a><ol>{links}</ol></li>')
+        body = f'<nav epub:type="toc" id="toc"><h2>目录</h2><ol><li><a href="Text/intro.xhtml">简介</a></li>{"".join(items)}</ol></nav>'
+        return EPUB_PAGE.format(title="目录", body=body).replace('href="../style.css"', 'href="style.css"')
+
+    def ncx(self):
+        points = ['<navPoint id="intro" playOrder="1"><navLabel><text>简介</text></navLabel><content src="Text/intro.xhtml"/></navPoint>']
+        order = 1
+        for number, (volume, entries) in enumerate(self.toc_groups()):
+            children = []
+            for file_name, heading in entries:
+                order += 1
+                children.append(f'<navPoint id="p{order}" playOrder="{order}"><navLabel><text>{html.escape(heading)}</text>'
+                                f'</navLabel><content src="{file_name}"/></navPoint>')
+            if volume is None:
+                points.extend(children)
+            else:
+                points.append(f'<navPoint id="v{number + 1}"><navLabel><text>{html.escape(volume)}</text></navLabel>'
+                              f'<content src="{entries[0][0]}"/>{"".join(children)}</navPoint>')
+        return ('<?xml version="1.0" encoding="utf-8"?>\n<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">'
+                f'<head><meta name="dtb:uid" content="urn:fanqie:{self.book["book_id"]}"/></head>'
+                f'<docTitle><text>{html.escape(self.book["name"])}</text></docTitle>'
+                f'<navMap>{"".join(points)}</navMap></ncx>')
+
+    def opf(self):
+        manifest = [
+            '<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>',
+            '<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>',
+            '<item id="style" href="style.css" media-type="text/css"/>',
+            '<item id="intro" href="Text/intro.xhtml" media-type="application/xhtml+xml"/>'
+        ]
+        spine = ['<itemref idref="intro"/>']
+        for number, (file_name, _, _) in enumerate(self.entries, 1):
+            manifest.append(f'<item id="c{number}" href="{file_name}" media-type="application/xhtml+xml"/>')
+            spine.append(f'<itemref idref="c{number}"/>')
+        modified = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        return ('<?xml version="1.0" encoding="utf-8"?>\n'
+                '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="book-id" xml:lang="zh-CN">'
+                '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+                f'<dc:identifier id="book-id">urn:fanqie:{self.book["book_id"]}</dc:identifier>'
+                f'<dc:title>{html.escape(self.book["name"])}</dc:title>'
+                f'<dc:creator>{html.escape(self.book["author"])}</dc:creator>'
+                f'<dc:description>{html.escape(self.book["description"])}</dc:description>'
+                f'<dc:language>zh-CN</dc:language><meta property="dcterms:modified">{modified}</meta></metadata>'
+                f'<manifest>{"".join(manifest)}</manifest><spine toc="ncx">{"".join(spine)}</spine></package>')
+
+    def finish(self):
+        if self.zip.fp is None:
+            return
+        self.zip.writestr("OEBPS/nav.xhtml", self.nav())
+        self.zip.writestr("OEBPS/toc.ncx", self.ncx())
+        self.zip.writestr("OEBPS/content.opf", self.opf())
+        self.zip.close()
+
+EXPORTERS = {
+    "txt": TxtExporter,
+    "epub": EpubExporter,
+    "chapters": ChapterSplitExporter,
+    "volumes": VolumeSplitExporter
+}
+
+def export_book(book_id, save_path, formats, cache=None):
+    """不联网，从章节缓存按目录顺序读取一遍，同时生成多种格式。
+    formats 为 EXPORTERS 中的格式名；cache 默认为本地章节缓存，也可以传入工作队列的共享存储。
+    返回 {"name", "outputs": {格式: 路径}, "written": [章节ID], "missing"}，缓存中没有这本书时返回 None"""
+    unknown = [fmt for fmt in formats if fmt not in EXPORTERS]
+    if unknown:
+        raise ValueError(f"不支持的导出格式: {', '.join(unknown)}")
+    cache = cache or get_chapter_cache()
+    if cache is None:
+        print("未启用章节缓存（cache_file），无法从本地缓存导出。")
+        return None
+    book = cache.load_book(book_id)
+    if not book:
+        print(f"本地缓存中没有小说 {book_id} 的章节目录，请先下载一次。")
+        return None
+
+    book["book_id"] = str(book_id)
+    os.makedirs(save_path, exist_ok=True)
+    exporters = {}
+    written = []
+    try:
+        for fmt in OrderedDict.fromkeys(formats):
+            exporters[fmt] = EXPORTERS[fmt](book, save_path)
+        with get_metrics().timer("export_seconds"):
+            for pos, chapter, api_title, content in iter_cached_chapters(cache, book["chapters"]):
+                for exporter in exporters.values():
+                    exporter.add(pos, chapter, api_title, content)
+                written.append(chapter["id"])
+            outputs = {fmt: exporter.close() for fmt, exporter in exporters.items()}
+    except Exception:
+        for exporter in exporters.values():
+            exporter.abort()
+        raise
+    return {
+        "name": book["name"],
+        "outputs": outputs,
+        "written": written,
+        "missing": len(book["chapters"]) - len(written)
+    }
+
+def export_formats(book_id, save_path, formats, cache=None):
+    """导出并打印结果，出错时只打印错误，返回是否成功"""
+    try:
+        result = export_book(book_id, save_path, formats, cache)
+    except Exception as e:
+        print(f"导出失败: {str(e)}")
+        return False
+    if result is None:
+        return False
+    for fmt, path in result["outputs"].items():
+        print(f"已导出 {fmt}: {path}")
+    if result["missing"]:
+        print(f"缓存中缺少 {result['missing']} 个章节，导出的文件中没有这些章节")
+    return True
+
+class WorkQueue:
+    """多台机器共享的章节下载队列（放在共享磁盘上的 SQLite 文件）：
+    章节以租约方式领取，租约到期未完成的章节会被其他节点重新领取，节点中途退出不会丢章节；
+    下载结果写入同一文件中的共享章节存储，由 finalize 按目录顺序生成TXT等格式"""
+    def __init__(self, path, lease_seconds=None, max_attempts=None):
+        self.path = path
+        self.lease_seconds = lease_seconds or CONFIG["queue_lease_seconds"]
+        self.max_attempts = max_attempts or CONFIG["retry_max_attempts"]
+        # 共享存储不淘汰章节，书籍生成之前必须一直保留
+        self.store = ChapterCache(path, float("inf"), journal_mode="DELETE")
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "item_id TEXT PRIMARY KEY, book_id TEXT, position INTEGER, state TEXT, owner TEXT, "
+            "lease_expires REAL, available_at REAL, attempts INTEGER, updated REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state, available_at)")
+
+    @contextmanager
+    def transaction(self):
+        """BEGIN IMMEDIATE 事务，多个进程同时操作时由 SQLite 的文件锁串行化"""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def add_book(self, book_id, name, author, description, chapters):
+        """加入一本书：保存目录，共享存储中还没有的章节加入队列；之前永久失败的章节重新排队。返回新加入的章节数"""
+        book_id = str(book_id)
+        self.store.save_book(book_id, name, author, description, chapters)
+        stored = self.store.get_many([ch["id"] for ch in chapters])
+        now = time.time()
+        with self.transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO jobs VALUES (?, ?, ?, 'pending', NULL, 0, 0, 0, ?)",
+                [(ch["id"], book_id, pos, now) for pos, ch in enumerate(chapters) if ch["id"] not in stored]
+            )
+            conn.execute(
+                "UPDATE jobs SET state = 'pending', attempts = 0, available_at = 0, updated = ? "
+                "WHERE book_id = ? AND state = 'failed'", (now, book_id)
+            )
+            return conn.total_changes - before
+
+    def lease(self, owner, limit):
+        """领取最多 limit 个章节（同一本书、按目录顺序），包括租约已过期的章节；返回 (书籍ID, [章节ID])"""
+        now = time.time()
+        with get_metrics().timer("queue_seconds", op="lease"), self.transaction() as conn:
+            row = conn.execute(
+                "SELECT book_id FROM jobs WHERE (state = 'pending' AND available_at <= ?) "
+                "OR (state = 'leased' AND lease_expires <= ?) ORDER BY available_at, position LIMIT 1", (now, now)
+            ).fetchone()
+            if not row:
+                return None, []
+            item_ids = [r[0] for r in conn.execute(
+                "SELECT item_id FROM jobs WHERE book_id = ? AND ((state = 'pending' AND available_at <= ?) "
+                "OR (state = 'leased' AND lease_expires <= ?)) ORDER BY position LIMIT ?", (row[0], now, now, limit)
+            )]
+            conn.executemany(
+                "UPDATE jobs SET state = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1, updated = ? "
+                "WHERE item_id = ?", [(owner, now + self.lease_seconds, now, item_id) for item_id in item_ids]
+            )
+        get_metrics().inc("queue_leased_total", len(item_ids))
+        return row[0], item_ids
+
+    def complete(self, owner, results):
+        """把下载结果写入共享存储并标记完成；租约过期后被其他节点重复下载的章节也可以直接覆盖"""
+        if not results:
+            return
+        self.store.put_many(results)
+        with get_metrics().timer("queue_seconds", op="complete"), self.transaction() as conn:
+            conn.executemany(
+                "UPDATE jobs SET state = 'done', owner = ?, updated = ? WHERE item_id = ?",
+                [(owner, time.time(), item_id) for item_id in results]
+            )
+
+    def fail(self, owner, item_ids):
+        """下载失败的章节按退避时间放回队列，超过最大尝试次数的记为永久失败；返回永久失败的章节ID"""
+        if not item_ids:
+            return []
+        now = time.time()
+        failed = []
+        jitter = random.uniform(0.5, 1.0)
+        with self.transaction() as conn:
+            for item_id in item_ids:
+                row = conn.execute(
+                    "SELECT attempts FROM jobs WHERE item_id = ? AND state = 'leased' AND owner = ?", (item_id, owner)
+                ).fetchone()
+                if not row:
+                    # 租约已过期并被其他节点领走
+                    continue
+                if row[0] >= self.max_attempts:
+                    failed.append(item_id)
+                    conn.execute("UPDATE jobs SET state = 'failed', updated = ? WHERE item_id = ?", (now, item_id))
+                else:
+                    conn.execute(
+                        "UPDATE jobs SET state = 'pending', available_at = ?, updated = ? WHERE item_id = ?",
+                        (now + retry_delay(row[0], jitter), now, item_id)
+                    )
+        get_metrics().inc("retries_total", len(item_ids) - len(failed), kind="queue")
+        return failed
+
+    def release(self, owner):
+        """节点正常退出时交还手上未完成的租约，不必等租约过期"""
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET state = 'pending', attempts = MAX(0, attempts - 1), updated = ? "
+                "WHERE state = 'leased' AND owner = ?", (time.time(), owner)
+            )
+
+    def counts(self, book_id=None):
+        """各状态的章节数，book_id 为空时统计全部书籍；返回 {书籍ID: {状态: 数量}}"""
+        with self.lock:
+            if book_id is None:
+                rows = self.conn.execute("SELECT book_id, state, COUNT(*) FROM jobs GROUP BY book_id, state").fetchall()
+            else:
+                rows = self.conn.execute(
+                    "SELECT book_id, state, COUNT(*) FROM jobs WHERE book_id = ? GROUP BY book_id, state", (str(book_id),)
+                ).fetchall()
+        counts = {}
+        for book, state, count in rows:
+            counts.setdefault(book, {"pending": 0, "leased": 0, "done": 0, "failed": 0})[state] = count
+        return counts
+
+    def unfinished(self):
+        """还有未完成（排队中或已被领取）的章节"""
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM jobs WHERE state IN ('pending', 'leased') LIMIT 1").fetchone() is not None
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+        self.store.close()
+
+def enqueue_books(queue_path, book_ids):
+    """获取章节目录和书籍信息，把章节加入共享队列"""
+    queue = WorkQueue(queue_path)
+    headers = get_headers()
+    try:
+        for book_id in book_ids:
+            chapters = get_chapters_from_api(book_id, headers)
+            if not chapters:
+                print(f"小说 {book_id} 未找到任何章节，已跳过")
+                continue
+            name, author_name, description = get_book_info(book_id, headers)
+            if not name:
+                name, author_name, description = f"未知小说_{book_id}", "未知作者", "无简介"
+            added = queue.add_book(book_id, name, author_name, description, chapters)
+            print(f"《{name}》已加入队列：{added} 个章节待下载，共 {len(chapters)} 章")
+    finally:
+        queue.close()
+
+def run_worker(queue_path, worker_id=None, stop_event=None, exit_when_idle=True):
+    """工作节点：不断从共享队列领取章节，走与普通下载相同的 down_text_batch 流程，结果写入共享存储。
+    exit_when_idle 为 True 时队列中没有未完成的章节就退出。返回本节点下载成功的章节数"""
+    stop_event = stop_event or threading.Event()
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    queue = WorkQueue(queue_path)
+    headers = get_headers()
+    batch_size = max(1, CONFIG["batch_size"])
+    done = 0
+    lock = threading.Lock()
+
+    def work():
+        nonlocal done
+        while not stop_event.is_set():
+            try:
+                book_id, item_ids = queue.lease(worker_id, batch_size)
+            except sqlite3.Error as e:
+                # 共享磁盘上的队列文件可能暂时被锁住或不可用，稍后再试
+                print(f"读取队列失败: {str(e)}")
+                stop_event.wait(CONFIG["queue_poll_interval"])
+                continue
+            if not item_ids:
+                if exit_when_idle and not queue.unfinished():
+                    return
+                # 其他节点正在下载的章节可能失败或租约过期后重新排队
+                stop_event.wait(CONFIG["queue_poll_interval"])
+                continue
+            try:
+                with get_download_slots():
+                    results = down_text_batch(item_ids, headers, book_id)
+            except Exception as e:
+                print(f"章节 {item_ids[0]} 等 {len(item_ids)} 个章节下载异常: {str(e)}")
+                results = {}
+            results = {item_id: results[item_id] for item_id in item_ids if item_id in results}
+            try:
+                queue.complete(worker_id, results)
+                for item_id in queue.fail(worker_id, [item_id for item_id in item_ids if item_id not in results]):
+                    print(f"章节 {item_id} 多次重试后仍下载失败，已跳过")
+            except sqlite3.Error as e:
+                # 没有记录下来的章节在租约过期后会重新下载
+                print(f"保存下载结果失败: {str(e)}")
+                continue
+            with lock:
+                done += len(results)
+
+    print(f"工作节点 {worker_id} 已启动，队列: {queue_path}")
+    previous = install_stop_handler(stop_event)
+    try:
+        with ThreadPoolExecutor(max_workers=CONFIG["max_workers"]) as executor:
+            for future in [executor.submit(work) for _ in range(CONFIG["max_workers"])]:
+                future.result()
+    finally:
+        restore_stop_handler(previous)
+        queue.release(worker_id)
+        queue.close()
+    print(f"工作节点 {worker_id} 结束，下载 {done} 个章节")
+    print_network_stats()
+    export_metrics(CONFIG["metrics_file"], CONFIG["metrics_prometheus_file"])
+    return done
+
+def finalize_books(queue_path, save_path, book_ids=None, formats=None, force=False):
+    """从共享存储按目录顺序生成书籍；book_ids 为空时处理队列中全部章节都已有结果的书。
+    还有章节未完成的书跳过，force 为 True 时仍然生成（缺少的章节不写入）。返回是否全部成功"""
+    queue = WorkQueue(queue_path)
+    ok = True
+    try:
+        counts = queue.counts()
+        for book_id in book_ids or list(counts):
+            book_counts = counts.get(str(book_id))
+            if book_counts is None:
+                print(f"队列中没有小说 {book_id}")
+                ok = False
+                continue
+            unfinished = book_counts["pending"] + book_counts["leased"]
+            if unfinished and not force:
+                print(f"小说 {book_id} 还有 {unfinished} 个章节未完成，暂不生成")
+                ok = False
+                continue
+            if book_counts["failed"]:
+                print(f"小说 {book_id} 有 {book_counts['failed']} 个章节下载失败，生成的文件中没有这些章节")
+            ok = export_formats(book_id, save_path, formats or CONFIG["export_formats"] or ["txt"], queue.store) and ok
+    finally:
+        queue.close()
+    return ok
+
+def print_queue_status(queue_path):
+    queue = WorkQueue(queue_path)
+    try:
+        for book_id, counts in queue.counts().items():
+            print(f"{book_id}: 待下载 {counts['pending']}，下载中 {counts['leased']}，完成 {counts['done']}，失败 {counts['failed']}")
+    finally:
+        queue.close()
+
+def parse_book_id(text):
+    """从小说ID或详情页链接中取出小说ID，无法识别时返回 None"""
+    text = text.strip()
+    match = re.search(r'/page/(\d+)', text)
+    if match:
+        return match.group(1)
+    return text if text.isdigit() else None
+
+def read_book_ids(path):
+    """读取小说ID列表文件：每行一个ID或详情页链接，# 开头的行为注释"""
+    book_ids = []
+    with (sys.stdin if path == "-" else open(path, 'r', encoding='utf-8')) as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            book_id = parse_book_id(line)
+            if book_id is None:
+                print(f"无法识别的小说ID，已跳过: {line}")
+                continue
+            book_ids.append(book_id)
+    return book_ids
+
+def write_summary(summary, path):
+    """输出 JSON 格式的下载摘要，path 为 - 时输出到标准输出"""
+    text = json.dumps(summary, ensure_ascii=False, indent=2)
+    if path == "-":
+        print(text)
+        return
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text + "\n")
 
 def main():
+    parser = argparse.ArgumentParser(description="番茄小说下载器精简版")
+    parser.add_argument("book_ids", metavar="小说ID", nargs="*", help="要下载的小说ID或详情页链接，可以有多个；不指定时进入交互模式")
+    parser.add_argument("-f", "--file", action="append", default=[], help="从文件读取小说ID，每行一个（- 表示标准输入）")
+    parser.add_argument("--rebuild-txt", metavar="小说ID", help="不联网，从本地章节缓存重新生成TXT")
+    parser.add_argument("--export", metavar="小说ID", help="不联网，从本地章节缓存导出 --formats 指定的格式")
+    parser.add_argument("--formats", default=None,
+                        help=f"导出格式，逗号分隔：{', '.join(EXPORTERS)}；下载时指定会在下载完成后额外导出（--export 默认 epub）")
+    parser.add_argument("--book-format", choices=["txt", "tnb"], default=None,
+                        help="下载保存的格式：txt，或每章单独压缩、可随机读取的索引书籍文件 tnb")
+    parser.add_argument("--to-txt", metavar="文件", help="把 .tnb 索引书籍文件转换为TXT")
+    parser.add_argument("--queue", metavar="文件", default=None, help="多台机器共用的工作队列文件（放在共享磁盘上）")
+    parser.add_argument("--enqueue", action="store_true", help="把小说ID的全部章节加入 --queue 队列")
+    parser.add_argument("--worker", action="store_true", help="作为工作节点从 --queue 队列领取章节下载，队列为空时退出")
+    parser.add_argument("--finalize", action="store_true",
+                        help="从 --queue 队列的下载结果按顺序生成书籍（不指定小说ID时处理全部已完成的书）")
+    parser.add_argument("--force", action="store_true", help="与 --finalize 一起使用：有章节未完成时也生成")
+    parser.add_argument("--queue-status", action="store_true", help="显示 --queue 队列中各书的进度")
+    parser.add_argument("--update", metavar="小说ID", nargs="*", help="增量更新：只下载新章节并追加到已有TXT")
+    parser.add_argument("--save-path", default=None, help="保存路径（默认当前目录）")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help=f"同时下载的书籍数量（默认 {CONFIG['book_workers']}）")
+    parser.add_argument("--max-workers", type=int, default=None, help=f"所有书籍共用的并发请求数（默认 {CONFIG['max_workers']}）")
+    parser.add_argument("--engine", choices=["thread", "async"], default=None, help="下载引擎")
+    parser.add_argument("--summary", metavar="文件", default=None, help="把 JSON 格式的下载摘要写入文件（- 表示标准输出）")
+    parser.add_argument("--no-progress", action="store_true", help="不显示进度条")
+    parser.add_argument("--metrics", metavar="文件", default=None, help="下载结束后把各环节的耗时、流量和重试统计写成 JSON")
+    parser.add_argument("--prometheus", metavar="文件", default=None, help="同时导出 Prometheus 文本格式的性能指标")
+    parser.add_argument("--config", metavar="文件", default=None, help=f"JSON 配置文件（默认读取 {CONFIG_FILE}）")
+    args = parser.parse_args()
+
+    try:
+        load_config(args.config)
+    except Exception as e:
+        parser.error(f"读取配置文件失败: {str(e)}")
+
+    if args.max_workers:
+        CONFIG["max_workers"] = args.max_workers
+    if args.metrics:
+        CONFIG["metrics_file"] = args.metrics
+    if args.prometheus:
+        CONFIG["metrics_prometheus_file"] = args.prometheus
+    if args.engine:
+        CONFIG["engine"] = args.engine
+    if args.book_format:
+        CONFIG["book_format"] = args.book_format
+    save_path = args.save_path or os.getcwd()
+    if args.formats is not None:
+        formats = [fmt.strip() for fmt in args.formats.split(",") if fmt.strip()]
+        unknown = [fmt for fmt in formats if fmt not in EXPORTERS]
+        if unknown:
+            parser.error(f"不支持的导出格式: {', '.join(unknown)}")
+        CONFIG["export_formats"] = formats
+
+    if args.export:
+        sys.exit(0 if export_formats(args.export, save_path, CONFIG["export_formats"] or ["epub"]) else 1)
+
+    if args.rebuild_txt:
+        sys.exit(0 if rebuild_txt(args.rebuild_txt, save_path) else 1)
+
+    if args.to_txt:
+        try:
+            convert_book_to_txt(args.to_txt, args.save_path)
+        except Exception as e:
+            print(f"转换失败: {str(e)}")
+            sys.exit(1)
+        return
+
+    book_ids = []
+    for text in args.book_ids + (args.update or []):
+        book_id = parse_book_id(text)
+        if book_id is None:
+            parser.error(f"无法识别的小说ID: {text}")
+        book_ids.append(book_id)
+    for path in args.file:
+        book_ids.extend(read_book_ids(path))
+
+    if args.enqueue or args.worker or args.finalize or args.queue_status:
+        if not args.queue:
+            parser.error("--enqueue/--worker/--finalize/--queue-status 需要同时指定 --queue")
+        if args.enqueue:
+            if not book_ids:
+                parser.error("--enqueue 需要小说ID")
+            enqueue_books(args.queue, book_ids)
+        if args.worker:
+            try:
+                run_worker(args.queue)
+            except KeyboardInterrupt:
+                sys.exit(130)
+        ok = True
+        if args.finalize:
+            ok = finalize_books(args.queue, save_path, book_ids, force=args.force)
+        if args.queue_status:
+            print_queue_status(args.queue)
+        sys.exit(0 if ok else 1)
+
+    if book_ids:
+        try:
+            summary = download_books(
+                book_ids, save_path,
+                update=args.update is not None,
+                jobs=args.jobs,
+                progress=not args.no_progress
+            )
+        except KeyboardInterrupt:
+            sys.exit(130)
+        for book in summary["books"]:
+            print(f"{book['book_id']} 《{book['name'] or '未知'}》: {book['status']}，"
+                  f"已完成 {book['done']}/{book['total']} 章，本次下载 {book['downloaded']} 章")
+        if args.summary:
+            write_summary(summary, args.summary)
+        sys.exit(0 if summary["ok"] else 1)
+    if args.update is not None or args.file:
+        print("没有需要下载的小说ID")
+        sys.exit(1)
+
     print("""欢迎使用番茄小说下载器精简版！
 作者：Dlmos（Dlmily）
 当前版本：v1.6.6.4
 Github：https://github.com/Dlmily/Tomato-Novel-Downloader-Lite
 赞助/了解新产品：https://afdian.com/a/dlbaokanluntanos
-*使用前须知*：开始下载之后，您可能会过于着急而查看下载文件的位置，这是徒劳的，请耐心等待小说下载完成再查看！另外如果你要下载之前已经下载过的小说(在此之前已经删除了原txt文件)，那么你有可能会遇到"所有章节已是最新，无需下载"的情况，这时就请删除掉chapter.json，然后再次运行程序。
+*使用前须知*：开始下载之后，您可能会过于着急而查看下载文件的位置，这是徒劳的，请耐心等待小说下载完成再查看！另外如果你要下载之前已经下载过的小说(在此之前已经删除了原txt文件)，那么你有可能会遇到"所有章节已是最新，无需下载"的情况，这时可以运行 python 2.py --rebuild-txt 小说ID --save-path 保存路径 直接从本地章节缓存重建txt（无需联网），或者删除掉保存目录下的chapter_小说ID.json和chapter_小说ID.journal，然后再次运行程序。
 
 另：如果有另外的api，按照您的意愿投到“Issues”页中。
 ------------------------------------------""")
     
     while True:
-        book_id = input("请输入小说ID（输入q退出）：").strip()
-        if book_id.lower() == 'q':
+        try:
+            book_id = input("请输入小说ID（输入q退出）：").strip()
+            if book_id.lower() == 'q':
+                break
+
+            save_path = input("保存路径（留空为当前目录）：").strip() or os.getcwd()
+        except (KeyboardInterrupt, EOFError):
+            print()
             break
-            
-        save_path = input("保存路径（留空为当前目录）：").strip() or os.getcwd()
         
         try:
             Run(book_id, save_path)
@@ -571,4 +3714,8 @@ Github：https://github.com/Dlmily/Tomato-Novel-Downloader-Lite
         print("\n" + "="*50 + "\n")
 
 if __name__ == "__main__":
+    if getattr(sys, "frozen", False):
+        # 打包后的程序在子进程中运行解密进程池时需要
+        import multiprocessing
+        multiprocessing.freeze_support()
     main()
\ No newline at end of file
@@ -0,0 +1,1060 @@
+"""番茄小说下载器性能测试
+
+用法：
+    python bench.py sanitize [--chapters 2000] [--repeat 3]
+    python bench.py e2e [--chapters 100 1000 10000] [--latency 0.02] [--error-rate 0.05] [--book-format tnb] [--json result.json]
+    python bench.py identities [--counts 1 2 4] [--identity-qps 5] [--bad 1]
+    python bench.py queue [--nodes 1 2 4] [--node-rate 4] [--kill]
+    python bench.py bad-chapters [--chapters 200] [--bad 7 150]
+    python bench.py metadata [--page-kb 200]
+    python bench.py export [--chapters 5000]
+    python bench.py startup [--runs 10]
+"""
+import argparse
+import base64
+import gzip
+import importlib.util
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from urllib.parse import urlparse
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_downloader():
+    """以模块方式加载 2.py"""
+    spec = importlib.util.spec_from_file_location("tomato_downloader", os.path.join(ROOT, "2.py"))
+    module = importlib.util.module_from_spec(spec)
+    # 注册到 sys.modules，进程池才能按模块名找到其中的函数
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# ---------------------------------------------------------------------------
+# 测试数据
+# ---------------------------------------------------------------------------
+
+SAMPLE_CHARS = (
+    "的一是在不了有和人这中大为上个我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说"
+    "产种面而方后多定行学法所民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当"
+    "使点从业本去把性好应开它合还因由其些然前外天政四日那社义事平形相全表间样与关各重新线内数正心反"
+)
+PUNCTUATION = "，。！？；：“”"
+
+
+def make_paragraph(rng):
+    length = rng.randint(20, 150)
+    text = "".join(rng.choice(SAMPLE_CHARS) for _ in range(length))
+    return text + rng.choice(PUNCTUATION)
+
+
+def make_chapter_html(rng, index, fmt):
+    """生成与各接口返回格式一致的章节HTML"""
+    paragraphs = "".join(
+        f'<p idx="{i}">{make_paragraph(rng)}</p>' for i in range(rng.randint(30, 90))
+    )
+    return wrap_chapter_html(index, paragraphs, fmt)
+
+
+def wrap_chapter_html(index, paragraphs, fmt):
+    title = f"第{index + 1}章 测试章节{index + 1}"
+    if fmt == "official":
+        html = (
+            '<?xml version="1.0" encoding="utf-8"?><html><head><meta charset="utf-8"/>'
+            f'<title>{title}</title></head><body><header><div class="tt-title">{title}</div>'
+            f'</header><article>{paragraphs}</article><footer><div>本章完</div></footer></body></html>'
+        )
+    elif fmt == "cenguigui":
+        html = f'<header><div class="tt-title">{title}</div></header><article>{paragraphs}</article>'
+    else:
+        html = paragraphs
+    return title, html
+
+
+def make_corpus(count, fmt, seed=2024):
+    rng = random.Random(seed)
+    return [make_chapter_html(rng, i, fmt) for i in range(count)]
+
+
+# ---------------------------------------------------------------------------
+# 章节内容清洗
+# ---------------------------------------------------------------------------
+
+def legacy_official(chapter_title, content):
+    """优化前官方API的清洗流程"""
+    if chapter_title and re.match(r'^第[0-9]+章', chapter_title):
+        chapter_title = re.sub(r'^第[0-9]+章\s*', '', chapter_title)
+    content = re.sub(r'<header>.*?</header>', '', content, flags=re.DOTALL)
+    content = re.sub(r'<footer>.*?</footer>', '', content, flags=re.DOTALL)
+    content = re.sub(r'</?article>', '', content)
+    content = re.sub(r'<p[^>]*>', '\n    ', content)
+    content = re.sub(r'</p>', '', content)
+    content = re.sub(r'<[^>]+>', '', content)
+    content = re.sub(r'\\u003c|\\u003e', '', content)
+    if chapter_title and content.startswith(chapter_title):
+        content = content[len(chapter_title):].lstrip()
+    content = re.sub(r'\n{3,}', '\n\n', content).strip()
+    lines = [line.strip() for line in content.split('\n') if line.strip()]
+    return chapter_title, '\n'.join(['    ' + line for line in lines])
+
+
+def legacy_cenguigui(chapter_title, content):
+    """优化前 api.cenguigui.cn 的清洗流程"""
+    content = re.sub(r'<header>.*?</header>', '', content, flags=re.DOTALL)
+    content = re.sub(r'<footer>.*?</footer>', '', content, flags=re.DOTALL)
+    content = re.sub(r'</?article>', '', content)
+    content = re.sub(r'<p idx="\d+">', '\n', content)
+    content = re.sub(r'</p>', '\n', content)
+    content = re.sub(r'<[^>]+>', '', content)
+    content = re.sub(r'\\u003c|\\u003e', '', content)
+    if chapter_title and content.startswith(chapter_title):
+        content = content[len(chapter_title):].lstrip()
+    content = re.sub(r'\n{2,}', '\n', content).strip()
+    return chapter_title, '\n'.join(['    ' + line if line.strip() else line for line in content.split('\n')])
+
+
+def legacy_lsjk(chapter_title, content):
+    """优化前 lsjk.zyii.xyz 的清洗流程"""
+    paragraphs = re.findall(r'<p idx="\d+">(.*?)</p>', content)
+    cleaned_content = "\n".join(p.strip() for p in paragraphs if p.strip())
+    return chapter_title, '\n'.join('    ' + line if line.strip() else line
+                                    for line in cleaned_content.split('\n'))
+
+
+def bench_sanitize(args):
+    downloader = load_downloader()
+    cases = {
+        "official": (legacy_official, downloader.process_official_content),
+        "cenguigui": (legacy_cenguigui, lambda t, c: (t, downloader.sanitize_content(c, t))),
+        "lsjk": (legacy_lsjk, lambda t, c: (t, downloader.sanitize_content(c, paragraphs_only=True))),
+    }
+    print(f"章节数: {args.chapters}, 重复: {args.repeat}")
+    for fmt, (legacy, current) in cases.items():
+        corpus = make_corpus(args.chapters, fmt)
+        size = sum(len(html.encode('utf-8')) for _, html in corpus)
+
+        mismatches = sum(legacy(t, html) != current(t, html) for t, html in corpus)
+
+        timings = {}
+        for name, func in (("legacy", legacy), ("current", current)):
+            best = float('inf')
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                for title, html in corpus:
+                    func(title, html)
+                best = min(best, time.perf_counter() - start)
+            timings[name] = best
+
+        print(
+            f"{fmt:10s} {size / 1024 / 1024:7.1f} MB  "
+            f"旧: {timings['legacy']:.3f}s ({args.chapters / timings['legacy']:.0f} 章/秒)  "
+            f"新: {timings['current']:.3f}s ({args.chapters / timings['current']:.0f} 章/秒)  "
+            f"加速 {timings['legacy'] / timings['current']:.2f}x  输出不一致: {mismatches}"
+        )
+
+
+# ---------------------------------------------------------------------------
+# 本地模拟服务器
+# ---------------------------------------------------------------------------
+
+MOCK_KEY = "5f" * 16
+VOLUME_SIZE = 100
+PAGE_PADDING = "<script>var filler='" + "x" * 1024 + "';</script>\n"
+
+
+def make_book_page(book_id, page_kb):
+    """模拟详情页：头部和末尾是脚本，书籍信息在中间，末尾带有内嵌的页面数据"""
+    state = json.dumps({"page": {
+        "bookId": book_id, "bookName": f"测试小说{book_id}", "author": "测试作者", "abstract": "这是一本用于性能测试的小说。"
+    }}, ensure_ascii=False)
+    return (
+        f"<html><head><title>测试小说{book_id}</title>" + PAGE_PADDING * (page_kb // 2) + "</head><body>"
+        + f'<div class="info"><h1>测试小说{book_id}</h1><div class="author-name">'
+        + '<span class="author-name-text">测试作者</span></div></div>'
+        + '<div class="page-abstract-content"><p>这是一本用于性能测试的小说。</p></div>'
+        + PAGE_PADDING * (page_kb - page_kb // 2)
+        + f"<script>window.__INITIAL_STATE__={state};</script></body></html>"
+    )
+
+
+def chapter_id(book_id, index):
+    return f"{book_id}{index:06d}"
+
+
+def split_chapter_id(item_id):
+    return item_id[:-6], int(item_id[-6:])
+
+
+class MockState:
+    """模拟服务器的配置和请求计数，在服务器进程内使用"""
+    def __init__(self, books, latency, jitter, error_rate, throttle_rate, qps, page_kb,
+                 identity_qps=0, bad_identities=(), bad_chapters=(), seed=2024):
+        # 正文从预先生成的段落中轮流取用，避免服务器生成数据的开销影响测试结果
+        rng = random.Random(seed)
+        self.paragraphs = [
+            "".join(f'<p idx="{i}">{make_paragraph(rng)}</p>' for i in range(rng.randint(30, 90)))
+            for _ in range(64)
+        ]
+        self.books = books
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.qps = qps
+        self.page_kb = page_kb
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.tokens = qps
+        self.updated = time.monotonic()
+        self.identity_qps = identity_qps
+        self.bad_identities = set(bad_identities)
+        self.identity_tokens = {}
+        self.bad_chapters = set(bad_chapters)
+
+    def chapter_html(self, item_id, fmt):
+        index = split_chapter_id(item_id)[1]
+        return wrap_chapter_html(index, self.paragraphs[index % len(self.paragraphs)], fmt)
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def admit(self):
+        """按配置的延迟、错误率和每秒请求上限决定响应：返回 None 表示正常，否则为状态码"""
+        with self.lock:
+            delay = max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter))
+            status = None
+            if self.qps:
+                now = time.monotonic()
+                self.tokens = min(self.qps, self.tokens + (now - self.updated) * self.qps)
+                self.updated = now
+                if self.tokens < 1:
+                    status = 429
+                else:
+                    self.tokens -= 1
+            if status is None and self.rng.random() < self.throttle_rate:
+                status = 429
+            elif status is None and self.rng.random() < self.error_rate:
+                status = 500
+        if delay:
+            time.sleep(delay)
+        return status
+
+    def admit_identity(self, install_id):
+        """按设备身份限流：失效的身份与官方接口一样返回 HTTP 200 和非 0 的 code（这里返回 110），
+        超过每个身份的每秒上限返回 429，否则返回 None"""
+        if install_id in self.bad_identities:
+            return 110
+        if not self.identity_qps:
+            return None
+        with self.lock:
+            now = time.monotonic()
+            tokens, updated = self.identity_tokens.get(install_id, (self.identity_qps, now))
+            tokens = min(self.identity_qps, tokens + (now - updated) * self.identity_qps)
+            if tokens < 1:
+                self.identity_tokens[install_id] = (tokens, now)
+                return 429
+            self.identity_tokens[install_id] = (tokens - 1, now)
+        return None
+
+
+def make_mock_handler(state, downloader):
+    import http.server
+    import urllib.parse
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def handle(self):
+            try:
+                super().handle()
+            except (BrokenPipeError, ConnectionResetError):
+                # 客户端关闭了连接池中的空闲连接
+                pass
+
+        def send_body(self, body, status=200, content_type="application/json"):
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                # 客户端读到需要的内容后提前断开
+                self.close_connection = True
+
+        def send_json(self, obj):
+            self.send_body(json.dumps(obj, ensure_ascii=False))
+
+        def route(self, name, identity=False):
+            """记录请求并按配置注入错误，需要中止时返回 False；identity 为 True 时还按设备身份限流"""
+            state.count(name)
+            status = state.admit()
+            if status is None and identity:
+                cookie = self.headers.get("Cookie", "")
+                match = re.search(r'install_id=(\d+)', cookie)
+                status = state.admit_identity(match.group(1) if match else "")
+            if status is None:
+                return True
+            state.count(f"{name}:{status}")
+            if status == 110:
+                self.send_json({"code": 110, "message": "illegal access", "data": {}})
+            else:
+                self.send_body(b"", status)
+            return False
+
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            query = urllib.parse.parse_qs(url.query)
+            if url.path == "/__stats":
+                with state.lock:
+                    return self.send_json(dict(state.counts))
+            if url.path == "/__reset":
+                with state.lock:
+                    state.counts.clear()
+                return self.send_json({})
+            if url.path == "/api/reader/directory/detail":
+                if not self.route("directory"):
+                    return
+                book_id = query["bookId"][0]
+                count = state.books.get(book_id, 0)
+                item_ids = [chapter_id(book_id, i) for i in range(count)]
+                return self.send_json({
+                    "code": 0,
+                    "data": {
+                        "allItemIds": item_ids,
+                        "volumeNameList": [f"第{n + 1}卷" for n in range(-(-count // VOLUME_SIZE))],
+                        "chapterListWithVolume": [
+                            [{"itemId": item_id} for item_id in item_ids[start:start + VOLUME_SIZE]]
+                            for start in range(0, count, VOLUME_SIZE)
+                        ]
+                    }
+                })
+            if url.path.startswith("/page/"):
+                if not self.route("page"):
+                    return
+                book_id = url.path.rsplit("/", 1)[-1]
+                return self.send_body(make_book_page(book_id, state.page_kb), content_type="text/html; charset=utf-8")
+            if url.path == "/reading/reader/batch_full/v":
+                if not self.route("batch_full", identity=True):
+                    return
+                crypto = downloader.FqCrypto(MOCK_KEY)
+                data = {}
+                for item_id in query["item_ids"][0].split(","):
+                    # 无法下载的章节：官方接口的响应中不包含该章节
+                    if item_id in state.bad_chapters:
+                        continue
+                    title, html = state.chapter_html(item_id, "official")
+                    iv = os.urandom(16)
+                    encrypted = crypto.encrypt(gzip.compress(html.encode('utf-8'), 1), iv)
+                    data[item_id] = {"title": title, "content": base64.b64encode(iv + encrypted).decode()}
+                return self.send_json({"code": 0, "data": data})
+            # 备用API：路径中带上原主机名，下载器按主机名选择解析方式
+            if url.path.startswith("/api.cenguigui.cn/"):
+                if not self.route("cenguigui"):
+                    return
+                item_id = query["item_id"][0]
+                if item_id in state.bad_chapters:
+                    return self.send_body(b"", 500)
+                title, html = state.chapter_html(item_id, "cenguigui")
+                return self.send_json({"code": 200, "data": {"title": title, "content": html}})
+            if url.path.startswith("/lsjk.zyii.xyz/"):
+                if not self.route("lsjk"):
+                    return
+                item_id = query["item_id"][0]
+                if item_id in state.bad_chapters:
+                    return self.send_body(b"", 500)
+                title, html = state.chapter_html(item_id, "lsjk")
+                return self.send_json({"data": {"title": title, "content": html}})
+            self.send_body(b"", 404)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if urllib.parse.urlparse(self.path).path != "/reading/crypt/registerkey":
+                return self.send_body(b"", 404)
+            if not self.route("registerkey", identity=True):
+                return
+            iv = os.urandom(16)
+            encrypted = downloader.FqCrypto(downloader.grk()).encrypt(bytes.fromhex(MOCK_KEY), iv)
+            self.send_json({"code": 0, "data": {"key": base64.b64encode(iv + encrypted).decode()}})
+
+    return Handler
+
+
+def serve_mock(settings, port_queue):
+    """在子进程中运行模拟服务器，把端口号放入 port_queue"""
+    import http.server
+    state = MockState(**settings)
+    downloader = load_downloader()
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), make_mock_handler(state, downloader))
+    server.daemon_threads = True
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+def start_mock_server(settings):
+    """启动模拟服务器进程，settings 为 MockState 的参数，返回 (进程, 基础URL)"""
+    import multiprocessing
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve_mock, args=(settings, port_queue), daemon=True)
+    process.start()
+    return process, f"http://127.0.0.1:{port_queue.get(timeout=60)}"
+
+
+def mock_request(base_url, path):
+    import urllib.request
+    with urllib.request.urlopen(base_url + path, timeout=10) as response:
+        return json.loads(response.read())
+
+
+# ---------------------------------------------------------------------------
+# 端到端下载
+# ---------------------------------------------------------------------------
+
+def make_identities(count):
+    """生成测试用的设备身份"""
+    return [
+        {"install_id": str(4427064614339001 + i * 7919), "server_device_id": str(4427064614334905 + i * 7919)}
+        for i in range(count)
+    ]
+
+
+def peak_rss_mb():
+    """当前进程的峰值内存（MB），不支持的平台返回 None"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位为 KB，macOS 为字节
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def run_e2e_child(args):
+    """在独立进程中下载一本模拟书籍，最后一行输出 JSON 结果"""
+    import contextlib
+    import io
+    import tempfile
+
+    downloader = load_downloader()
+    config = downloader.CONFIG
+    config["official_api"]["base_url"] = args.base_url
+    config["web_base_url"] = args.base_url
+    config["api_endpoints"] = [
+        args.base_url + "/api.cenguigui.cn/api/tomato/content.php?item_id={chapter_id}",
+        args.base_url + "/lsjk.zyii.xyz/content?item_id={chapter_id}"
+    ]
+    config["engine"] = args.engine
+    config["max_workers"] = args.max_workers
+    config["batch_size"] = args.batch_size
+    config["decode_workers"] = args.decode_workers
+    config["key_cache_file"] = None
+    config["book_format"] = args.book_format
+    config["retry_max_attempts"] = args.retry_max_attempts
+    config["retry_base_delay"] = args.retry_delay
+    config["retry_max_delay"] = max(args.retry_delay, args.retry_max_delay)
+    config["circuit_open_seconds"] = args.circuit_open_seconds
+    host = urlparse(args.base_url).netloc
+    for name in ("official", "fanqienovel.com", "default", host):
+        config["rate_limits"][name] = {"rate": args.rate, "burst": max(1, int(args.rate))}
+    if args.identity_rate:
+        config["rate_limits"]["official"] = {"rate": args.identity_rate, "burst": max(1, int(args.identity_rate))}
+    if args.identities:
+        config["identities"] = make_identities(args.identity_start + args.identities)[args.identity_start:]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config["cache_file"] = None if args.no_cache else os.path.join(tmp_dir, "chapters.db")
+        output = io.StringIO()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(sys.stderr if args.verbose else output):
+            summary = downloader.download_book(args.book_id, os.path.join(tmp_dir, "out"), progress=False)
+        elapsed = time.perf_counter() - start
+        size = os.path.getsize(summary["output"]) if summary["output"] and os.path.exists(summary["output"]) else 0
+
+    report = downloader.get_metrics().report()
+    print(json.dumps({
+        "status": summary["status"],
+        "chapters": summary["done"],
+        "failed_ids": summary["failed_ids"],
+        "elapsed": round(elapsed, 3),
+        "chapters_per_second": round(summary["done"] / elapsed, 1) if elapsed else None,
+        "peak_rss_mb": peak_rss_mb(),
+        "output_mb": round(size / 1024 / 1024, 2),
+        "client_requests": sum(value for key, value in report["counters"].items() if key.startswith("http_responses_total")),
+        "retries": {key: value for key, value in report["counters"].items() if key.startswith("retries_total")},
+        "identities": downloader.network_stats()["identities"],
+        "stages": {key: hist["sum"] for key, hist in report["histograms"].items()}
+    }, ensure_ascii=False))
+
+
+def run_e2e_book(base_url, book_id, args, identities=None, identity_start=0):
+    """在子进程中下载一本模拟书籍，返回结果（含服务器端的请求统计），失败时返回 None"""
+    import subprocess
+
+    mock_request(base_url, "/__reset")
+    command = [
+        sys.executable, os.path.abspath(__file__), "e2e-child",
+        "--base-url", base_url, "--book-id", book_id,
+        "--engine", args.engine, "--max-workers", str(args.max_workers),
+        "--batch-size", str(args.batch_size), "--decode-workers", str(args.decode_workers),
+        "--rate", str(args.rate), "--identity-rate", str(args.identity_rate),
+        "--identities", str(args.identities if identities is None else identities),
+        "--identity-start", str(identity_start), "--book-format", args.book_format,
+        "--retry-max-attempts", str(args.retry_max_attempts), "--retry-delay", str(args.retry_delay),
+        "--retry-max-delay", str(args.retry_max_delay), "--circuit-open-seconds", str(args.circuit_open_seconds)
+    ] + (["--no-cache"] if args.no_cache else []) + (["--verbose"] if args.verbose else [])
+    completed = subprocess.run(command, stdout=subprocess.PIPE, text=True, encoding='utf-8', timeout=args.timeout)
+    if completed.returncode != 0 or not completed.stdout.strip():
+        return None
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    result["server_requests"] = mock_request(base_url, "/__stats")
+    return result
+
+
+def bench_e2e(args):
+    books = {f"9{count:08d}": count for count in args.chapters}
+    process, base_url = start_mock_server({
+        "books": books,
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "error_rate": args.error_rate,
+        "throttle_rate": args.throttle_rate,
+        "qps": args.server_qps,
+        "page_kb": args.page_kb
+    })
+    results = {}
+    try:
+        print(f"模拟服务器 {base_url}  延迟 {args.latency}s±{args.jitter}s  错误率 {args.error_rate}  "
+              f"429比例 {args.throttle_rate}  每秒上限 {args.server_qps or '无'}")
+        print(f"引擎 {args.engine}  max_workers {args.max_workers}  batch_size {args.batch_size}  "
+              f"decode_workers {args.decode_workers}  客户端限速 {args.rate}/s  格式 {args.book_format}")
+        for book_id, count in books.items():
+            result = run_e2e_book(base_url, book_id, args)
+            if result is None:
+                print(f"{count:6d} 章: 运行失败")
+                continue
+            results[str(count)] = result
+            print(
+                f"{count:6d} 章: {result['status']:9s} {result['elapsed']:8.2f}s  "
+                f"{result['chapters_per_second']:8.1f} 章/秒  峰值内存 {result['peak_rss_mb']} MB  输出 {result['output_mb']} MB  "
+                f"客户端请求 {result['client_requests']}  服务器 {json.dumps(result['server_requests'], ensure_ascii=False)}"
+            )
+            stages = sorted(result["stages"].items(), key=lambda item: -item[1])[:5]
+            print("        耗时最多: " + "  ".join(f"{name} {seconds:.2f}s" for name, seconds in stages))
+    finally:
+        process.terminate()
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        for count, result in results.items():
+            old = baseline.get(count)
+            if old and old.get("chapters_per_second") and result.get("chapters_per_second"):
+                ratio = result["chapters_per_second"] / old["chapters_per_second"]
+                print(f"{count:>6s} 章: 速度为基准的 {ratio:.2f} 倍" + ("  <-- 变慢" if ratio < 1 - args.tolerance else ""))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+def bench_bad_chapters(args):
+    """个别章节在官方接口和备用接口上都拿不到内容：所有接口熔断后半开探测仍然失败也要计入尝试次数，
+    下载应在有限时间内以 incomplete 结束，并在 failed_ids 中列出这些章节"""
+    import subprocess
+
+    book_id = f"8{args.chapters:08d}"
+    bad = sorted({chapter_id(book_id, index) for index in args.bad if 0 <= index < args.chapters})
+    process, base_url = start_mock_server({
+        "books": {book_id: args.chapters},
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "error_rate": 0.0,
+        "throttle_rate": 0.0,
+        "qps": 0,
+        "page_kb": 20,
+        "bad_chapters": bad
+    })
+    passed = True
+    try:
+        print(f"模拟服务器 {base_url}  {args.chapters} 章，无法下载: {', '.join(bad)}  "
+              f"最大尝试 {args.retry_max_attempts} 次  熔断 {args.circuit_open_seconds}s")
+        for engine in args.engines:
+            args.engine = engine
+            try:
+                result = run_e2e_book(base_url, book_id, args)
+            except subprocess.TimeoutExpired:
+                result = None
+                print(f"{engine:6s}: 超过 {args.timeout}s 仍未结束")
+            ok = (result is not None and result["status"] == "incomplete"
+                  and sorted(result["failed_ids"]) == bad and result["chapters"] == args.chapters - len(bad))
+            passed = passed and ok
+            if result is not None:
+                print(f"{engine:6s}: {'通过' if ok else '失败'}  状态 {result['status']}  完成 {result['chapters']} 章  "
+                      f"失败章节 {result['failed_ids']}  {result['elapsed']:.2f}s  "
+                      f"服务器 {json.dumps(result['server_requests'], ensure_ascii=False)}")
+    finally:
+        process.terminate()
+    if not passed:
+        sys.exit(1)
+
+
+# ---------------------------------------------------------------------------
+# 书籍信息解析
+# ---------------------------------------------------------------------------
+
+def legacy_book_info(page):
+    """优化前用 BeautifulSoup 解析详情页的流程"""
+    import bs4
+    soup = bs4.BeautifulSoup(page, 'html.parser')
+    name_element = soup.find('h1')
+    name = name_element.text if name_element else "未知书名"
+    author_name = "未知作者"
+    author_name_element = soup.find('div', class_='author-name')
+    if author_name_element:
+        author_name_span = author_name_element.find('span', class_='author-name-text')
+        if author_name_span:
+            author_name = author_name_span.text
+    description = "无简介"
+    description_element = soup.find('div', class_='page-abstract-content')
+    if description_element:
+        description_p = description_element.find('p')
+        if description_p:
+            description = description_p.text
+    return name, author_name, description
+
+
+def bench_metadata(args):
+    downloader = load_downloader()
+    page = make_book_page("7143038691944959011", args.page_kb)
+    size = len(page.encode('utf-8'))
+
+    def current(page):
+        info = downloader.extract_book_info(page)
+        return info.get("name", "未知书名"), info.get("author", "未知作者"), info.get("description", "无简介")
+
+    # 流式读取时找到全部字段就停止，这里按 16KB 分块模拟需要读取的字节数
+    data = page.encode('utf-8')
+    needed = len(data)
+    for end in range(16384, len(data) + 16384, 16384):
+        if len(downloader.extract_book_info(data[:end].decode('utf-8', 'ignore'))) == 3:
+            needed = min(end, len(data))
+            break
+
+    cases = [("current", current)]
+    try:
+        import bs4  # noqa: F401
+        cases.insert(0, ("legacy", legacy_book_info))
+    except ImportError:
+        print("未安装 beautifulsoup4，只测试新的解析方式")
+
+    print(f"详情页 {size / 1024:.0f} KB，流式读取到 {needed / 1024:.0f} KB 时已取得全部字段")
+    results = {}
+    for name, func in cases:
+        best = float('inf')
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            results[name] = func(page)
+            best = min(best, time.perf_counter() - start)
+        print(f"{name:8s} {best * 1000:8.2f} ms  {results[name]}")
+    if "legacy" in results:
+        print("输出一致" if results["legacy"] == results["current"] else "输出不一致！")
+
+
+# ---------------------------------------------------------------------------
+# 导出
+# ---------------------------------------------------------------------------
+
+def make_cached_book(downloader, book_id, count, seed=2024):
+    """把合成书籍写入章节缓存（正文取自预先生成的章节，按序号轮流使用）"""
+    rng = random.Random(seed)
+    texts = []
+    for i in range(64):
+        title, html = make_chapter_html(rng, i, "lsjk")
+        texts.append(downloader.sanitize_content(html, paragraphs_only=True))
+    chapters = [
+        {"id": chapter_id(book_id, i), "title": f"第{i + 1}章", "index": i, "volume": f"第{i // VOLUME_SIZE + 1}卷"}
+        for i in range(count)
+    ]
+    cache = downloader.get_chapter_cache()
+    for start in range(0, count, 500):
+        cache.put_many({
+            ch["id"]: (f"测试章节{ch['index'] + 1}", texts[ch["index"] % len(texts)])
+            for ch in chapters[start:start + 500]
+        })
+    cache.save_book(book_id, f"测试小说{book_id}", "测试作者", "这是一本用于性能测试的合成小说。", chapters)
+
+
+def output_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def bench_export(args):
+    import shutil
+    import tempfile
+    import tracemalloc
+
+    downloader = load_downloader()
+    book_id = "900005000"
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        downloader.CONFIG["cache_file"] = os.path.join(tmp_dir, "chapters.db")
+        start = time.perf_counter()
+        make_cached_book(downloader, book_id, args.chapters)
+        print(f"已生成 {args.chapters} 章的缓存书籍，耗时 {time.perf_counter() - start:.2f}s")
+
+        cases = [[fmt] for fmt in downloader.EXPORTERS] + [list(downloader.EXPORTERS)]
+        separate = 0.0
+        for formats in cases:
+            out_dir = os.path.join(tmp_dir, "out")
+            best = float('inf')
+            for _ in range(args.repeat):
+                shutil.rmtree(out_dir, ignore_errors=True)
+                start = time.perf_counter()
+                result = downloader.export_book(book_id, out_dir, formats)
+                best = min(best, time.perf_counter() - start)
+            # tracemalloc 会明显拖慢速度，内存峰值单独测一次
+            shutil.rmtree(out_dir, ignore_errors=True)
+            tracemalloc.start()
+            downloader.export_book(book_id, out_dir, formats)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            size = sum(output_size(path) for path in result["outputs"].values())
+            if len(formats) == 1:
+                separate += best
+            label = "+".join(formats)
+            print(f"{label:28s} {best:7.2f}s  {len(result['written']) / best:8.0f} 章/秒  "
+                  f"Python 内存峰值 {peak / 1024 / 1024:6.1f} MB  输出 {size / 1024 / 1024:7.1f} MB")
+        print(f"分别导出四种格式合计 {separate:.2f}s，一次读取同时导出 {best:.2f}s")
+        downloader.get_chapter_cache().close()
+
+
+# ---------------------------------------------------------------------------
+# 启动耗时
+# ---------------------------------------------------------------------------
+
+HEAVY_MODULES = ("requests", "bs4", "aiohttp", "asyncio", "tqdm", "Crypto", "fake_useragent", "multiprocessing", "urllib3")
+
+IMPORT_SNIPPET = (
+    "import importlib.util, sys, json;"
+    "spec = importlib.util.spec_from_file_location('tomato_downloader', {path!r});"
+    "module = importlib.util.module_from_spec(spec); spec.loader.exec_module(module);"
+    "{extra}"
+    "print(json.dumps(sorted({{name.split('.')[0] for name in sys.modules}} & set({heavy!r}))))"
+)
+
+
+def time_command(command, runs):
+    """多次运行命令，返回 (每次耗时列表, 最后一次的标准输出)"""
+    import subprocess
+    timings = []
+    output = ""
+    for _ in range(runs):
+        start = time.perf_counter()
+        completed = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, encoding='utf-8')
+        timings.append(time.perf_counter() - start)
+        output = completed.stdout
+    return timings, output
+
+
+def bench_startup(args):
+    import statistics
+    import tempfile
+
+    script = os.path.join(ROOT, "2.py")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config_path = os.path.join(tmp_dir, "config.json")
+        with open(config_path, 'w', encoding='utf-8') as f:
+            json.dump({"cache_file": os.path.join(tmp_dir, "chapters.db")}, f)
+        cases = [
+            ("python -c pass", [sys.executable, "-c", "pass"]),
+            ("import 2.py", [sys.executable, "-c", IMPORT_SNIPPET.format(path=script, extra="", heavy=HEAVY_MODULES)]),
+            ("import + get_headers()", [sys.executable, "-c", IMPORT_SNIPPET.format(
+                path=script, extra="module.get_headers();", heavy=HEAVY_MODULES)]),
+            ("2.py --help", [sys.executable, script, "--help"]),
+            ("2.py --rebuild-txt", [sys.executable, script, "--config", config_path,
+                                    "--rebuild-txt", "0", "--save-path", tmp_dir]),
+        ]
+        print(f"每项运行 {args.runs} 次")
+        for name, command in cases:
+            timings, output = time_command(command, args.runs)
+            loaded = ""
+            if output.strip().startswith("["):
+                loaded = "  已加载: " + (", ".join(json.loads(output.strip().splitlines()[-1])) or "无")
+            print(f"{name:24s} 最小 {min(timings) * 1000:7.1f} ms  中位数 {statistics.median(timings) * 1000:7.1f} ms{loaded}")
+
+
+def bench_identities(args):
+    """设备身份数量与吞吐量：模拟服务器按身份限流，部分身份失效"""
+    # 失效的身份排在所有正常身份之后，只在最后一项测试中使用
+    healthy = max(args.counts + [args.with_bad])
+    bad = [identity["install_id"] for identity in make_identities(healthy + args.bad)[healthy:]]
+    book_id = f"9{args.chapters:08d}"
+    process, base_url = start_mock_server({
+        "books": {book_id: args.chapters},
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "error_rate": 0.0,
+        "throttle_rate": 0.0,
+        "qps": 0,
+        "page_kb": 50,
+        "identity_qps": args.identity_qps,
+        "bad_identities": bad
+    })
+    if not args.identity_rate:
+        # 客户端按服务器给每个身份的额度限速
+        args.identity_rate = args.identity_qps
+    try:
+        print(f"模拟服务器 {base_url}  每个身份每秒 {args.identity_qps} 次  {args.chapters} 章  "
+              f"max_workers {args.max_workers}  batch_size {args.batch_size}")
+        cases = [(count, 0, 0) for count in args.counts]
+        if args.bad:
+            cases.append((args.with_bad + args.bad, args.bad, healthy - args.with_bad))
+        base = None
+        for count, bad_count, start in cases:
+            result = run_e2e_book(base_url, book_id, args, identities=count, identity_start=start)
+            label = f"{count} 个身份" + (f"（{bad_count} 个失效）" if bad_count else "")
+            if result is None:
+                print(f"{label:16s} 运行失败")
+                continue
+            base = base or result["chapters_per_second"]
+            benched = sum(stats["benched"] for stats in result["identities"].values())
+            print(f"{label:16s} {result['status']:9s} {result['elapsed']:7.2f}s  {result['chapters_per_second']:8.1f} 章/秒  "
+                  f"为 1 个身份的 {result['chapters_per_second'] / base:4.2f} 倍  暂停身份 {benched} 次  "
+                  f"服务器 {json.dumps(result['server_requests'], ensure_ascii=False)}")
+    finally:
+        process.terminate()
+
+
+def write_node_config(path, base_url, args, identity):
+    """工作节点的配置文件：指向模拟服务器，每个节点使用自己的设备身份和限速额度"""
+    host = urlparse(base_url).netloc
+    node_rate = {"rate": args.node_rate, "burst": max(1, int(args.node_rate))}
+    config = {
+        "official_api": {"base_url": base_url},
+        "web_base_url": base_url,
+        "api_endpoints": [
+            base_url + "/api.cenguigui.cn/api/tomato/content.php?item_id={chapter_id}",
+            base_url + "/lsjk.zyii.xyz/content?item_id={chapter_id}"
+        ],
+        "identities": [identity],
+        "rate_limits": {name: node_rate for name in ("official", "fanqienovel.com", "default", host)},
+        "max_workers": args.max_workers,
+        "batch_size": args.batch_size,
+        "cache_file": None,
+        "key_cache_file": None,
+        "queue_lease_seconds": args.lease_seconds,
+        "queue_poll_interval": 0.2
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(config, f)
+
+
+def start_queue_workers(tmp_dir, base_url, queue_path, args, count, first=0):
+    """启动 count 个工作节点进程，返回进程列表"""
+    import subprocess
+    workers = []
+    for index, identity in enumerate(make_identities(first + count)[first:], first):
+        config_path = os.path.join(tmp_dir, f"node{index}.json")
+        write_node_config(config_path, base_url, args, identity)
+        log = open(os.path.join(tmp_dir, f"node{index}.log"), 'w', encoding='utf-8')
+        workers.append(subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "2.py"), "--config", config_path, "--queue", queue_path, "--worker"],
+            stdout=log, stderr=subprocess.STDOUT
+        ))
+        log.close()
+    return workers
+
+
+def run_queue_case(downloader, base_url, book_id, args, nodes, kill):
+    """把一本书加入新队列，由 nodes 个节点下载；kill 为 True 时中途强制结束一个节点。
+    返回 (耗时, 完成章节数, 生成TXT的章节数, 各状态计数)"""
+    import signal
+    import subprocess
+    import tempfile
+
+    mock_request(base_url, "/__reset")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        queue_path = os.path.join(tmp_dir, "queue.db")
+        config_path = os.path.join(tmp_dir, "enqueue.json")
+        write_node_config(config_path, base_url, args, make_identities(1)[0])
+        subprocess.run(
+            [sys.executable, os.path.join(ROOT, "2.py"), "--config", config_path, "--queue", queue_path, "--enqueue", book_id],
+            stdout=subprocess.DEVNULL, check=True, timeout=120
+        )
+        start = time.perf_counter()
+        workers = start_queue_workers(tmp_dir, base_url, queue_path, args, nodes)
+        if kill:
+            # 等第一个节点下载了一部分后直接 SIGKILL，它手上的租约只能等过期后由其他节点领取
+            queue = downloader.WorkQueue(queue_path)
+            while sum(c["done"] for c in queue.counts().values()) < args.chapters // 4:
+                time.sleep(0.2)
+            queue.close()
+            workers[0].send_signal(signal.SIGKILL)
+        for worker in workers:
+            worker.wait(timeout=args.timeout)
+        elapsed = time.perf_counter() - start
+
+        queue = downloader.WorkQueue(queue_path)
+        try:
+            counts = queue.counts()[book_id]
+            with open(os.devnull, 'w') as devnull:
+                stdout, sys.stdout = sys.stdout, devnull
+                try:
+                    result = downloader.export_book(book_id, os.path.join(tmp_dir, "out"), ["txt"], queue.store)
+                finally:
+                    sys.stdout = stdout
+        finally:
+            queue.close()
+    return elapsed, counts["done"], len(result["written"]) if result else 0, counts
+
+
+def bench_queue(args):
+    """共享工作队列：节点数量与吞吐量，以及节点中途被强制结束时是否丢章节"""
+    downloader = load_downloader()
+    book_id = f"9{args.chapters:08d}"
+    process, base_url = start_mock_server({
+        "books": {book_id: args.chapters},
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "error_rate": args.error_rate,
+        "throttle_rate": 0.0,
+        "qps": 0,
+        "page_kb": 50
+    })
+    try:
+        print(f"模拟服务器 {base_url}  {args.chapters} 章  每个节点每秒 {args.node_rate} 次请求  "
+              f"max_workers {args.max_workers}  batch_size {args.batch_size}  租约 {args.lease_seconds}s")
+        cases = [(nodes, False) for nodes in args.nodes]
+        if args.kill:
+            cases.append((max(2, max(args.nodes)), True))
+        base = None
+        for nodes, kill in cases:
+            elapsed, done, written, counts = run_queue_case(downloader, base_url, book_id, args, nodes, kill)
+            speed = done / elapsed
+            base = base or speed
+            label = f"{nodes} 个节点" + ("（结束 1 个）" if kill else "")
+            print(f"{label:14s} {elapsed:7.2f}s  {speed:8.1f} 章/秒  为 1 个节点的 {speed / base:4.2f} 倍  "
+                  f"完成 {done}/{args.chapters}  生成TXT {written} 章  失败 {counts['failed']}  "
+                  f"服务器 {json.dumps(mock_request(base_url, '/__stats'), ensure_ascii=False)}")
+    finally:
+        process.terminate()
+
+
+def add_client_arguments(p):
+    p.add_argument("--engine", choices=["thread", "async"], default="thread")
+    p.add_argument("--max-workers", type=int, default=3)
+    p.add_argument("--batch-size", type=int, default=20)
+    p.add_argument("--decode-workers", type=int, default=0)
+    p.add_argument("--rate", type=float, default=1000.0, help="客户端各限速器的每秒请求数")
+    p.add_argument("--identity-rate", type=float, default=0, help="客户端每个设备身份的每秒请求数（默认同 --rate）")
+    p.add_argument("--identities", type=int, default=0, help="使用的设备身份数量（0 表示只用默认身份）")
+    p.add_argument("--identity-start", type=int, default=0, help=argparse.SUPPRESS)
+    p.add_argument("--book-format", choices=["txt", "tnb"], default="txt", help="下载保存的格式")
+    p.add_argument("--retry-max-attempts", type=int, default=8, help="每个章节的最大尝试次数")
+    p.add_argument("--retry-delay", type=float, default=1.0, help="重试退避的基础时间（秒）")
+    p.add_argument("--retry-max-delay", type=float, default=30.0, help="重试退避的最长时间（秒）")
+    p.add_argument("--circuit-open-seconds", type=float, default=30, help="接口熔断的时间（秒）")
+    p.add_argument("--no-cache", action="store_true", help="不使用章节缓存")
+    p.add_argument("--verbose", action="store_true", help="显示下载器的输出")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="番茄小说下载器性能测试")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("sanitize", help="章节内容清洗与旧正则流程对比")
+    p.add_argument("--chapters", type=int, default=2000)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_sanitize)
+
+    p = sub.add_parser("e2e", help="用本地模拟服务器端到端下载合成书籍")
+    p.add_argument("--chapters", type=int, nargs="+", default=[100, 1000, 10000], help="每本书的章节数")
+    p.add_argument("--latency", type=float, default=0.02, help="服务器每个请求的延迟（秒）")
+    p.add_argument("--jitter", type=float, default=0.005)
+    p.add_argument("--error-rate", type=float, default=0.0, help="返回 500 的比例")
+    p.add_argument("--throttle-rate", type=float, default=0.0, help="随机返回 429 的比例")
+    p.add_argument("--server-qps", type=float, default=0, help="服务器每秒请求上限，超出返回 429")
+    p.add_argument("--page-kb", type=int, default=200, help="书籍详情页大小（KB）")
+    p.add_argument("--timeout", type=float, default=1800)
+    p.add_argument("--json", help="把结果写入 JSON 文件")
+    p.add_argument("--compare", help="与之前保存的 JSON 结果对比")
+    p.add_argument("--tolerance", type=float, default=0.1, help="速度下降超过该比例时标记为变慢")
+    add_client_arguments(p)
+    p.set_defaults(func=bench_e2e)
+
+    p = sub.add_parser("identities", help="设备身份数量与吞吐量，模拟服务器按身份限流")
+    p.add_argument("--chapters", type=int, default=2000)
+    p.add_argument("--counts", type=int, nargs="+", default=[1, 2, 4], help="依次测试的身份数量")
+    p.add_argument("--identity-qps", type=float, default=5, help="模拟服务器给每个身份的每秒请求上限")
+    p.add_argument("--bad", type=int, default=1, help="额外测试的失效身份数量")
+    p.add_argument("--with-bad", type=int, default=4, help="测试失效身份时的正常身份数量")
+    p.add_argument("--latency", type=float, default=0.02)
+    p.add_argument("--jitter", type=float, default=0.005)
+    p.add_argument("--timeout", type=float, default=1800)
+    add_client_arguments(p)
+    p.set_defaults(func=bench_identities)
+
+    p = sub.add_parser("queue", help="多个工作节点共用队列下载，节点数量与吞吐量")
+    p.add_argument("--chapters", type=int, default=2000)
+    p.add_argument("--nodes", type=int, nargs="+", default=[1, 2, 4], help="依次测试的节点数量")
+    p.add_argument("--node-rate", type=float, default=4, help="每个节点每个限速器的每秒请求数")
+    p.add_argument("--kill", action="store_true", help="额外测试中途强制结束一个节点")
+    p.add_argument("--lease-seconds", type=float, default=10)
+    p.add_argument("--max-workers", type=int, default=3)
+    p.add_argument("--batch-size", type=int, default=20)
+    p.add_argument("--latency", type=float, default=0.02)
+    p.add_argument("--jitter", type=float, default=0.005)
+    p.add_argument("--error-rate", type=float, default=0.0)
+    p.add_argument("--timeout", type=float, default=1800)
+    p.set_defaults(func=bench_queue)
+
+    p = sub.add_parser("bad-chapters", help="个别章节在所有接口上都无法下载时，下载应以未完成结束并列出这些章节")
+    p.add_argument("--chapters", type=int, default=200)
+    p.add_argument("--bad", type=int, nargs="+", default=[7, 150], help="无法下载的章节序号")
+    p.add_argument("--engines", nargs="+", choices=["thread", "async"], default=["thread", "async"])
+    p.add_argument("--latency", type=float, default=0.005)
+    p.add_argument("--jitter", type=float, default=0.002)
+    p.add_argument("--timeout", type=float, default=120)
+    add_client_arguments(p)
+    p.set_defaults(func=bench_bad_chapters, retry_max_attempts=4, retry_delay=0.05,
+                   retry_max_delay=0.2, circuit_open_seconds=0.3)
+
+    p = sub.add_parser("metadata", help="书籍信息解析与 BeautifulSoup 对比")
+    p.add_argument("--page-kb", type=int, default=200)
+    p.add_argument("--repeat", type=int, default=20)
+    p.set_defaults(func=bench_metadata)
+
+    p = sub.add_parser("export", help="从章节缓存导出 TXT、EPUB 和分章、分卷文件")
+    p.add_argument("--chapters", type=int, default=5000)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_export)
+
+    p = sub.add_parser("startup", help="启动耗时和启动时加载的重量级模块")
+    p.add_argument("--runs", type=int, default=10)
+    p.set_defaults(func=bench_startup)
+
+    p = sub.add_parser("e2e-child")
+    p.add_argument("--base-url", required=True)
+    p.add_argument("--book-id", required=True)
+    add_client_arguments(p)
+    p.set_defaults(func=run_e2e_child)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()